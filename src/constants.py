@@ -8,5 +8,113 @@ DATA_PATH = os.path.join(PROJECT_ROOT, 'data', 'raw', 'data.json')
 STAGING_FOLDER = os.path.join(PROJECT_ROOT, 'data', 'staging')
 EXPORT_FOLDER = os.path.join(PROJECT_ROOT, 'data', 'export')
 
+# Expectation suite the raw data is validated against, profiled from the raw data once and then reused
+EXPECTATION_SUITE_PATH = os.path.join(PROJECT_ROOT, 'data', 'expectation_suite.json')
+
+# Semantic type of each raw column, as declared to the profiler and checked by the validation module
+DATA_QUALITY_SEMANTIC_TYPES = {
+    'string': ['id', 'email', 'location', 'widget_list'],
+    'numeric': ['age_group', 'user_score', 'revenue'],
+    'datetime': ['created_at'],
+}
+
+# Expectations the profiler would pin to the aggregates of the data it profiled, such as its row count, column
+# statistics and value ranges, which new valid data does not meet. They are left out of the saved suite,
+# which keeps the schema, type and null checks
+DATA_QUALITY_EXCLUDED_EXPECTATIONS = [
+    'expect_table_row_count_to_be_between',
+    'expect_column_min_to_be_between',
+    'expect_column_max_to_be_between',
+    'expect_column_mean_to_be_between',
+    'expect_column_median_to_be_between',
+    'expect_column_quantile_values_to_be_between',
+    'expect_column_proportion_of_unique_values_to_be_between',
+    'expect_column_values_to_be_between',
+]
+
+# Patterns the raw string columns must match, and the number of rows validated per parallel chunk
+VALIDATION_PATTERNS = {
+    'id': r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$',
+    'email': r'^[^@\s]+@[^@\s]+\.[^@\s]+$',
+}
+VALIDATION_CHUNKSIZE = 250000
+
+# Format of the staging snapshots, one of those registered in the snapshots module
+SNAPSHOT_FORMAT = 'npy'
+
 # Path to the SQLite database within the export folder
-DB_PATH = os.path.join(EXPORT_FOLDER, 'database.db')
\ No newline at end of file
+DB_PATH = os.path.join(EXPORT_FOLDER, 'database.db')
+
+# Path to the multi-field inverted index within the export folder, and the fields it indexes
+INDEX_PATH = os.path.join(EXPORT_FOLDER, 'index.npz')
+INDEX_FIELDS = ['location', 'age_group', 'widget_name', 'email_domain', 'created_month']
+
+# Share of the indexed users changed since the multi-field index was last compacted beyond which saving it
+# compacts it, rather than writing the changes as delta segments next to it
+INDEX_COMPACT_FRACTION = 0.1
+
+# Path to the store of (id, created_at) fingerprints of records ingested by earlier incremental runs,
+# and the number of keys a new store is sized for
+FINGERPRINT_PATH = os.path.join(EXPORT_FOLDER, 'fingerprints.npz')
+DEDUP_CAPACITY = 1000000
+
+# Secondary indexes built on the transformed_data table after a bulk load
+TRANSFORMED_DATA_INDEXES = [['id', 'created_at'], ['location']]
+
+# Secondary indexes of the star-schema export, which stores transformed_data as users, widgets and locations
+# tables behind a view of the same shape. users and locations are keyed on their integer surrogate keys
+STAR_SCHEMA_INDEXES = {
+    'users': [['id', 'created_at'], ['location_key']],
+    'widgets': [['user_key', 'position'], ['name']],
+    'locations': [['location']],
+}
+
+# Fields of the optional search index, searched by prefix or whole term in '<field>_search' tables
+SEARCH_FIELDS = ['email', 'widget_name']
+
+# Size limits of the result cache of the query service, in results and in estimated bytes
+QUERY_CACHE_MAX_ENTRIES = 1024
+QUERY_CACHE_MAX_BYTES = 64 * 2 ** 20
+
+# Number of records per batch when the pipeline runs in streaming mode
+BATCH_SIZE = 100000
+
+# In compact mode, string columns become categorical when at most this fraction of their values are distinct
+COMPACT_MAX_UNIQUE_RATIO = 0.8
+
+# Semantic type of each column produced by the pipeline. Only 'nested' columns can hold lists or dicts.
+PIPELINE_SCHEMA = {
+    'id': 'string',
+    'email': 'string',
+    'age_group': 'numeric',
+    'user_score': 'numeric',
+    'revenue': 'numeric',
+    'widget_list': 'nested',
+    'location': 'string',
+    'created_at': 'datetime',
+    'age_group_rank': 'numeric',
+    'widget_name': 'string',
+    'widget_amount': 'numeric',
+}
+
+# Folder holding the cached output of each pipeline stage, and the size it is trimmed to after a run
+CACHE_FOLDER = os.path.join(PROJECT_ROOT, 'data', 'cache')
+CACHE_MAX_BYTES = 1 << 30
+
+# Measurements of each pipeline stage, appended as JSON lines after every run, and those of the last run in the
+# Prometheus text format for a node exporter textfile collector
+METRICS_PATH = os.path.join(PROJECT_ROOT, 'data', 'metrics', 'stages.jsonl')
+PROMETHEUS_PATH = os.path.join(PROJECT_ROOT, 'data', 'metrics', 'stages.prom')
+
+# Column types of the raw data for the typed parser backend of extract. 'int' picks the smallest integer
+# type holding the values, and 'widgets' columns also get flat offset and value arrays
+RAW_DATA_DTYPES = {
+    'id': 'string',
+    'email': 'string',
+    'age_group': 'int',
+    'user_score': 'float64',
+    'revenue': 'float64',
+    'widget_list': 'widgets',
+    'location': 'category',
+    'created_at': 'datetime',
+}
\ No newline at end of file
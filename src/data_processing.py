@@ -1,76 +1,302 @@
 import os
+import json
+import numpy as np
 import pandas as pd
-from io import StringIO
+from io import StringIO, BytesIO
+from itertools import chain, islice
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
-from constants import DATA_PATH
+import snapshots
+import parsers
+from fingerprints import FingerprintStore
+from constants import DATA_PATH, PIPELINE_SCHEMA, COMPACT_MAX_UNIQUE_RATIO
 
+# Parser backends extract can read the raw data with
+PARSER_BACKENDS = ('pandas', 'typed')
 
-def extract(data_path=DATA_PATH):
+
+def extract(data_path=DATA_PATH, chunksize=None, max_workers=None, backend='pandas'):
     """
     Load the JSON data into a DataFrame.
     
     Parameters:
     data_path (str): The file path to the JSON data. Defaults to DATA_PATH from constants module.
+    chunksize (int, optional): If given, stream the file instead and yield DataFrames of at most this many records.
+    max_workers (int, optional): If more than one, parse the file in parallel with extract_partitions and merge
+                                 the partitions back into file order. The result is the same as a serial extract.
+    backend (str): The JSON parser, 'pandas' for pd.read_json or 'typed' for parsers.parse_lines, which is faster
+                   and stores the columns in the compact types of RAW_DATA_DTYPES. Both read the same values.
     
     Returns:
     pd.DataFrame: The loaded data.
+    Iterator[pd.DataFrame]: The record batches, if chunksize is given.
     
     Raises:
-    ValueError: If the file could not be loaded.
+    ValueError: If the file could not be loaded, chunksize is not positive or the backend is unknown.
     """
+    if backend not in PARSER_BACKENDS:
+        raise ValueError(f"Unknown parser backend {backend!r}, expected one of: {', '.join(PARSER_BACKENDS)}")
+
+    if chunksize is not None:
+        if chunksize < 1:
+            raise ValueError(f"chunksize must be a positive integer, got {chunksize}")
+        try:
+            file = open(data_path, 'r')
+        except Exception as e:
+            raise ValueError(f"Failed to load data from {data_path}: {e}")
+        return _extract_batches(file, data_path, chunksize, backend)
+
+    if max_workers is not None and max_workers > 1:
+        return merge_partitions(extract_partitions(data_path, partitions=max_workers, max_workers=max_workers,
+                                                   backend=backend))
+
     try:
-        with open(data_path, 'r') as file:
-            data_str = file.read()
-        data = pd.read_json(StringIO(data_str), lines=True)
+        with open(data_path, 'rb') as file:
+            data = _read_lines(file.read(), backend)
     except Exception as e:
         raise ValueError(f"Failed to load data from {data_path}: {e}")
     return data
 
 
-def export_snapshot(data, snapshot_folder, snapshot_name):
+def _read_lines(text, backend):
+    """
+    Parse JSON lines, given as one str or bytes, into a DataFrame with the given parser backend.
+
+    Floats are parsed exactly by both backends, so their values round-trip the file.
+    """
+    if backend == 'typed':
+        return parsers.parse_lines(text.splitlines(), widgets=False)[0]
+    return pd.read_json(BytesIO(text) if isinstance(text, bytes) else StringIO(text), lines=True, precise_float=True)
+
+
+def _concat(frames):
+    """Concatenate DataFrames, keeping columns categorical when their categories differ between frames."""
+    data = pd.concat(frames)
+    for column, dtype in frames[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype) and not isinstance(data[column].dtype, pd.CategoricalDtype):
+            data[column] = data[column].astype('category')
+    return data
+
+
+def _extract_batches(file, data_path, chunksize, backend='pandas'):
+    """
+    Yield DataFrames of at most chunksize records read straight from an open JSON lines file.
+
+    Only one batch of raw lines is held in memory at a time. The file is closed once
+    the generator is exhausted or discarded.
+    """
+    with file:
+        offset = 0
+        while True:
+            lines = list(islice(file, chunksize))
+            if not lines:
+                break
+            try:
+                batch = _read_lines(''.join(lines), backend)
+            except Exception as e:
+                raise ValueError(f"Failed to load data from {data_path}: {e}")
+            # Keep the index global so batches line up with the non-streaming extract
+            batch.index += offset
+            offset += len(lines)
+            yield batch
+
+
+def extract_partitions(data_path=DATA_PATH, partitions=None, max_workers=None, backend='pandas'):
+    """
+    Load the JSON lines data on a process pool, hash-partitioned on 'id'.
+
+    The file is split into byte ranges ending on line breaks, one or more per worker, and each range is
+    parsed in its own process. Every record goes to the partition of the hash of its id, so records that
+    deduplicate together always share a partition and can be deduplicated independently. Ranking cannot:
+    rank_users ranks users within their age group, which spans every partition, so it needs a global pass
+    over the scores, such as build_score_index. Each partition keeps the file order of its records, indexed
+    by their row number in the file, so merge_partitions restores the result of extract.
+
+    Parameters:
+    data_path (str): The file path to the JSON data. Defaults to DATA_PATH from constants module.
+    partitions (int, optional): The number of partitions. Defaults to the number of workers.
+    max_workers (int, optional): The number of processes. Defaults to the number of CPUs.
+    backend (str): The JSON parser each process uses, as for extract. Defaults to 'pandas'.
+
+    Returns:
+    list: The DataFrame of each partition.
+
+    Raises:
+    ValueError: If the file could not be loaded or is empty, or partitions is not positive.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    partitions = partitions or max_workers
+    if partitions < 1:
+        raise ValueError(f"partitions must be a positive integer, got {partitions}")
+
+    try:
+        ranges = _line_ranges(data_path, max_workers * 4)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            parsed = list(executor.map(_parse_range, [data_path] * len(ranges), *zip(*ranges), [partitions] * len(ranges),
+                                       [backend] * len(ranges)))
+    except Exception as e:
+        raise ValueError(f"Failed to load data from {data_path}: {e}")
+    if not parsed:
+        raise ValueError(f"Failed to load data from {data_path}: the file is empty")
+
+    # Number the rows of each range after those of the ranges before it
+    offsets = np.cumsum([0] + [row_count for _, row_count in parsed])
+    range_partitions = []
+    for (parts, _), offset in zip(parsed, offsets):
+        for part in parts:
+            part.index += offset
+        range_partitions.append(parts)
+    return [_concat([parts[partition] for parts in range_partitions]) for partition in range(partitions)]
+
+
+def merge_partitions(partitions):
+    """
+    Merge the partitions of extract_partitions back into one DataFrame in file order.
+
+    Parameters:
+    partitions (list): The DataFrame of each partition.
+
+    Returns:
+    pd.DataFrame: The merged data.
+    """
+    return _concat(partitions).sort_index()
+
+
+def partition_of(ids, partitions):
+    """
+    Return the partition of each id, from a hash that is stable across processes and runs.
+
+    Parameters:
+    ids (pd.Series): The ids.
+    partitions (int): The number of partitions.
+
+    Returns:
+    np.ndarray: The partition number of each id.
+    """
+    return (pd.util.hash_array(ids.astype(str).to_numpy(dtype=object)) % np.uint64(partitions)).astype(np.int64)
+
+
+def _line_ranges(data_path, count):
+    """Split a file into up to count byte ranges of about equal size, each ending after a line break."""
+    size = os.path.getsize(data_path)
+    boundaries = [0]
+    with open(data_path, 'rb') as file:
+        for target in range(size // count, size, max(size // count, 1)):
+            if target <= boundaries[-1]:
+                continue
+            file.seek(target)
+            file.readline()  # Move to the start of the next line
+            if file.tell() >= size:
+                break
+            boundaries.append(file.tell())
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def _parse_range(data_path, start, end, partitions, backend='pandas'):
+    """Parse a byte range of whole lines and split its records into partitions, numbering them from 0."""
+    with open(data_path, 'rb') as file:
+        file.seek(start)
+        data = _read_lines(file.read(end - start), backend)
+    if data.empty:
+        return [data] * partitions, 0
+
+    partition = partition_of(data['id'], partitions)
+    order = np.argsort(partition, kind='stable')
+    bounds = np.searchsorted(partition[order], np.arange(partitions + 1))
+    return [data.iloc[order[bounds[i]:bounds[i + 1]]] for i in range(partitions)], len(data)
+
+
+def export_snapshot(data, snapshot_folder, snapshot_name, fmt='csv', writer=None):
     """
     Export snapshot of data to the required destination.
 
+    The snapshot is written atomically, so its path only exists once it is complete.
+
     Parameters:
     data (pd.DataFrame): The input data.
     snapshot_folder (str): The path of the folder to save to
     snapshot_name (str): The name to be assigned to the file with a timestamp
+    fmt (str): The snapshot format registered in the snapshots module, e.g. 'csv' or 'npy', or the compressed
+               'csv.gz' or 'npz'. Defaults to 'csv'.
+    writer (snapshots.SnapshotWriter, optional): Write the snapshot in the background on this writer instead
+                                                 of before returning. Write errors are then raised by its flush,
+                                                 and the data must not be modified until the write is done.
 
     Returns:
     str: The path of the folder the snapshot has been saved to
 
     Raises:
     IOError: If there is an issue writing to the specified file path.
+    SnapshotFormatError: If the format is not registered.
     """
+    extension, _, _ = snapshots.get_snapshot_format(fmt)
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    snapshot_path = os.path.join(snapshot_folder, f'{snapshot_name}_{timestamp}.csv')
-    data.to_csv(snapshot_path, index=False)
+    snapshot_path = os.path.join(snapshot_folder, f'{snapshot_name}_{timestamp}{extension}')
+    if writer is not None:
+        writer.submit(data, snapshot_path, fmt)
+    else:
+        snapshots.write_snapshot(data, snapshot_path, fmt)
     return snapshot_path  # Returning the path can be useful for logging or further processing
 
 
-def load_from_staging(staging_folder, file_name):
+def export_snapshot_batches(batches, snapshot_folder, snapshot_name):
+    """
+    Export a stream of batches to a single snapshot, passing each batch through once written.
+
+    Batches are appended to one CSV file, as CSV is the only snapshot format that can be appended to.
+
+    Parameters:
+    batches (Iterable[pd.DataFrame]): The input batches.
+    snapshot_folder (str): The path of the folder to save to
+    snapshot_name (str): The name to be assigned to the file with a timestamp
+
+    Yields:
+    pd.DataFrame: Each input batch, unchanged.
+
+    Raises:
+    IOError: If there is an issue writing to the specified file path.
+    """
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    snapshot_path = os.path.join(snapshot_folder, f'{snapshot_name}_{timestamp}.csv')
+    header = True
+    for batch in batches:
+        batch.to_csv(snapshot_path, index=False, mode='w' if header else 'a', header=header)
+        header = False
+        yield batch
+
+
+def load_from_staging(staging_folder, file_name, mmap=True):
     """
     Load snapshot of data from the required destination.
 
     Parameters:
     staging_folder (str): The path of the folder to load from.
-    file_name (str): The name of the file to load.
+    file_name (str): The name of the file to load. Its extension determines the snapshot format.
+    mmap (bool): Memory-map the stored arrays where the format supports it. Defaults to True.
 
     Returns:
     pd.DataFrame: The loaded data.
+
+    Raises:
+    SnapshotFormatError: If the file does not match a registered format.
     """
     file_path = os.path.join(staging_folder, file_name)
-    data = pd.read_csv(file_path)
+    _, _, reader = snapshots.detect_snapshot_format(file_path)
+    data = reader(file_path, mmap=mmap)
     return data
 
 
-def deduplicate(data):
+def deduplicate(data, seen=None):
     """
     Deduplicate the data based on 'id' and 'created_at'.
     
     Parameters:
     data (pd.DataFrame): The input data.
+    seen (set or FingerprintStore, optional): The (id, created_at) keys of previously processed batches
+                          or runs. Rows matching one of them are dropped too, and the keys kept from this
+                          batch are added to it. A FingerprintStore holds the keys far more compactly than a set.
     
     Returns:
     pd.DataFrame: The deduplicated data.
@@ -82,18 +308,51 @@ def deduplicate(data):
         raise ValueError("Input DataFrame is empty")
     
     deduplicated_data = data.drop_duplicates(subset=['id', 'created_at'])
+
+    if isinstance(seen, FingerprintStore):
+        deduplicated_data = deduplicated_data[seen.update(deduplicated_data)]
+    elif seen is not None:
+        keys = list(zip(deduplicated_data['id'], deduplicated_data['created_at']))
+        deduplicated_data = deduplicated_data[[key not in seen for key in keys]]
+        seen.update(keys)
     return deduplicated_data
 
 
-def rank_users(data):
+def build_score_index(batches):
+    """
+    Collect the user_score distribution of each age group from a stream of batches.
+
+    Only the scores are kept, so the result is far smaller than the batches themselves
+    and can be used to rank any later batch against the whole dataset.
+
+    Parameters:
+    batches (Iterable[pd.DataFrame]): The (deduplicated) input batches.
+
+    Returns:
+    dict: A mapping of age_group to a sorted (ascending) array of the user_score values in that group.
+    """
+    scores = {}
+    for batch in batches:
+        for age_group, group_scores in batch.groupby('age_group')['user_score']:
+            scores.setdefault(age_group, []).append(group_scores.to_numpy())
+    return {age_group: np.sort(np.concatenate(parts)) for age_group, parts in scores.items()}
+
+
+def rank_users(data, score_index=None):
     """
     Rank the users within their age groups based on their user_score.
+
+    The data is ordered by age_group and descending user_score with one stable lexsort, and the
+    ranks are read off that order, so the ranked data can be passed to top_k_per_group without
+    sorting it again.
     
     Parameters:
     data (pd.DataFrame): The input data.
+    score_index (dict, optional): The output of build_score_index. If given, users are ranked against
+                                  every score in the index rather than only those in the input data.
     
     Returns:
-    pd.DataFrame: The data with an added 'age_group_rank' column.
+    pd.DataFrame: The data sorted by age_group and descending user_score, with an added 'age_group_rank' column.
 
     Raises:
     ValueError: If the input data is empty.
@@ -101,21 +360,92 @@ def rank_users(data):
     if data.empty:
         raise ValueError("Input DataFrame is empty")
 
-    # Make a copy of the data to avoid modifying the original DataFrame
-    data_copy = data.copy()
+    group_codes = pd.factorize(data['age_group'], sort=True)[0]
+    user_scores = data['user_score'].to_numpy(dtype=float)
+    order = np.lexsort((-user_scores, group_codes))
+    # take already returns a new frame, so the input is left untouched without a defensive copy
+    ranked_data = data.take(order)
+    group_codes, user_scores = group_codes[order], user_scores[order]
+
+    if score_index is not None:
+        # Rank 'min' in descending order is one more than the number of strictly greater scores
+        ranks = np.empty(len(ranked_data), dtype=int)
+        for age_group, positions in ranked_data.groupby('age_group').indices.items():
+            group_scores = score_index[age_group]
+            ranks[positions] = len(group_scores) - np.searchsorted(group_scores, user_scores[positions], side='right') + 1
+        ranked_data['age_group_rank'] = ranks
+        return ranked_data
+
+    # In sorted order, a 'min' rank is the position of the first row with the same score, counted from the group's first row
+    positions = np.arange(len(ranked_data))
+    group_starts = np.r_[True, group_codes[1:] != group_codes[:-1]]
+    score_starts = group_starts | np.r_[True, user_scores[1:] != user_scores[:-1]]
+    ranked_data['age_group_rank'] = np.maximum.accumulate(np.where(score_starts, positions, 0)) \
+                                    - np.maximum.accumulate(np.where(group_starts, positions, 0)) + 1
+
+    return ranked_data
+
+
+def top_k_per_group(data, k, group_column='age_group', score_column='user_score', rank_column='age_group_rank',
+                    key_columns=('id', 'created_at')):
+    """
+    Get the k highest scoring records of each group.
+
+    If the data has been ranked by rank_users, the rows are picked by their rank in one pass, without
+    sorting the data. Otherwise each group's top k are found by partial selection (np.argpartition)
+    rather than a full sort. Ties are broken by the order of the rows in the data. Rows repeating a
+    record, as flattened data repeats a record once per widget, count once, keeping the first.
 
-    # Sort the data by age_group and user_score, in descending order for user_score
-    data_copy.sort_values(by=['age_group', 'user_score'], ascending=[True, False], inplace=True)
+    Parameters:
+    data (pd.DataFrame): The input data.
+    k (int): The number of rows to keep per group.
+    group_column (str): The column to group by. Defaults to 'age_group'.
+    score_column (str): The column to rank by, highest first. Defaults to 'user_score'.
+    rank_column (str): The column holding ranks from rank_users, used if present. Defaults to 'age_group_rank'.
+    key_columns (Iterable[str]): The columns identifying a record, as ranked by rank_users. Those missing
+                                 from the data are left out. Defaults to ('id', 'created_at').
 
-    # Compute the rank within each age group based on user_score
-    data_copy['age_group_rank'] = data_copy.groupby('age_group')['user_score'].rank(method='min', ascending=False).astype(int)
+    Returns:
+    pd.DataFrame: Up to k rows per group, one per record, ordered by group and then by descending score.
 
-    return data_copy
+    Raises:
+    ValueError: If k is less than 1.
+    """
+    if k < 1:
+        raise ValueError("k must be at least 1")
+
+    key_columns = [column for column in key_columns if column in data.columns]
+    if rank_column in data.columns:
+        # Ranks count each record once, so only the repeated rows of the few candidates need dropping
+        candidates = data[data[rank_column].to_numpy() <= k]
+        if key_columns:
+            candidates = candidates.drop_duplicates(subset=key_columns)
+        sort_keys = candidates[rank_column].to_numpy()
+    else:
+        if key_columns:
+            data = data.drop_duplicates(subset=key_columns)
+        user_scores = data[score_column].to_numpy(dtype=float)
+        selected = []
+        for positions in data.groupby(group_column).indices.values():
+            if len(positions) > k:
+                # Keep every row scoring at least the k-th highest score, so ties at the cut are resolved by row order below
+                threshold = -np.partition(-user_scores[positions], k - 1)[k - 1]
+                positions = positions[user_scores[positions] >= threshold]
+            selected.append(positions)
+        candidates = data.take(np.sort(np.concatenate(selected))) if selected else data.iloc[:0]
+        sort_keys = -candidates[score_column].to_numpy(dtype=float)
+
+    # Only the few candidate rows are sorted, stably so that earlier rows win ties
+    group_codes = pd.factorize(candidates[group_column], sort=True)[0]
+    candidates = candidates.take(np.lexsort((sort_keys, group_codes)))
+    return candidates.groupby(group_column, sort=False).head(k)
 
 
 def get_top_user_per_age_group(data):
     """
     Get the top user from each age group based on user_score.
+
+    Data ranked by rank_users is not sorted again, see top_k_per_group.
     
     Parameters:
     data (pd.DataFrame): The input data.
@@ -133,9 +463,7 @@ def get_top_user_per_age_group(data):
     if not all(col in data.columns for col in required_columns):
         raise ValueError(f"Missing required columns: {', '.join(required_columns)}")
 
-    return data.sort_values(by=['age_group', 'user_score'], ascending=[True, False])\
-                .groupby('age_group')\
-                .head(1)[['id', 'email', 'age_group']]
+    return top_k_per_group(data, 1)[['id', 'email', 'age_group']]
 
 
 def flatten_widget_list(data):
@@ -158,12 +486,117 @@ def flatten_widget_list(data):
     return data_exploded
 
 
-def convert_unsupported_data_types(data):
+def flatten_and_extract_widgets(data):
     """
-    Convert unsupported data types in a DataFrame to strings.
+    Flatten the widget_list column and extract widget_name and widget_amount in a single pass.
+
+    Gives the same result as extract_widget_info(flatten_widget_list(data)), but reads each
+    widget list once and expands the parent rows with one take over repeated row positions,
+    instead of exploding every column and then applying a lambda per cell for each new column.
+
+    Parameters:
+    data (pd.DataFrame): The input data.
+
+    Returns:
+    pd.DataFrame: The data with one row per widget and added 'widget_name' and 'widget_amount' columns.
+
+    Raises:
+    ValueError: If the input data is empty.
+    """
+    if data.empty:
+        raise ValueError("Input DataFrame is empty")
+
+    # Read the length of every widget list once, -1 marks values that are not lists
+    widget_lists = data['widget_list'].to_numpy(dtype=object)
+    lengths = np.array([len(x) if isinstance(x, (list, tuple)) else -1 for x in widget_lists.tolist()], dtype=np.intp)
+    is_list = lengths >= 0
+    counts = np.maximum(lengths, 0)
+
+    # Every parent row is repeated once per widget, or kept once if it has none
+    repeats = np.maximum(counts, 1)
+    flattened_data = data.take(np.repeat(np.arange(len(data)), repeats))
+
+    # Row offset of each widget in the output: the start of its parent row plus its position in the list
+    list_starts = np.cumsum(counts) - counts
+    widget_rows = np.repeat(np.cumsum(repeats) - repeats, counts) + np.arange(counts.sum()) - np.repeat(list_starts, counts)
+
+    # Parent rows without widgets keep their value like explode does, empty lists become NaN
+    widgets = np.repeat(widget_lists, repeats)
+    widgets[np.repeat(lengths == 0, repeats)] = np.nan
+    flat_widgets = np.fromiter(chain.from_iterable(widget_lists[is_list]), dtype=object, count=len(widget_rows))
+    widgets[widget_rows] = flat_widgets
+
+    # Lists normally hold only dicts, so try the unchecked lookups first
+    flat_widgets = flat_widgets.tolist()
+    try:
+        flat_names = [widget['name'] for widget in flat_widgets]
+        flat_amounts = [widget['amount'] for widget in flat_widgets]
+    except TypeError:
+        flat_names = [widget['name'] if isinstance(widget, dict) else None for widget in flat_widgets]
+        flat_amounts = [widget['amount'] if isinstance(widget, dict) else None for widget in flat_widgets]
+
+    names = np.full(len(widgets), None, dtype=object)
+    names[widget_rows] = np.fromiter(flat_names, dtype=object, count=len(flat_names))
+
+    # Rows without a widget leave gaps in widget_amount, which turn integer amounts into floats
+    flat_amounts = np.array(flat_amounts)
+    if flat_amounts.dtype.kind in 'iuf' and len(widget_rows) == len(widgets):
+        amounts = flat_amounts
+    elif flat_amounts.dtype.kind in 'iuf' and len(flat_amounts):
+        amounts = np.full(len(widgets), np.nan)
+        amounts[widget_rows] = flat_amounts
+    else:
+        amounts = np.full(len(widgets), None, dtype=object)
+        amounts[widget_rows] = flat_amounts
+        amounts = pd.Series(amounts).infer_objects().to_numpy()
+
+    flattened_data['widget_list'] = widgets
+    flattened_data['widget_name'] = names
+    flattened_data['widget_amount'] = amounts
+    return flattened_data
+
+
+def compact_dtypes(data, schema=PIPELINE_SCHEMA, max_unique_ratio=COMPACT_MAX_UNIQUE_RATIO):
+    """
+    Store the columns of a DataFrame in compact types, without changing their values.
+
+    String columns with repeated values, such as the user columns repeated for every widget once the
+    widget list is flattened, become categorical so each distinct string is held once. Integer columns
+    are downcast to the smallest integer type holding their values. Floats, datetimes and nested columns
+    are left as they are, and columns that are already compact are passed through.
+
+    Parameters:
+    data (pd.DataFrame): The input data.
+    schema (dict): The semantic type of each column. Defaults to PIPELINE_SCHEMA from constants module.
+    max_unique_ratio (float): The largest fraction of distinct values a string column becomes categorical at.
+                              Defaults to COMPACT_MAX_UNIQUE_RATIO from constants module.
+
+    Returns:
+    pd.DataFrame: The data in compact types.
+    """
+    compacted = data.copy(deep=False)
+    for column in data.columns:
+        series = data[column]
+        semantic_type = schema.get(column)
+        if semantic_type == 'string' and series.dtype == object:
+            if series.nunique() <= max_unique_ratio * len(series):
+                compacted[column] = series.astype('category')
+        elif semantic_type == 'numeric' and series.dtype.kind in 'iu':
+            compacted[column] = pd.to_numeric(series, downcast='integer')
+    return compacted
+
+
+def convert_unsupported_data_types(data, schema=PIPELINE_SCHEMA):
+    """
+    Convert unsupported data types in a DataFrame to JSON strings.
+
+    Only object columns that the schema declares as 'nested', or that it does not declare at all,
+    are scanned. Their lists and dicts are serialized as JSON so they can be parsed back later.
+    Numeric, datetime and declared string columns are passed through untouched.
 
     Parameters:
     data (pd.DataFrame): The input data.
+    schema (dict): The semantic type of each column. Defaults to PIPELINE_SCHEMA from constants module.
 
     Returns:
     pd.DataFrame: The data with unsupported data types converted to strings.
@@ -174,7 +607,12 @@ def convert_unsupported_data_types(data):
     if data.empty:
         raise ValueError("Input DataFrame is empty")
 
-    converted_data = data.apply(lambda series: series.map(lambda x: str(x) if isinstance(x, (list, dict)) else x))
+    converted_data = data.copy(deep=False)
+    for column in data.columns:
+        if data[column].dtype != object or schema.get(column, 'nested') != 'nested':
+            continue
+        converted_data[column] = [json.dumps(x, default=str) if isinstance(x, (list, dict)) else x
+                                  for x in data[column].tolist()]
     return converted_data
 
 
@@ -1,6 +1,16 @@
+import os
+import re
+import hashlib
+import queue
 import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+from urllib.request import pathname2url
 
-from constants import DB_PATH
+from constants import DB_PATH, STAR_SCHEMA_INDEXES, SEARCH_FIELDS
+from rankings import AgeGroupRankings
 
 class DatabaseError(Exception):
     """An exception class for database-related errors."""
@@ -11,12 +21,14 @@ class IndexCreationError(DatabaseError):
 class IndexStorageError(DatabaseError):
     """An exception class for errors during inverted index storage."""
 
-def connect(db_path=DB_PATH):
+def connect(db_path=DB_PATH, read_only=False, check_same_thread=True):
     """
     Create a database connection and return the connection object.
 
     Parameters:
     db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    read_only (bool): Open the database read-only. It must already exist. Defaults to False.
+    check_same_thread (bool): Only allow the creating thread to use the connection. Defaults to True.
 
     Returns:
     sqlite3.Connection: The connection object for the SQLite database.
@@ -25,34 +37,797 @@ def connect(db_path=DB_PATH):
     DatabaseError: If a database connection error occurs.
     """
     try:
-        conn = sqlite3.connect(db_path)
+        if read_only:
+            uri = f'file:{pathname2url(os.path.abspath(db_path))}?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=check_same_thread)
+        else:
+            conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
         return conn
     except sqlite3.Error as e:
         raise DatabaseError(f"Database connection error: {e}")
 
-def load(data, db_path=DB_PATH, table_name='main_table'):
+class Session:
+    """
+    A database connection shared by every database stage of a pipeline run.
+
+    Used as a context manager, the session opens one transaction that all writes made through it
+    join, committing it on a clean exit and rolling it back if an exception escapes. The database is
+    switched to WAL mode, so ReaderPool connections can keep reading while the session writes. Bulk loads
+    tune the connection's pragmas for the rest of the transaction with set_pragmas.
+    """
+
+    def __init__(self, db_path=DB_PATH, bulk_load=False):
+        """
+        Parameters:
+        db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+        bulk_load (bool): Run each transaction with synchronous off, as bulk_load does, for sessions whose
+                          transactions bulk load tables. SQLite only changes it outside a transaction.
+                          Defaults to False.
+
+        Raises:
+        DatabaseError: If a database connection error occurs.
+        """
+        self.db_path = db_path
+        self.bulk_load = bulk_load
+        self.conn = connect(db_path, check_same_thread=False)
+        self.conn.isolation_level = None  # Transactions are managed by the session
+        self._saved_pragmas = {}
+        try:
+            self.conn.execute('PRAGMA journal_mode = WAL')
+            self.conn.execute('PRAGMA synchronous = NORMAL')
+        except sqlite3.Error as e:
+            self.conn.close()
+            raise DatabaseError(f"Database error: {e}")
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            self.close()
+
+    def begin(self):
+        """Open a transaction, unless one is already open."""
+        if not self.conn.in_transaction:
+            if self.bulk_load:
+                self.set_pragmas(synchronous='OFF')
+            self.conn.execute('BEGIN')
+
+    def commit(self):
+        """Commit the open transaction, if any, then restore any pragmas set for it."""
+        if self.conn.in_transaction:
+            self.conn.execute('COMMIT')
+        self._restore_pragmas()
+
+    def rollback(self):
+        """Roll back the open transaction, if any, then restore any pragmas set for it."""
+        if self.conn.in_transaction:
+            self.conn.execute('ROLLBACK')
+        self._restore_pragmas()
+
+    def set_pragmas(self, **pragmas):
+        """
+        Set pragmas on the session's connection until its transaction ends, when their previous values are restored.
+
+        Pragmas such as synchronous cannot be changed inside a transaction, see the bulk_load parameter.
+
+        Parameters:
+        pragmas: The value of each pragma, e.g. synchronous='OFF'.
+        """
+        for pragma, value in pragmas.items():
+            if pragma not in self._saved_pragmas:
+                self._saved_pragmas[pragma] = self.conn.execute(f'PRAGMA {pragma}').fetchone()[0]
+            self.conn.execute(f'PRAGMA {pragma} = {value}')
+
+    def _restore_pragmas(self):
+        """Restore the pragmas changed by set_pragmas to their previous values."""
+        for pragma, value in self._saved_pragmas.items():
+            self.conn.execute(f'PRAGMA {pragma} = {value}')
+        self._saved_pragmas = {}
+
+    def close(self):
+        """Close the connection, rolling back any transaction still open."""
+        self.conn.close()
+
+class ReaderPool:
+    """
+    A thread-safe pool of read-only connections to a SQLite database.
+
+    Connections are handed out to one thread at a time and returned to the pool afterwards,
+    so many threads can query the export database concurrently, including while a Session writes to it.
+    """
+
+    def __init__(self, db_path=DB_PATH, size=4):
+        """
+        Parameters:
+        db_path (str): The path to the SQLite database, which must already exist. Defaults to DB_PATH from constants module.
+        size (int): The number of connections in the pool. Defaults to 4.
+
+        Raises:
+        ValueError: If size is not positive.
+        DatabaseError: If a database connection error occurs.
+        """
+        if size < 1:
+            raise ValueError(f"size must be a positive integer, got {size}")
+        self.db_path = db_path
+        self._connections = queue.LifoQueue()
+        self._all_connections = []
+        self._lock = threading.Lock()
+        for _ in range(size):
+            conn = connect(db_path, read_only=True, check_same_thread=False)
+            self._all_connections.append(conn)
+            self._connections.put(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Borrow a read-only connection from the pool for the duration of a with block.
+
+        Parameters:
+        timeout (float, optional): How long to wait for a free connection, in seconds. Waits forever by default.
+
+        Raises:
+        DatabaseError: If no connection became free within the timeout.
+        """
+        try:
+            conn = self._connections.get(timeout=timeout)
+        except queue.Empty:
+            raise DatabaseError(f"No free connection in the reader pool after {timeout} seconds")
+        try:
+            yield conn
+        finally:
+            self._connections.put(conn)
+
+    def query(self, sql, params=()):
+        """
+        Run a query on a pooled connection and return all result rows.
+
+        Parameters:
+        sql (str): The query to run.
+        params (tuple or dict): The query parameters. Defaults to none.
+
+        Returns:
+        list: The result rows as tuples.
+
+        Raises:
+        DatabaseError: If a database error occurs.
+        """
+        with self.connection() as conn:
+            try:
+                return conn.execute(sql, params).fetchall()
+            except sqlite3.Error as e:
+                raise DatabaseError(f"Database error: {e}")
+
+    def read_sql(self, sql, params=None):
+        """
+        Run a query on a pooled connection and return the result as a DataFrame.
+
+        Parameters:
+        sql (str): The query to run.
+        params (tuple or dict, optional): The query parameters.
+
+        Returns:
+        pd.DataFrame: The query result.
+        """
+        with self.connection() as conn:
+            return pd.read_sql(sql, conn, params=params)
+
+    def close(self):
+        """Close every connection in the pool."""
+        with self._lock:
+            for conn in self._all_connections:
+                conn.close()
+            self._all_connections = []
+
+@contextmanager
+def _connection(db_path, session):
+    """Yield the session's connection if one is given, otherwise a new connection that is closed afterwards."""
+    if session is not None:
+        yield session.conn
+        return
+    conn = connect(db_path)  # Create a database connection
+    try:
+        yield conn
+    finally:
+        conn.close()  # Close the database connection
+
+def _drop(conn, name):
+    """Drop a table or view, whichever of the two the name belongs to, if it exists."""
+    row = conn.execute("SELECT type FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?", (name,)).fetchone()
+    if row:
+        conn.execute(f'DROP {row[0].upper()} "{name}"')
+
+def _create_table(conn, table_name, dtypes, primary_key=None):
+    """Replace a table with an empty one, with the SQLite column types of the given dtypes."""
+    columns = ', '.join(f'"{column}" {sql_column_type(dtype)}{" PRIMARY KEY" if column == primary_key else ""}'
+                        for column, dtype in dtypes.items())
+    _drop(conn, table_name)
+    conn.execute(f'CREATE TABLE "{table_name}" ({columns})')
+
+def _write_table(conn, data, table_name, indexes=(), primary_key=None):
+    """
+    Replace a table with the given batches, creating it with explicit column types and writing the rows
+    with executemany over a single prepared INSERT. Secondary indexes are built once all rows are in.
+    Nothing is committed, so the writes join whatever transaction the connection has open.
+
+    An integer primary_key column becomes the table's rowid, so joins on it need no separate index.
+
+    Returns:
+    int: The number of rows written.
+    """
+    row_count = 0
+    for batch in data:
+        if batch.empty:
+            continue
+        if not row_count:
+            _create_table(conn, table_name, batch.dtypes, primary_key)
+            insert = f'INSERT INTO "{table_name}" VALUES ({", ".join("?" for _ in batch.columns)})'
+        conn.executemany(insert, zip(*_sql_columns(batch)))
+        row_count += len(batch)
+    if not row_count:
+        raise ValueError("Input data is empty")
+
+    for index_columns in indexes:
+        index_name = f'idx_{table_name}_{"_".join(index_columns)}'
+        quoted_columns = ', '.join(f'"{column}"' for column in index_columns)
+        conn.execute(f'CREATE INDEX "{index_name}" ON "{table_name}" ({quoted_columns})')
+    return row_count
+
+def load(data, db_path=DB_PATH, table_name='main_table', session=None):
     """
     Load the data into a SQLite database.
 
     Parameters:
-    data (pd.DataFrame): The data to be loaded.
+    data (pd.DataFrame or Iterable[pd.DataFrame]): The data to be loaded, either as a single DataFrame
+                                                   or as a stream of batches which are written one at a time.
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    table_name (str): The name of the table to load the data into. Defaults to 'main_table'.
+    session (Session, optional): A session to write through instead of a new connection. The rows are then
+                                 written with prepared statements, as pandas.to_sql would commit the session's transaction.
+
+    Raises:
+    ValueError: If the data is empty.
+    DatabaseError: If a database error occurs.
+    """
+    if isinstance(data, pd.DataFrame):
+        if data.empty:
+            raise ValueError("Input data is empty")
+        data = [data]
+
+    with _connection(db_path, session) as conn:
+        try:
+            if session is not None:
+                _write_table(conn, data, table_name)
+                return
+
+            # The first batch replaces any existing table, the rest are appended to it
+            if_exists = 'replace'
+            for batch in data:
+                if batch.empty:
+                    continue
+                batch.to_sql(table_name, conn, if_exists=if_exists, index=False)
+                if_exists = 'append'
+            if if_exists == 'replace':
+                raise ValueError("Input data is empty")
+        except sqlite3.Error as e:
+            raise DatabaseError(f"Database error: {e}")
+
+def sql_column_type(dtype):
+    """
+    Map a pandas dtype to the SQLite column type pandas.to_sql would declare for it.
+
+    Parameters:
+    dtype (np.dtype or pd.api.extensions.ExtensionDtype): The column dtype.
+
+    Returns:
+    str: The SQLite column type.
+    """
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'TIMESTAMP'
+    return 'TEXT'
+
+def _sql_columns(data):
+    """
+    Convert each column of a DataFrame to a list of plain Python values that SQLite can bind,
+    with None for missing values. Datetimes are converted to UTC text in the format earlier loads
+    stored, e.g. '2020-03-01 00:00:00+00:00', which compares correctly as a string. They are always
+    written to the second, the precision of the raw created_at values, so the same timestamp keys
+    the same row and moves the same high-water mark whichever batch it is loaded in.
+    """
+    columns = []
+    for column, dtype in data.dtypes.items():
+        series = data[column]
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            # Format each distinct timestamp once, as flattened data repeats them once per widget
+            tz_aware = getattr(dtype, 'tz', None) is not None
+            values = (series.dt.tz_convert('UTC').dt.tz_localize(None) if tz_aware else series).to_numpy(dtype='datetime64[ns]')
+            codes, uniques = pd.factorize(values)
+            text = np.char.replace(np.datetime_as_string(uniques, unit='s'), 'T', ' ')
+            text = np.char.add(text, '+00:00' if tz_aware else '').astype(object)
+            series = pd.Series(np.append(text, None)[codes], dtype=object)
+        elif series.hasnans:
+            series = series.astype(object).where(series.notna(), None)
+        columns.append(series.tolist())
+    return columns
+
+def _sql_rows(data):
+    """Convert a DataFrame to a list of row tuples of plain Python values, with None for missing values."""
+    return list(zip(*_sql_columns(data)))
+
+def _get_high_water_mark(conn, table_name):
+    """Return the high-water mark stored for a table, or None if nothing has been loaded yet."""
+    conn.execute("CREATE TABLE IF NOT EXISTS load_state (table_name TEXT PRIMARY KEY, high_water_mark TEXT)")
+    row = conn.execute("SELECT high_water_mark FROM load_state WHERE table_name = ?", (table_name,)).fetchone()
+    return row[0] if row else None
+
+def _set_high_water_mark(conn, table_name, high_water_mark):
+    """Store the high-water mark of a table, keeping the later one if a mark is already stored."""
+    conn.execute(
+        "INSERT INTO load_state (table_name, high_water_mark) VALUES (?, ?) "
+        "ON CONFLICT (table_name) DO UPDATE SET high_water_mark = max(high_water_mark, excluded.high_water_mark)",
+        (table_name, high_water_mark)
+    )
+
+def high_water_mark(db_path=DB_PATH, table_name='transformed_data', session=None):
+    """
+    Return the high-water mark upsert stored for a table.
+
+    Parameters:
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    table_name (str): The name of the table. Defaults to 'transformed_data'.
+    session (Session, optional): A session to read through instead of a new connection.
+
+    Returns:
+    str: The high-water mark as UTC ISO 8601 text, or None if the table has not been upserted into yet.
+
+    Raises:
+    DatabaseError: If a database error occurs.
+    """
+    with _connection(db_path, session) as conn:
+        try:
+            return _get_high_water_mark(conn, table_name)
+        except sqlite3.Error as e:
+            raise DatabaseError(f"Database error: {e}")
+
+def bump_generation(db_path=DB_PATH, session=None):
+    """
+    Increment the run generation of a database, marking that a pipeline run changed its data.
+
+    Written through a session, the new generation is committed in the same transaction as the data,
+    so readers never see new data under an old generation.
+
+    Parameters:
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    session (Session, optional): A session to write through instead of a new connection.
+
+    Returns:
+    int: The new generation.
+
+    Raises:
+    DatabaseError: If a database error occurs.
+    """
+    with _connection(db_path, session) as conn:
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS run_generation (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                         "generation INTEGER NOT NULL)")
+            conn.execute("INSERT INTO run_generation (id, generation) VALUES (0, 1) "
+                         "ON CONFLICT (id) DO UPDATE SET generation = generation + 1")
+            generation = conn.execute("SELECT generation FROM run_generation").fetchone()[0]
+            if session is None:
+                conn.commit()
+            return generation
+        except sqlite3.Error as e:
+            raise DatabaseError(f"Database error: {e}")
+
+def run_generation(conn):
+    """Return the run generation stored by bump_generation on a connection, or 0 if none was stored yet."""
+    try:
+        row = conn.execute("SELECT generation FROM run_generation").fetchone()
+    except sqlite3.OperationalError:
+        return 0  # No run has bumped the generation yet
+    return row[0] if row else 0
+
+def row_count(db_path=DB_PATH, table_name='transformed_data', session=None):
+    """
+    Return the number of rows in a table.
+
+    Parameters:
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    table_name (str): The name of the table. Defaults to 'transformed_data'.
+    session (Session, optional): A session to read through instead of a new connection.
+
+    Returns:
+    int: The number of rows, or None if the database or the table does not exist.
+
+    Raises:
+    DatabaseError: If a database error occurs.
+    """
+    if session is None and not os.path.exists(db_path):
+        return None
+    with _connection(db_path, session) as conn:
+        try:
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?",
+                                  (table_name,)).fetchone()
+            return conn.execute(f'SELECT COUNT(*) FROM "{table_name}"').fetchone()[0] if exists else None
+        except sqlite3.Error as e:
+            raise DatabaseError(f"Database error: {e}")
+
+def state_fingerprint(db_path=DB_PATH, table_names=('transformed_data',), session=None):
+    """
+    Return a fingerprint of the schema and row count of some tables or views, to tell whether they changed.
+
+    Parameters:
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    table_names (Iterable[str]): The tables or views. Those that do not exist are fingerprinted as missing.
+    session (Session, optional): A session to read through instead of a new connection.
+
+    Returns:
+    str: The SHA-256 of the definition, the index definitions and the row count of each table.
+
+    Raises:
+    DatabaseError: If a database error occurs.
+    """
+    digest = hashlib.sha256()
+    if session is None and not os.path.exists(db_path):
+        return digest.hexdigest()
+    with _connection(db_path, session) as conn:
+        try:
+            for table_name in table_names:
+                schema = conn.execute("SELECT type, name, sql FROM sqlite_master WHERE tbl_name = ? ORDER BY name",
+                                      (table_name,)).fetchall()
+                count = conn.execute(f'SELECT COUNT(*) FROM "{table_name}"').fetchone()[0] if schema else None
+                digest.update(repr((table_name, schema, count)).encode())
+        except sqlite3.Error as e:
+            raise DatabaseError(f"Database error: {e}")
+    return digest.hexdigest()
+
+# The key of the rows of upsert, one per widget of each record
+UPSERT_KEY_COLUMNS = ['id', 'created_at', 'widget_position']
+
+def _primary_key(table_info):
+    """Return the primary key columns of a table, in key order, from its PRAGMA table_info rows."""
+    return [name for _, name, _, _, _, pk in sorted(table_info, key=lambda column: column[5]) if pk]
+
+def is_upserted(db_path=DB_PATH, table_name='transformed_data', session=None):
+    """
+    Return whether a table exists with the key upsert writes, rather than as a full load or the star schema
+    view leaves it, in which case the next upsert replaces it with only the rows it is given.
+
+    Raises:
+    DatabaseError: If a database error occurs.
+    """
+    with _connection(db_path, session) as conn:
+        try:
+            return _primary_key(conn.execute(f'PRAGMA table_info("{table_name}")').fetchall()) == UPSERT_KEY_COLUMNS
+        except sqlite3.Error as e:
+            raise DatabaseError(f"Database error: {e}")
+
+def _create_keyed_table(conn, data, table_name, key_columns):
+    """
+    Create a table with a primary key over key_columns, unless a table with that key already exists.
+
+    A table or view of the same name without the key, e.g. from a full load, is dropped along with its
+    high-water mark, so the next upsert reloads it in full.
+    """
+    table_info = conn.execute(f'PRAGMA table_info("{table_name}")').fetchall()
+    if table_info and _primary_key(table_info) == list(key_columns):
+        return
+    if table_info:
+        _drop(conn, table_name)
+        conn.execute("DELETE FROM load_state WHERE table_name = ?", (table_name,))
+
+    columns = ', '.join(f'"{column}" {sql_column_type(dtype)}' for column, dtype in data.dtypes.items())
+    keys = ', '.join(f'"{column}"' for column in key_columns)
+    conn.execute(f'CREATE TABLE "{table_name}" ({columns}, PRIMARY KEY ({keys}))')
+
+def upsert(data, db_path=DB_PATH, table_name='transformed_data', watermark_column='created_at', watermark=True,
+           session=None):
+    """
+    Incrementally load flattened user data into a SQLite database.
+
+    Rows are keyed on (id, created_at, widget_position), where widget_position is the position of the
+    row's widget within its user's widget list and is added if missing. Only rows with a watermark_column
+    value at or after the table's high-water mark are considered. Of those, new rows are inserted, rows
+    whose values differ are updated and widgets beyond the end of a user's current widget list are removed.
+    The high-water mark is then moved to the latest value loaded, so the next run skips rows already loaded.
+    A table without that key, as a full load leaves it, is replaced, and every row given is loaded.
+
+    As older rows are skipped, values derived from the whole dataset, such as age_group_rank, are only
+    refreshed for rows at or after the high-water mark. Callers that already know which rows are new, such
+    as through a fingerprint store, pass watermark=False to load every row given, late arrivals included.
+
+    Parameters:
+    data (pd.DataFrame or Iterable[pd.DataFrame]): The data to be loaded, either as a single DataFrame
+                                                   or as a stream of batches which are written one at a time.
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    table_name (str): The name of the table to load the data into. Defaults to 'transformed_data'.
+    watermark_column (str): The column the high-water mark is kept on. Defaults to 'created_at'.
+    watermark (bool): Skip rows before the high-water mark. The mark is moved forward either way. Defaults to True.
+    session (Session, optional): A session to write through instead of a new connection. The changes are then
+                                 committed with the session's transaction rather than by this function.
+
+    Returns:
+    int: The number of rows inserted, updated or removed.
+
+    Raises:
+    ValueError: If the data is empty or required columns are missing.
+    DatabaseError: If a database error occurs.
+    """
+    key_columns = UPSERT_KEY_COLUMNS
+    if isinstance(data, pd.DataFrame):
+        if data.empty:
+            raise ValueError("Input data is empty")
+        data = [data]
+
+    with _connection(db_path, session) as conn:
+        try:
+            changes = 0
+            high_water_mark = _get_high_water_mark(conn, table_name)
+            if _primary_key(conn.execute(f'PRAGMA table_info("{table_name}")').fetchall()) != key_columns:
+                # The table is replaced with a keyed one, so every row given is loaded whatever the mark says
+                high_water_mark = None
+            loaded = False
+            for batch in data:
+                if batch.empty:
+                    continue
+                if not all(col in batch.columns for col in ['id', 'created_at', watermark_column]):
+                    raise ValueError(f"Missing required columns: id, created_at, {watermark_column}")
+                loaded = True
+
+                batch = batch.reset_index(drop=True)
+                if 'widget_position' not in batch.columns:
+                    batch['widget_position'] = batch.groupby(['id', 'created_at'], sort=False).cumcount()
+                # Store datetimes as UTC text so the high-water mark compares correctly as a string
+                for column, dtype in batch.dtypes.items():
+                    if pd.api.types.is_datetime64_any_dtype(dtype):
+                        batch[column] = _sql_columns(batch[[column]])[0]
+
+                if watermark and high_water_mark is not None:
+                    batch = batch[batch[watermark_column] >= high_water_mark]
+                    if batch.empty:
+                        continue
+
+                _create_keyed_table(conn, batch, table_name, key_columns)
+                batch_changes = conn.total_changes
+                columns = ', '.join(f'"{column}"' for column in batch.columns)
+                placeholders = ', '.join('?' for _ in batch.columns)
+                updates = [column for column in batch.columns if column not in key_columns]
+                assignments = ', '.join(f'"{column}" = excluded."{column}"' for column in updates)
+                changed = ' OR '.join(f'"{table_name}"."{column}" IS NOT excluded."{column}"' for column in updates)
+                conn.executemany(
+                    f'INSERT INTO "{table_name}" ({columns}) VALUES ({placeholders}) '
+                    f'ON CONFLICT ({", ".join(key_columns)}) DO UPDATE SET {assignments} WHERE {changed}',
+                    _sql_rows(batch)
+                )
+
+                # Remove widgets a user no longer has
+                widget_counts = batch.groupby(['id', 'created_at'], sort=False)['widget_position'].max() + 1
+                conn.executemany(
+                    f'DELETE FROM "{table_name}" WHERE id = ? AND created_at = ? AND widget_position >= ?',
+                    [(user_id, created_at, int(count)) for (user_id, created_at), count in widget_counts.items()]
+                )
+                changes += conn.total_changes - batch_changes
+                _set_high_water_mark(conn, table_name, batch[watermark_column].max())
+
+            if not loaded:
+                raise ValueError("Input data is empty")
+            if session is None:
+                conn.commit()
+            return changes
+        except sqlite3.Error as e:
+            raise DatabaseError(f"Database error: {e}")
+
+def bulk_load(data, db_path=DB_PATH, table_name='main_table', indexes=(), cache_size_kib=262144, session=None):
+    """
+    Load the data into a SQLite database through a dedicated bulk-load path.
+
+    The table is created with explicit column types and every row is written in one transaction
+    with executemany over a single prepared INSERT. For the duration of the load the database runs
+    in WAL mode with synchronous off and a larger page cache, and those pragmas are restored afterwards.
+    Secondary indexes are only built once all rows are in.
+
+    Parameters:
+    data (pd.DataFrame or Iterable[pd.DataFrame]): The data to be loaded, either as a single DataFrame
+                                                   or as a stream of batches which are written one at a time.
     db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
     table_name (str): The name of the table to load the data into. Defaults to 'main_table'.
+    indexes (Iterable[Iterable[str]]): The column lists to build secondary indexes on. Defaults to none.
+    cache_size_kib (int): The page cache size during the load, in KiB. Defaults to 256 MiB.
+    session (Session, optional): A session to write through instead of a new connection. The rows then join
+                                 the session's transaction and the larger page cache lasts until it ends.
+                                 Synchronous is only off for a Session opened with bulk_load=True, and the
+                                 session stays in WAL mode.
+
+    Returns:
+    int: The number of rows loaded.
 
     Raises:
     ValueError: If the data is empty.
     DatabaseError: If a database error occurs.
     """
+    if isinstance(data, pd.DataFrame):
+        if data.empty:
+            raise ValueError("Input data is empty")
+        data = [data]
+
+    try:
+        with _bulk_connection(db_path, cache_size_kib, session) as conn:
+            return _write_table(conn, data, table_name, indexes)
+    except sqlite3.Error as e:
+        raise DatabaseError(f"Database error: {e}")
+
+@contextmanager
+def _bulk_connection(db_path, cache_size_kib, session):
+    """
+    Yield a connection in bulk-load mode with a transaction open. A session's page cache is enlarged until the
+    session's transaction ends, as its writes are only flushed when it commits. Otherwise a new connection
+    is opened, its transaction is committed when the block exits normally, and its pragmas are then restored.
+    """
+    if session is not None:
+        session.set_pragmas(cache_size=-cache_size_kib)
+        yield session.conn
+        return
+
+    with _connection(db_path, None) as conn:
+        conn.isolation_level = None  # Transactions are managed explicitly below
+        pragmas = {pragma: conn.execute(f'PRAGMA {pragma}').fetchone()[0]
+                   for pragma in ('journal_mode', 'synchronous', 'cache_size')}
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute(f'PRAGMA cache_size = -{cache_size_kib}')
+        try:
+            conn.execute('BEGIN')
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.execute(f'PRAGMA journal_mode = {pragmas["journal_mode"]}')
+            conn.execute(f'PRAGMA synchronous = {pragmas["synchronous"]}')
+            conn.execute(f'PRAGMA cache_size = {pragmas["cache_size"]}')
+
+# The tables of the star schema, joined by its view
+_STAR_TABLES = ['users', 'widgets', 'locations']
+
+# Columns of the user records in the star schema, in the order of the transformed data
+_STAR_USER_COLUMNS = ['id', 'email', 'age_group', 'user_score', 'revenue', 'location', 'created_at', 'age_group_rank']
+
+# Rebuilds the transformed data from the star schema, with each widget_list rendered as json.dumps renders ASCII names
+_STAR_VIEW = """
+CREATE VIEW "{view_name}" AS
+SELECT u.id, u.email, u.age_group, u.user_score, u.revenue,
+       CASE WHEN w.user_key IS NULL THEN NULL
+            ELSE '{{"name": ' || json_quote(w.name) || ', "amount": ' || json_quote(w.amount) || '}}' END AS widget_list,
+       l.location, u.created_at, u.age_group_rank, w.name AS widget_name, w.amount AS widget_amount
+FROM users u
+LEFT JOIN widgets w ON w.user_key = u.user_key
+LEFT JOIN locations l ON l.location_key = u.location_key
+ORDER BY u.user_key, w.position
+"""
+
+def split_star_schema(data):
+    """
+    Split flattened transformed data into the tables of a star schema, with integer surrogate keys.
+
+    Each (id, created_at) record becomes one row of users, each of its widgets one row of widgets, and
+    each distinct location one row of locations. User attributes are then stored once per record rather
+    than once per widget, and widget_list is not stored at all, as it only repeats the widget's name and amount.
+
+    Parameters:
+    data (pd.DataFrame): The flattened transformed data, one row per widget.
+
+    Returns:
+    dict: The 'users', 'widgets' and 'locations' DataFrames.
+
+    Raises:
+    ValueError: If the data is empty or required columns are missing.
+    """
+    required_columns = _STAR_USER_COLUMNS + ['widget_list', 'widget_name', 'widget_amount']
+    missing = [column for column in required_columns if column not in data.columns]
+    if missing:
+        raise ValueError(f"Missing required columns: {', '.join(missing)}")
     if data.empty:
         raise ValueError("Input data is empty")
 
-    conn = connect(db_path)  # Create a database connection
+    groups = data.groupby(['id', 'created_at'], sort=False, dropna=False)
+    user_keys = groups.ngroup().to_numpy() + 1
+    positions = groups.cumcount().to_numpy()
+
+    location_codes, location_values = pd.factorize(data['location'].astype(object))
+    locations = pd.DataFrame({'location_key': np.arange(1, len(location_values) + 1), 'location': location_values})
+
+    first = positions == 0
+    users = data.loc[first, _STAR_USER_COLUMNS].reset_index(drop=True)
+    users.insert(0, 'user_key', user_keys[first])
+    # factorize gives missing locations the code -1
+    location_keys = location_codes[first] + 1
+    users['location'] = pd.Series(location_keys, dtype='Int64').where(location_keys > 0)
+    users = users.rename(columns={'location': 'location_key'})
+
+    # Rows without a widget only carry their user
+    has_widget = data['widget_list'].notna().to_numpy()
+    amounts = data['widget_amount'].to_numpy()[has_widget]
+    if amounts.dtype.kind == 'f' and len(amounts) and not np.isnan(amounts).any() and (amounts == np.round(amounts)).all():
+        # Integer amounts only turned to floats to fill the rows without a widget
+        amounts = amounts.astype(np.int64)
+    widgets = pd.DataFrame({
+        'user_key': user_keys[has_widget],
+        'position': positions[has_widget],
+        'name': data['widget_name'].to_numpy(dtype=object)[has_widget],
+        'amount': amounts,
+    })
+    return {'users': users, 'widgets': widgets, 'locations': locations}
+
+def drop_star_schema(db_path=DB_PATH, session=None):
+    """
+    Drop the users, widgets and locations tables of load_star_schema, so a wide load replacing its view
+    leaves no copy of the data behind.
+
+    Raises:
+    DatabaseError: If a database error occurs.
+    """
+    with _connection(db_path, session) as conn:
+        try:
+            for table_name in _STAR_TABLES:
+                _drop(conn, table_name)
+            if session is None:
+                conn.commit()
+        except sqlite3.Error as e:
+            raise DatabaseError(f"Database error: {e}")
+
+def load_star_schema(data, db_path=DB_PATH, view_name='transformed_data', indexes=STAR_SCHEMA_INDEXES,
+                     cache_size_kib=262144, session=None):
+    """
+    Load flattened transformed data as a star schema of users, widgets and locations tables, through the
+    bulk-load path of bulk_load, and replace view_name with a view rebuilding the flattened rows from them.
+
+    Parameters:
+    data (pd.DataFrame): The flattened transformed data, one row per widget.
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    view_name (str): The name of the view with the shape of the flattened data. Defaults to 'transformed_data'.
+    indexes (dict): The column lists to build secondary indexes on, per table. Defaults to STAR_SCHEMA_INDEXES.
+    cache_size_kib (int): The page cache size during the load, in KiB. Defaults to 256 MiB.
+    session (Session, optional): A session to write through instead of a new connection.
+
+    Returns:
+    int: The number of rows of the view.
+
+    Raises:
+    ValueError: If the data is empty or required columns are missing.
+    DatabaseError: If a database error occurs.
+    """
+    tables = split_star_schema(data)
+    primary_keys = {'users': 'user_key', 'locations': 'location_key'}
     try:
-        data.to_sql(table_name, conn, if_exists='replace', index=False)
+        with _bulk_connection(db_path, cache_size_kib, session) as conn:
+            _drop(conn, view_name)
+            for table_name, table in tables.items():
+                if table.empty:
+                    _create_table(conn, table_name, table.dtypes, primary_keys.get(table_name))
+                else:
+                    _write_table(conn, [table], table_name, indexes.get(table_name, ()), primary_keys.get(table_name))
+            conn.execute(_STAR_VIEW.format(view_name=view_name))
     except sqlite3.Error as e:
         raise DatabaseError(f"Database error: {e}")
-    finally:
-        conn.close()  # Close the database connection
+    return len(data)
 
 def create_inverted_index(data):
     """
@@ -75,27 +850,468 @@ def create_inverted_index(data):
         raise ValueError("Input data is empty")
 
     try:
-        inverted_index = data.groupby('location')['id'].apply(lambda x: ','.join(map(str, x))).reset_index()
+        inverted_index = data.groupby('location', observed=True)['id'].apply(lambda x: ','.join(map(str, x))).reset_index()
         return inverted_index
     except Exception as e:
         raise IndexCreationError(f"Error during index creation: {e}")
 
-def store_inverted_index(inverted_index, db_path=DB_PATH, table_name='inverted_index'):
+def create_posting_lists(data, field='location'):
     """
-    Store the inverted index in a SQLite database.
+    Create a normalized inverted index of deduplicated, sorted posting lists.
+
+    Unlike create_inverted_index, each (value, user) pair appears once however many widget rows
+    the user has, and no ids are joined into strings.
 
     Parameters:
-    inverted_index (pd.DataFrame): The inverted index as a DataFrame.
+    data (pd.DataFrame): The data to create the posting lists from.
+    field (str): The column to index. Defaults to 'location'.
+
+    Returns:
+    pd.DataFrame: One row per (field value, user_id) pair, sorted by value and then user_id.
+
+    Raises:
+    ValueError: If the data is empty or required columns are missing.
+    IndexCreationError: If an error occurs during index creation.
+    """
+    required_columns = [field, 'id']
+    if not all(col in data.columns for col in required_columns):
+        raise ValueError(f"Missing required columns: {', '.join(required_columns)}")
+    if data.empty:
+        raise ValueError("Input data is empty")
+
+    try:
+        postings = data[[field, 'id']].dropna().drop_duplicates().rename(columns={'id': 'user_id'})
+        postings['user_id'] = postings['user_id'].astype(str)
+        return postings.sort_values([field, 'user_id'], ignore_index=True)
+    except Exception as e:
+        raise IndexCreationError(f"Error during index creation: {e}")
+
+def store_posting_lists(postings, db_path=DB_PATH, table_name=None, session=None):
+    """
+    Store posting lists in a SQLite table keyed on (value, user_id).
+
+    The table is a WITHOUT ROWID table whose primary key covers both columns, so a lookup
+    is a single range scan of the key with no separate table access. A secondary index on
+    user_id lets update_posting_lists find the postings of changed users.
+
+    Parameters:
+    postings (pd.DataFrame): The posting lists from create_posting_lists.
     db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
-    table_name (str): The name of the table to store the inverted index. Defaults to 'inverted_index'.
+    table_name (str, optional): The name of the table to store the posting lists in. Defaults to '<field>_postings',
+                                e.g. 'location_postings'.
+    session (Session, optional): A session to write through instead of a new connection.
 
     Raises:
     IndexStorageError: If a database error occurs during index storage.
     """
-    conn = connect(db_path)  # Create a database connection
+    field = postings.columns[0]
+    table_name = table_name or f'{field}_postings'
+    with _connection(db_path, session) as conn:
+        try:
+            conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            conn.execute(f'CREATE TABLE "{table_name}" ("{field}" TEXT NOT NULL, user_id TEXT NOT NULL, '
+                         f'PRIMARY KEY ("{field}", user_id)) WITHOUT ROWID')
+            conn.executemany(f'INSERT INTO "{table_name}" VALUES (?, ?)', zip(*_sql_columns(postings[[field, 'user_id']])))
+            conn.execute(f'CREATE INDEX "idx_{table_name}_user_id" ON "{table_name}" (user_id)')
+            if session is None:
+                conn.commit()
+        except sqlite3.Error as e:
+            raise IndexStorageError(f"Error during index storage: {e}")
+
+def update_posting_lists(data, db_path=DB_PATH, field='location', table_name=None, deleted_ids=(), session=None):
+    """
+    Apply a delta of inserted, changed and deleted users to a posting list table.
+
+    Only the postings of the users in the delta are read and written, so the cost follows the
+    size of the delta rather than of the table.
+
+    Parameters:
+    data (pd.DataFrame): Every current row of the inserted and changed users, e.g. all their widgets.
+                         Users missing from it keep their postings.
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    field (str): The indexed column. Defaults to 'location'.
+    table_name (str, optional): The posting list table. Defaults to '<field>_postings'.
+    deleted_ids (Iterable[str]): The ids of users to remove from the posting lists.
+    session (Session, optional): A session to write through instead of a new connection.
+
+    Returns:
+    set: The values whose posting lists changed.
+
+    Raises:
+    ValueError: If required columns are missing.
+    IndexStorageError: If a database error occurs during index storage.
+    """
+    table_name = table_name or f'{field}_postings'
+    postings = create_posting_lists(data, field) if len(data) else pd.DataFrame(columns=[field, 'user_id'])
+    new_postings = set(zip(*_sql_columns(postings[[field, 'user_id']])))
+    user_ids = list(dict.fromkeys(postings['user_id'].tolist() + [str(user_id) for user_id in deleted_ids]))
+
+    with _connection(db_path, session) as conn:
+        try:
+            old_postings = set()
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                old_postings.update(conn.execute(
+                    f'SELECT "{field}", user_id FROM "{table_name}" WHERE user_id IN ({", ".join("?" for _ in chunk)})', chunk
+                ))
+            removed = old_postings - new_postings
+            added = new_postings - old_postings
+            conn.executemany(f'DELETE FROM "{table_name}" WHERE "{field}" = ? AND user_id = ?', removed)
+            conn.executemany(f'INSERT INTO "{table_name}" VALUES (?, ?)', added)
+            if session is None:
+                conn.commit()
+        except sqlite3.Error as e:
+            raise IndexStorageError(f"Error during index storage: {e}")
+    return {value for value, _ in removed | added}
+
+# Runs of characters that separate the words of a searched value
+_SEARCH_SEPARATORS = re.compile(r'[\W_]+')
+
+# The ways search matches a query against the terms of a value
+SEARCH_MATCHES = ('prefix', 'term')
+
+def _search_terms(value):
+    """Return the search terms of a value: the lowercased value and its every tail starting at a word."""
+    value = value.lower()
+    terms = {value}
+    for separator in _SEARCH_SEPARATORS.finditer(value):
+        if separator.end() < len(value):
+            terms.add(value[separator.end():])
+    return sorted(terms)
+
+def create_search_terms(data, field):
+    """
+    Create the search terms of each user's values of a field, for a search index over it.
+
+    The terms of a value are the lowercased value and every tail of it that starts at a word, e.g.
+    'jo.doe@mail.com', 'doe@mail.com', 'mail.com' and 'com' for an email. A query is then matched
+    against the start of any word of a value, or against its domain, with one range scan of the terms.
+
+    Parameters:
+    data (pd.DataFrame): The data to create the terms from.
+    field (str): The column to index, e.g. 'email' or 'widget_name'.
+
+    Returns:
+    pd.DataFrame: One row per (term, id) pair, in the shape create_posting_lists takes with field='term'.
+
+    Raises:
+    ValueError: If required columns are missing.
+    """
+    required_columns = [field, 'id']
+    if not all(col in data.columns for col in required_columns):
+        raise ValueError(f"Missing required columns: {', '.join(required_columns)}")
+
+    pairs = data[[field, 'id']].dropna().drop_duplicates()
+    values = pairs[field].astype(str).to_numpy()
+    # Distinct values are far fewer than rows, e.g. widget names, so each is split once
+    terms = {value: _search_terms(value) for value in pd.unique(values)}
+    return pd.DataFrame({'term': [terms[value] for value in values], 'id': pairs['id'].to_numpy()}).explode('term')
+
+def store_search_index(data, fields=SEARCH_FIELDS, db_path=DB_PATH, session=None):
+    """
+    Store a search index over each of the given fields, as posting lists of search terms.
+
+    Each field gets a '<field>_search' table keyed on (term, user_id), see store_posting_lists, so
+    a prefix query reads one contiguous range of the key instead of scanning transformed_data.
+
+    Parameters:
+    data (pd.DataFrame): The data to index.
+    fields (Iterable[str]): The columns to index. Defaults to SEARCH_FIELDS from constants module.
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    session (Session, optional): A session to write through instead of a new connection.
+
+    Returns:
+    dict: The number of (term, user) postings stored in each search table.
+
+    Raises:
+    ValueError: If the data is empty or required columns are missing.
+    IndexCreationError: If an error occurs during index creation.
+    IndexStorageError: If a database error occurs during index storage.
+    """
+    row_counts = {}
+    for field in fields:
+        postings = create_posting_lists(create_search_terms(data, field), field='term')
+        store_posting_lists(postings, db_path, table_name=f'{field}_search', session=session)
+        row_counts[f'{field}_search'] = len(postings)
+    return row_counts
+
+def update_search_index(data, fields=SEARCH_FIELDS, db_path=DB_PATH, deleted_ids=(), session=None):
+    """
+    Apply a delta of inserted, changed and deleted users to the search index, see update_posting_lists.
+
+    Parameters:
+    data (pd.DataFrame): Every current row of the inserted and changed users.
+    fields (Iterable[str]): The indexed columns. Defaults to SEARCH_FIELDS from constants module.
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    deleted_ids (Iterable[str]): The ids of users to remove from the search index.
+    session (Session, optional): A session to write through instead of a new connection.
+
+    Raises:
+    ValueError: If required columns are missing.
+    IndexStorageError: If a database error occurs during index storage.
+    """
+    for field in fields:
+        update_posting_lists(create_search_terms(data, field), db_path, field='term', table_name=f'{field}_search',
+                             deleted_ids=deleted_ids, session=session)
+
+def drop_search_index(fields=SEARCH_FIELDS, db_path=DB_PATH, session=None):
+    """
+    Drop the search tables of the given fields, so a run without a search index leaves none out of date.
+
+    Raises:
+    IndexStorageError: If a database error occurs.
+    """
+    with _connection(db_path, session) as conn:
+        try:
+            for field in fields:
+                _drop(conn, f'{field}_search')
+            if session is None:
+                conn.commit()
+        except sqlite3.Error as e:
+            raise IndexStorageError(f"Error during index storage: {e}")
+
+def search(query, field='email', match='prefix', db_path=DB_PATH, table_name=None, pool=None):
+    """
+    Look up the ids of the users whose values of a field match a query in the search index.
+
+    Matching ignores case. With match='prefix', a value matches if any of its words starts with the query,
+    e.g. 'oryx' matches the widget names 'Oryx gazella' and 'Beisa oryx', and 'doe@' matches 'jo.doe@mail.com'.
+    With match='term', the value itself or its tail from a word on must equal the query, e.g. 'mail.com'
+    matches every email at mail.com and its subdomains. Either way the terms are read with one range scan
+    of the table's key, so the work follows the number of matches rather than the size of the table.
+
+    Parameters:
+    query (str): The text to search for.
+    field (str): The indexed column. Defaults to 'email'.
+    match (str): 'prefix' or 'term'. Defaults to 'prefix'.
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    table_name (str, optional): The search table. Defaults to '<field>_search'.
+    pool (ReaderPool, optional): A reader pool to query through instead of a new connection.
+
+    Returns:
+    list: The sorted ids of the matching users.
+
+    Raises:
+    ValueError: If the query is empty or the match is unknown.
+    DatabaseError: If a database error occurs, e.g. the field has no search index.
+    """
+    if match not in SEARCH_MATCHES:
+        raise ValueError(f"Unknown match '{match}', expected one of {', '.join(SEARCH_MATCHES)}")
+    query = query.lower()
+    if not query:
+        raise ValueError("The search query is empty")
+    table_name = table_name or f'{field}_search'
+    if match == 'prefix':
+        # Every term starting with the query sorts between it and the query with its last character incremented
+        sql = f'SELECT DISTINCT user_id FROM "{table_name}" WHERE term >= ? AND term < ? ORDER BY user_id'
+        params = (query, query[:-1] + chr(ord(query[-1]) + 1))
+    else:
+        sql = f'SELECT user_id FROM "{table_name}" WHERE term = ? ORDER BY user_id'
+        params = (query,)
+
     try:
-        inverted_index.to_sql(table_name, conn, if_exists='replace', index=False)
+        if pool is not None:
+            return [user_id for user_id, in pool.query(sql, params)]
+        conn = connect(db_path, read_only=True)
+        try:
+            return [user_id for user_id, in conn.execute(sql, params)]
+        finally:
+            conn.close()
     except sqlite3.Error as e:
-        raise IndexStorageError(f"Error during index storage: {e}")
-    finally:
-        conn.close()  # Close the database connection
\ No newline at end of file
+        raise DatabaseError(f"Database error: {e}")
+
+def lookup(value, field='location', db_path=DB_PATH, table_name=None, pool=None):
+    """
+    Look up the ids of the users with a given value in a posting list table.
+
+    Parameters:
+    value (str): The value to look up, e.g. a location.
+    field (str): The indexed column. Defaults to 'location'.
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    table_name (str, optional): The posting list table. Defaults to '<field>_postings'.
+    pool (ReaderPool, optional): A reader pool to query through instead of a new connection.
+
+    Returns:
+    list: The sorted user ids, empty if the value is not indexed.
+
+    Raises:
+    DatabaseError: If a database error occurs.
+    """
+    return lookup_many([value], field, db_path, table_name, pool)[value]
+
+def lookup_many(values, field='location', db_path=DB_PATH, table_name=None, pool=None):
+    """
+    Look up the ids of the users with each of several values in a posting list table.
+
+    Parameters:
+    values (Iterable[str]): The values to look up, e.g. locations.
+    field (str): The indexed column. Defaults to 'location'.
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    table_name (str, optional): The posting list table. Defaults to '<field>_postings'.
+    pool (ReaderPool, optional): A reader pool to query through instead of a new connection.
+
+    Returns:
+    dict: A mapping of each value to its sorted user ids, empty for values that are not indexed.
+
+    Raises:
+    DatabaseError: If a database error occurs.
+    """
+    table_name = table_name or f'{field}_postings'
+    values = list(dict.fromkeys(values))
+    results = {value: [] for value in values}
+
+    def run_queries(conn):
+        # Stay below SQLite's limit on the number of parameters per statement
+        for start in range(0, len(values), 500):
+            chunk = values[start:start + 500]
+            rows = conn.execute(
+                f'SELECT "{field}", user_id FROM "{table_name}" WHERE "{field}" IN ({", ".join("?" for _ in chunk)}) '
+                f'ORDER BY "{field}", user_id', chunk
+            )
+            for value, user_id in rows:
+                results[value].append(user_id)
+
+    try:
+        if pool is not None:
+            with pool.connection() as conn:
+                run_queries(conn)
+        else:
+            conn = connect(db_path, read_only=True)
+            try:
+                run_queries(conn)
+            finally:
+                conn.close()
+    except sqlite3.Error as e:
+        raise DatabaseError(f"Database error: {e}")
+    return results
+
+def update_inverted_index(data, locations, db_path=DB_PATH, table_name='inverted_index', session=None):
+    """
+    Rebuild the rows of the given locations in a stored inverted index, leaving the other rows as they are.
+
+    Parameters:
+    data (pd.DataFrame): The data to create the inverted index from, e.g. only the rows of the given locations.
+                         Rows of other locations are ignored.
+    locations (Iterable[str]): The locations whose id lists changed, e.g. as returned by update_posting_lists.
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    table_name (str): The name of the table storing the inverted index. Defaults to 'inverted_index'.
+    session (Session, optional): A session to write through instead of a new connection.
+
+    Raises:
+    IndexCreationError: If an error occurs during index creation.
+    IndexStorageError: If a database error occurs during index storage.
+    """
+    locations = list(locations)
+    affected = data[data['location'].isin(locations)]
+    rows = create_inverted_index(affected).itertuples(index=False, name=None) if len(affected) else []
+
+    with _connection(db_path, session) as conn:
+        try:
+            conn.executemany(f'DELETE FROM "{table_name}" WHERE location = ?', ((location,) for location in locations))
+            conn.executemany(f'INSERT INTO "{table_name}" (location, id) VALUES (?, ?)', rows)
+            if session is None:
+                conn.commit()
+        except sqlite3.Error as e:
+            raise IndexStorageError(f"Error during index storage: {e}")
+
+def store_inverted_index(inverted_index, db_path=DB_PATH, table_name='inverted_index', session=None):
+    """
+    Store the inverted index in a SQLite database.
+
+    Parameters:
+    inverted_index (pd.DataFrame): The inverted index as a DataFrame.
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    table_name (str): The name of the table to store the inverted index. Defaults to 'inverted_index'.
+    session (Session, optional): A session to write through instead of a new connection.
+
+    Raises:
+    IndexStorageError: If the inverted index is empty or a database error occurs during index storage.
+    """
+    # Checked up front, as the session path would otherwise fail with the ValueError of _write_table
+    if inverted_index.empty:
+        raise IndexStorageError("Error during index storage: the inverted index is empty")
+
+    with _connection(db_path, session) as conn:
+        try:
+            if session is not None:
+                _write_table(conn, [inverted_index], table_name)
+            else:
+                inverted_index.to_sql(table_name, conn, if_exists='replace', index=False)
+        except sqlite3.Error as e:
+            raise IndexStorageError(f"Error during index storage: {e}")
+
+def _has_rankings_table(conn, table_name):
+    """Return whether a rankings table exists keyed on records, rather than on user ids alone as before."""
+    return 'created_at' in [row[1] for row in conn.execute(f'PRAGMA table_info("{table_name}")')]
+
+def store_rankings(rankings, db_path=DB_PATH, table_name='age_group_rankings', replace=False, session=None):
+    """
+    Persist age group rankings to a SQLite table keyed on (id, created_at), one row per record.
+
+    The first time, if the table is missing or keyed on user ids alone, or if replace is set, every
+    record is written. Otherwise only the records changed since the last store are upserted or deleted.
+
+    Parameters:
+    rankings (AgeGroupRankings or pd.DataFrame): The rankings to store, or the 'id', 'created_at', 'age_group'
+                                                 and 'user_score' of every record, one row each, which
+                                                 replace the table as they are.
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    table_name (str): The name of the table. Defaults to 'age_group_rankings'.
+    replace (bool): Rewrite the table from scratch. Defaults to False.
+    session (Session, optional): A session to write through instead of a new connection.
+
+    Returns:
+    int: The number of records written or deleted.
+
+    Raises:
+    DatabaseError: If a database error occurs.
+    """
+    with _connection(db_path, session) as conn:
+        try:
+            if isinstance(rankings, pd.DataFrame):
+                upserted, deleted, replace = rankings[['id', 'created_at', 'age_group', 'user_score']], [], True
+            else:
+                upserted, deleted = rankings.pop_changes()
+            if replace or not _has_rankings_table(conn, table_name):
+                conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+                conn.execute(f'CREATE TABLE "{table_name}" (id TEXT NOT NULL, created_at TEXT NOT NULL, '
+                             f'age_group INTEGER NOT NULL, user_score REAL NOT NULL, PRIMARY KEY (id, created_at)) WITHOUT ROWID')
+                conn.execute(f'CREATE INDEX "idx_{table_name}_age_group_user_score" ON "{table_name}" (age_group, user_score)')
+                if not isinstance(rankings, pd.DataFrame):
+                    upserted, deleted = rankings.to_frame(), []
+            conn.executemany(f'INSERT OR REPLACE INTO "{table_name}" (id, created_at, age_group, user_score) VALUES (?, ?, ?, ?)',
+                             _sql_rows(upserted))
+            conn.executemany(f'DELETE FROM "{table_name}" WHERE id = ? AND created_at = ?',
+                             _sql_rows(pd.DataFrame(deleted, columns=['id', 'created_at'])))
+            if session is None:
+                conn.commit()
+            return len(upserted) + len(deleted)
+        except sqlite3.Error as e:
+            raise DatabaseError(f"Database error: {e}")
+
+def load_rankings(db_path=DB_PATH, table_name='age_group_rankings', session=None):
+    """
+    Load age group rankings stored by store_rankings.
+
+    Parameters:
+    db_path (str): The path to the SQLite database. Defaults to DB_PATH from constants module.
+    table_name (str): The name of the table. Defaults to 'age_group_rankings'.
+    session (Session, optional): A session to read through instead of a new connection.
+
+    Returns:
+    AgeGroupRankings: The rankings, empty if none were stored yet, or only keyed on user ids, which must be rebuilt.
+
+    Raises:
+    DatabaseError: If a database error occurs.
+    """
+    with _connection(db_path, session) as conn:
+        try:
+            if not _has_rankings_table(conn, table_name):
+                return AgeGroupRankings()
+            data = pd.read_sql(f'SELECT id, created_at, age_group, user_score FROM "{table_name}" '
+                               f'ORDER BY age_group, user_score', conn)
+        except (sqlite3.Error, pd.errors.DatabaseError) as e:
+            raise DatabaseError(f"Database error: {e}")
+    rankings = AgeGroupRankings.from_data(data)
+    rankings.pop_changes()
+    return rankings
@@ -0,0 +1,219 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from constants import FINGERPRINT_PATH, DEDUP_CAPACITY
+
+_LOW_BITS = np.uint64(0xFFFFFFFF)
+
+
+def hash_keys(data):
+    """
+    Hash the (id, created_at) key of every row to 64 bits.
+
+    The hash is deterministic across runs and processes, so it can be persisted.
+
+    Parameters:
+    data (pd.DataFrame): The data, with 'id' and 'created_at' columns.
+
+    Returns:
+    np.ndarray: The uint64 hash of each row's key.
+    """
+    keys = pd.DataFrame({'id': data['id'].astype(str), 'created_at': pd.to_datetime(data['created_at'], utc=True)})
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+
+class FingerprintStore:
+    """
+    A compact, optionally persistent set of the (id, created_at) keys seen so far, for deduplication
+    across batches and runs.
+
+    Each key is kept as a fingerprint of the top bucket_bits + 32 bits of its 64-bit hash. Fingerprints
+    are stored sorted, as a directory of bucket offsets over their top bucket_bits bits and a uint32
+    array of the remaining 32 bits, so each key costs a little over 4 bytes. bucket_bits is picked from
+    the expected capacity so buckets hold about 8 keys, which keeps the chance of a new key matching a
+    stored fingerprint near 8 / 2**32 up to that capacity.
+
+    Recently added fingerprints are held in a small sorted array and folded into the directory once it
+    reaches a quarter of the store. An optional Bloom filter in front answers most lookups of new keys
+    without searching the store.
+    """
+
+    def __init__(self, capacity=DEDUP_CAPACITY, bloom_bits_per_key=None, path=None):
+        """
+        Parameters:
+        capacity (int): The number of keys the store is sized for. It can hold more, with a higher chance
+                        of false matches. Defaults to DEDUP_CAPACITY from constants module.
+        bloom_bits_per_key (int, optional): Bits of Bloom filter per key of capacity. No filter by default.
+        path (str, optional): Where save writes the store to.
+        """
+        self.path = path
+        self.bucket_bits = int(min(max(np.ceil(np.log2(max(capacity, 1))) - 3, 0), 32))
+        self._offsets = np.zeros((1 << self.bucket_bits) + 1, dtype=np.uint32)
+        self._remainders = np.empty(0, dtype=np.uint32)
+        self._max_bucket = 0
+        self._pending = np.empty(0, dtype=np.uint64)
+
+        if bloom_bits_per_key:
+            bloom_size = max(int(capacity * bloom_bits_per_key) // 8, 8)
+            self._bloom = np.zeros(bloom_size, dtype=np.uint8)
+            self._bloom_hashes = max(int(round(bloom_bits_per_key * np.log(2))), 1)
+        else:
+            self._bloom = None
+            self._bloom_hashes = 0
+
+        self.stats = {'batches': 0, 'rows': 0, 'new_rows': 0, 'seconds': 0.0}
+
+    @classmethod
+    def open(cls, path=FINGERPRINT_PATH, capacity=DEDUP_CAPACITY, bloom_bits_per_key=None):
+        """
+        Load the store saved at a path, or create an empty one that will be saved there.
+
+        Parameters:
+        path (str): The path of the store. Defaults to FINGERPRINT_PATH from constants module.
+        capacity (int): The capacity of a new store. Defaults to DEDUP_CAPACITY from constants module.
+        bloom_bits_per_key (int, optional): The Bloom filter size of a new store. No filter by default.
+
+        Returns:
+        FingerprintStore: The store.
+        """
+        if not os.path.exists(path):
+            return cls(capacity, bloom_bits_per_key, path)
+
+        store = cls(capacity=1, path=path)
+        with np.load(path) as arrays:
+            store.bucket_bits, store._bloom_hashes = (int(value) for value in arrays['meta'])
+            store._offsets = arrays['offsets']
+            store._remainders = arrays['remainders']
+            store._bloom = arrays['bloom'] if store._bloom_hashes else None
+        store._max_bucket = int(np.diff(store._offsets).max(initial=0))
+        return store
+
+    def __len__(self):
+        return len(self._remainders) + len(self._pending)
+
+    @property
+    def nbytes(self):
+        """The memory held by the store's arrays, in bytes."""
+        bloom_bytes = self._bloom.nbytes if self._bloom is not None else 0
+        return self._offsets.nbytes + self._remainders.nbytes + self._pending.nbytes + bloom_bytes
+
+    @property
+    def throughput(self):
+        """The rows per second checked by update so far."""
+        return self.stats['rows'] / self.stats['seconds'] if self.stats['seconds'] else 0.0
+
+    def _fingerprints(self, hashes):
+        return hashes >> np.uint64(32 - self.bucket_bits)
+
+    def _bloom_positions(self, hashes):
+        """Return the Bloom filter bit positions of each hash, one column per hash function."""
+        high, low = hashes >> np.uint64(32), (hashes & _LOW_BITS) | np.uint64(1)
+        steps = np.arange(self._bloom_hashes, dtype=np.uint64)
+        return (high[:, None] + steps * low[:, None]) % np.uint64(len(self._bloom) * 8)
+
+    def contains(self, hashes):
+        """
+        Check which key hashes are in the store.
+
+        Parameters:
+        hashes (np.ndarray): uint64 key hashes, as returned by hash_keys.
+
+        Returns:
+        np.ndarray: A boolean mask, True where the key is in the store.
+        """
+        found = np.zeros(len(hashes), dtype=bool)
+        candidates = np.arange(len(hashes))
+        if self._bloom is not None and len(hashes):
+            positions = self._bloom_positions(hashes)
+            bits = (self._bloom[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+            candidates = np.flatnonzero(bits.all(axis=1))
+        if len(candidates) == 0:
+            return found
+
+        fingerprints = self._fingerprints(hashes[candidates])
+        if len(self._pending):
+            positions = np.minimum(np.searchsorted(self._pending, fingerprints), len(self._pending) - 1)
+            found[candidates] = self._pending[positions] == fingerprints
+
+        # Probe the candidates' buckets one slot at a time, buckets being a handful of keys long
+        buckets = (fingerprints >> np.uint64(32)).astype(np.int64)
+        remainders = (fingerprints & _LOW_BITS).astype(np.uint32)
+        starts, ends = self._offsets[buckets].astype(np.int64), self._offsets[buckets + 1].astype(np.int64)
+        for step in range(self._max_bucket):
+            active = np.flatnonzero(starts + step < ends)
+            if len(active) == 0:
+                break
+            found[candidates[active]] |= self._remainders[starts[active] + step] == remainders[active]
+        return found
+
+    def add(self, hashes):
+        """
+        Add key hashes to the store.
+
+        Parameters:
+        hashes (np.ndarray): uint64 key hashes, as returned by hash_keys.
+        """
+        if self._bloom is not None and len(hashes):
+            positions = self._bloom_positions(hashes).ravel()
+            np.bitwise_or.at(self._bloom, positions >> np.uint64(3),
+                             np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+        self._pending = _merge(self._pending, np.unique(self._fingerprints(hashes)))
+        if len(self._pending) * 4 >= len(self._remainders):
+            self._fold()
+
+    def _fold(self):
+        """Merge the pending fingerprints into the bucket directory."""
+        bucket_sizes = np.diff(self._offsets)
+        stored = (np.repeat(np.arange(len(bucket_sizes), dtype=np.uint64), bucket_sizes) << np.uint64(32)) \
+                 | self._remainders.astype(np.uint64)
+        merged = _merge(stored, self._pending)
+        self._offsets = np.searchsorted(merged >> np.uint64(32), np.arange(len(self._offsets), dtype=np.uint64))\
+                          .astype(np.uint32)
+        self._remainders = (merged & _LOW_BITS).astype(np.uint32)
+        self._max_bucket = int(np.diff(self._offsets).max(initial=0))
+        self._pending = np.empty(0, dtype=np.uint64)
+
+    def update(self, data):
+        """
+        Find the rows of a batch whose keys are not in the store yet, and add them.
+
+        Parameters:
+        data (pd.DataFrame): The batch, with 'id' and 'created_at' columns and no repeated keys.
+
+        Returns:
+        np.ndarray: A boolean mask, True for the rows whose keys were new.
+        """
+        start = time.perf_counter()
+        hashes = hash_keys(data)
+        new = ~self.contains(hashes)
+        self.add(hashes[new])
+
+        self.stats['batches'] += 1
+        self.stats['rows'] += len(data)
+        self.stats['new_rows'] += int(new.sum())
+        self.stats['seconds'] += time.perf_counter() - start
+        return new
+
+    def save(self, path=None):
+        """
+        Save the store as an uncompressed .npz file.
+
+        Parameters:
+        path (str, optional): The path to save to. Defaults to the path the store was opened from.
+        """
+        self._fold()
+        bloom = self._bloom if self._bloom is not None else np.empty(0, dtype=np.uint8)
+        with open(path or self.path, 'wb') as file:
+            np.savez(file, meta=np.array([self.bucket_bits, self._bloom_hashes]), offsets=self._offsets,
+                     remainders=self._remainders, bloom=bloom)
+
+
+def _merge(stored, new):
+    """Merge sorted unique fingerprints into a sorted unique array, in linear time when new is small."""
+    if len(stored) == 0:
+        return new
+    positions = np.searchsorted(stored, new)
+    duplicate = stored[np.minimum(positions, len(stored) - 1)] == new
+    return np.insert(stored, positions[~duplicate], new[~duplicate])
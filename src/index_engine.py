@@ -0,0 +1,490 @@
+import os
+import re
+import uuid
+import struct
+import zipfile
+import numpy as np
+import pandas as pd
+
+from constants import INDEX_PATH, INDEX_FIELDS, INDEX_COMPACT_FRACTION
+
+
+class IndexQueryError(Exception):
+    """An exception class for malformed index queries or unknown fields."""
+
+
+def email_domain(email):
+    """Return the lower-cased domain of each email address."""
+    codes, uniques = pd.factorize(email)
+    domains = np.array([address.rpartition('@')[2].lower() for address in uniques] + [None], dtype=object)
+    return pd.Series(domains[codes], index=email.index)
+
+
+def created_month(created_at):
+    """Return the 'YYYY-MM' month of each UTC timestamp."""
+    # Timestamps read back from a CSV snapshot are strings, so parse them first
+    created_at = pd.to_datetime(created_at, utc=True)
+    months = np.datetime_as_string(created_at.dt.tz_localize(None).to_numpy().astype('datetime64[M]'))
+    return pd.Series(months, index=created_at.index).where(created_at.notna())
+
+
+# Fields derived from other columns rather than read directly: name -> (source column, function)
+DERIVED_FIELDS = {
+    'email_domain': ('email', email_domain),
+    'created_month': ('created_at', created_month),
+}
+
+# A query token: a parenthesis, an operator, or a field=value term whose value may be quoted
+_TOKEN = re.compile(r"""\s*(?:(?P<paren>[()])|(?P<op>AND|OR|NOT)(?=[\s(]|$)|"""
+                    r"""(?P<field>\w+)\s*=\s*(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<bare>[^\s()]+)))""")
+
+
+def index_columns(data, fields=INDEX_FIELDS):
+    """
+    Select the id and every indexed field of the data, one row per distinct combination.
+
+    Derived fields such as email_domain are computed here. Running this on each batch of a
+    streamed run and concatenating the results gives the input of MultiFieldIndex.build
+    without holding the full transformed data.
+
+    Parameters:
+    data (pd.DataFrame): The transformed data.
+    fields (list): The fields to index. Defaults to INDEX_FIELDS from constants module.
+
+    Returns:
+    pd.DataFrame: The id column and one column per field.
+
+    Raises:
+    ValueError: If a field, or the column it is derived from, is missing from the data.
+    """
+    if 'id' not in data.columns:
+        raise ValueError("Missing required columns: id")
+    columns = {'id': data['id']}
+
+    for field in fields:
+        # A derived field that is already a column, e.g. when rebuilding from index_columns output, is kept
+        source, derive = DERIVED_FIELDS.get(field, (field, None)) if field not in data.columns else (field, None)
+        if source not in data.columns:
+            raise ValueError(f"Missing required columns: {source}")
+        columns[field] = derive(data[source]) if derive else data[source]
+
+    return pd.DataFrame(columns).drop_duplicates(ignore_index=True)
+
+
+class MultiFieldIndex:
+    """
+    An in-memory inverted index over several fields of the user data, answering boolean queries.
+
+    User ids are dictionary-encoded to integers. For each field, the postings of every value are
+    sorted integer arrays stored back to back in one array, with an offsets array marking where
+    each value's postings start (a CSR layout), so a lookup is a dictionary probe and a slice.
+
+    Changes are applied with apply_delta on top of these arrays without rebuilding them: the codes
+    of changed users are masked out of the arrays and their current postings are kept separately,
+    until compact folds everything back into the arrays. Saved, the arrays and these delta segments
+    go to separate files, so saving a small delta neither compacts nor rewrites the arrays.
+    """
+
+    def __init__(self, ids, fields, base_id=None, base_path=None):
+        """
+        Parameters:
+        ids (np.ndarray): The user id of each integer code, sorted.
+        fields (dict): Field name -> (values, offsets, codes) arrays, as built by build.
+        base_id (str, optional): The identifier of the saved file holding these arrays, if any.
+        base_path (str, optional): The path of that file.
+        """
+        self.ids = ids
+        self.fields = fields
+        self._base_id = base_id
+        self._base_path = base_path
+        self._positions = {field: {value: position for position, value in enumerate(values)}
+                           for field, (values, _, _) in fields.items()}
+        self._reset_delta()
+
+    def _reset_delta(self):
+        """Clear the changes applied since the arrays were built or compacted."""
+        self._new_ids = []
+        self._new_codes = {}
+        self._stale = np.empty(0, dtype=np.int32)
+        self._deleted = np.empty(0, dtype=np.int32)
+        self._added = {field: {} for field in self.fields}
+
+    @classmethod
+    def build(cls, data, fields=INDEX_FIELDS):
+        """
+        Build the index from the transformed data, or from the output of index_columns.
+
+        Parameters:
+        data (pd.DataFrame): The data to index.
+        fields (list): The fields to index. Defaults to INDEX_FIELDS from constants module.
+
+        Returns:
+        MultiFieldIndex: The index.
+
+        Raises:
+        ValueError: If the data is empty or a field is missing from it.
+        """
+        if data.empty:
+            raise ValueError("Input data is empty")
+        data = index_columns(data, fields)
+
+        codes, ids = pd.factorize(data['id'].astype(str), sort=True)
+        index_fields = {}
+        for field in fields:
+            value_codes, values = pd.factorize(data[field], sort=True)
+            present = value_codes >= 0
+            offsets, user_codes = _csr(value_codes[present], codes[present], len(values), len(ids))
+            # Key every value by its text, so that queries like age_group=2 match integer columns
+            values = np.array([str(value) for value in values], dtype=str)
+            index_fields[field] = (values, offsets, user_codes)
+
+        return cls(ids.to_numpy(dtype=str), index_fields)
+
+    def apply_delta(self, data, deleted_ids=()):
+        """
+        Update the index for inserted, changed and deleted users, touching only their postings.
+
+        Parameters:
+        data (pd.DataFrame): Every current row of the inserted and changed users, e.g. all their widgets.
+                             Users missing from it keep their postings.
+        deleted_ids (Iterable[str]): The ids of users to remove from the index.
+
+        Raises:
+        ValueError: If an indexed field is missing from the data.
+        """
+        deleted_ids = [str(user_id) for user_id in deleted_ids]
+        columns = index_columns(data, list(self.fields))
+        user_ids = columns['id'].astype(str).to_numpy()
+        changed_ids = list(dict.fromkeys(user_ids.tolist()))
+        changed_codes = np.unique(self._encode(changed_ids + deleted_ids)).astype(np.int32)
+        if len(changed_codes) == 0:
+            return
+
+        # Mask the changed users out of the arrays and out of earlier deltas, then add their current postings
+        self._stale = np.union1d(self._stale, changed_codes).astype(np.int32)
+        self._deleted = np.union1d(_difference(self._deleted, changed_codes),
+                                   np.unique(self._encode(deleted_ids))).astype(np.int32)
+        user_codes = self._encode(user_ids)
+        for field, added in self._added.items():
+            for value in list(added):
+                added[value] = _difference(added[value], changed_codes)
+            values = columns[field]
+            present = values.notna().to_numpy()
+            for value, codes in pd.Series(user_codes[present]).groupby(values[present].map(str).to_numpy()):
+                added[value] = np.union1d(added.get(value, np.empty(0, dtype=np.int32)), codes.to_numpy()).astype(np.int32)
+
+    def _encode(self, user_ids):
+        """Return the integer code of each user id, assigning new codes to unseen ids."""
+        user_ids = np.asarray(user_ids, dtype=str)
+        positions = np.minimum(np.searchsorted(self.ids, user_ids), max(len(self.ids) - 1, 0))
+        codes = positions.astype(np.int64)
+        found = self.ids[positions] == user_ids if len(self.ids) else np.zeros(len(user_ids), dtype=bool)
+        for i in np.flatnonzero(~found):
+            user_id = user_ids[i]
+            if user_id not in self._new_codes:
+                self._new_codes[user_id] = len(self.ids) + len(self._new_ids)
+                self._new_ids.append(user_id)
+            codes[i] = self._new_codes[user_id]
+        return codes
+
+    def _decode(self, codes):
+        """Return the user id of each sorted integer code."""
+        split = np.searchsorted(codes, len(self.ids))
+        if split == len(codes):
+            return self.ids[codes]
+        new_ids = np.array(self._new_ids, dtype=str)
+        return np.concatenate([self.ids[codes[:split]], new_ids[codes[split:] - len(self.ids)]])
+
+    def compact(self):
+        """
+        Fold the changes applied by apply_delta back into the sorted arrays.
+
+        This costs as much as a rebuild from encoded data, so save only does it once the changes
+        touch more than a set share of the users, rather than after each delta.
+        """
+        if not len(self._stale) and not self._new_ids:
+            return
+
+        # Drop deleted users and recode the remaining ones in id order
+        all_ids = np.concatenate([self.ids, np.array(self._new_ids, dtype=str)])
+        live = np.ones(len(all_ids), dtype=bool)
+        live[self._deleted] = False
+        order = np.argsort(all_ids[live], kind='stable')
+        recode = np.full(len(all_ids), -1, dtype=np.int64)
+        recode[np.flatnonzero(live)[order]] = np.arange(len(order))
+        ids = all_ids[live][order]
+
+        fields = {}
+        for field, (values, offsets, codes) in self.fields.items():
+            value_positions = np.repeat(np.arange(len(values)), np.diff(offsets))
+            keep = ~np.isin(codes, self._stale)
+            positions = dict(self._positions[field])
+            added = self._added[field]
+            for value in added:
+                positions.setdefault(value, len(positions))
+            value_positions = np.concatenate([value_positions[keep]] + [np.full(len(added_codes), positions[value])
+                                                                         for value, added_codes in added.items()])
+            user_codes = recode[np.concatenate([codes[keep]] + list(added.values())).astype(np.int64)]
+            offsets, user_codes = _csr(value_positions, user_codes, len(positions), len(ids))
+            fields[field] = (np.array(list(positions), dtype=str), offsets, user_codes)
+
+        self.__init__(ids, fields)
+
+    def postings(self, field, value):
+        """
+        Return the sorted integer codes of the users having a value in a field.
+
+        Raises:
+        IndexQueryError: If the field is not indexed.
+        """
+        if field not in self.fields:
+            raise IndexQueryError(f"Field '{field}' is not indexed, expected one of: {', '.join(self.fields)}")
+        position = self._positions[field].get(value)
+        if position is None:
+            codes = np.empty(0, dtype=np.int32)
+        else:
+            _, offsets, codes = self.fields[field]
+            codes = _difference(codes[offsets[position]:offsets[position + 1]], self._stale)
+        added = self._added[field].get(value)
+        return codes if added is None else np.union1d(codes, added).astype(np.int32)
+
+    def query_codes(self, query):
+        """
+        Evaluate a boolean query and return the sorted integer codes of the matching users.
+
+        Queries combine field=value terms with AND, OR, NOT and parentheses, e.g.
+        'location=Poland AND widget_name="Lycaon pictus" AND NOT age_group=2'. NOT binds
+        tightest and AND binds tighter than OR. Values containing spaces or parentheses must be quoted.
+
+        Raises:
+        IndexQueryError: If the query is malformed or refers to a field that is not indexed.
+        """
+        tokens = self._tokenize(query)
+        position = 0
+
+        def peek():
+            return tokens[position] if position < len(tokens) else (None, None)
+
+        def advance():
+            nonlocal position
+            position += 1
+            return tokens[position - 1]
+
+        def parse_or():
+            result = parse_and()
+            while peek() == ('op', 'OR'):
+                advance()
+                result = np.union1d(result, parse_and())
+            return result
+
+        def parse_and():
+            result = parse_not()
+            while peek() == ('op', 'AND'):
+                advance()
+                # Subtract 'AND NOT x' directly rather than intersecting with the complement of x
+                if peek() == ('op', 'NOT'):
+                    advance()
+                    result = _difference(result, parse_not())
+                else:
+                    result = _intersect(result, parse_not())
+            return result
+
+        def parse_not():
+            if peek() == ('op', 'NOT'):
+                advance()
+                mask = np.ones(len(self.ids) + len(self._new_ids), dtype=bool)
+                mask[parse_not()] = False
+                mask[self._deleted] = False
+                return np.flatnonzero(mask).astype(np.int32)
+            return parse_term()
+
+        def parse_term():
+            kind, token = peek()
+            if kind == 'term':
+                advance()
+                return self.postings(*token)
+            if (kind, token) == ('paren', '('):
+                advance()
+                result = parse_or()
+                if peek() != ('paren', ')'):
+                    raise IndexQueryError(f"Missing closing parenthesis in query: {query}")
+                advance()
+                return result
+            raise IndexQueryError(f"Expected a field=value term in query: {query}")
+
+        result = parse_or()
+        if position != len(tokens):
+            raise IndexQueryError(f"Unexpected '{tokens[position][1]}' in query: {query}")
+        return result
+
+    def query(self, query):
+        """
+        Evaluate a boolean query and return the ids of the matching users.
+
+        See query_codes for the query syntax.
+
+        Returns:
+        np.ndarray: The matching user ids, sorted unless users were added since the last compact.
+        """
+        return self._decode(self.query_codes(query))
+
+    @staticmethod
+    def _tokenize(query):
+        """Split a query into (kind, token) pairs, where a term token is a (field, value) pair."""
+        tokens = []
+        position = 0
+        query = query.rstrip()
+        while position < len(query):
+            match = _TOKEN.match(query, position)
+            if match is None:
+                raise IndexQueryError(f"Unable to parse query at position {position}: {query}")
+            if match['paren']:
+                tokens.append(('paren', match['paren']))
+            elif match['op']:
+                tokens.append(('op', match['op']))
+            else:
+                value = next(value for value in (match['dq'], match['sq'], match['bare']) if value is not None)
+                tokens.append(('term', (match['field'], value)))
+            position = match.end()
+        return tokens
+
+    def save(self, path=INDEX_PATH, compact_fraction=INDEX_COMPACT_FRACTION):
+        """
+        Save the index as uncompressed .npz files: the arrays at path, and the changes applied since
+        they were built or compacted as delta segments at delta_path(path).
+
+        The arrays are only written if they changed since they were saved there, so saving a loaded
+        index after a small delta costs as much as the delta. Once the changed users exceed
+        compact_fraction of the indexed users, the index is compacted and saved whole instead.
+
+        Parameters:
+        path (str): The path of the file. Defaults to INDEX_PATH from constants module.
+        compact_fraction (float): The share of changed users beyond which the index is compacted first.
+                                  Defaults to INDEX_COMPACT_FRACTION from constants module.
+        """
+        if len(self._stale) > compact_fraction * len(self.ids):
+            self.compact()
+
+        if self._base_id is None or self._base_path != path or not os.path.exists(path):
+            base_id = uuid.uuid4().hex
+            arrays = {'ids': self.ids, 'fields': np.array(list(self.fields), dtype=str), 'base_id': np.array(base_id)}
+            for field, (values, offsets, codes) in self.fields.items():
+                arrays[f'{field}.values'] = values
+                arrays[f'{field}.offsets'] = offsets
+                arrays[f'{field}.codes'] = codes
+            # Written aside and moved into place, as the previous file may still be memory-mapped by a loaded index
+            _write_npz(path, arrays)
+            self._base_id, self._base_path = base_id, path
+
+        if not len(self._stale) and not self._new_ids:
+            if os.path.exists(delta_path(path)):
+                os.remove(delta_path(path))
+            return
+        arrays = {'base_id': np.array(self._base_id), 'new_ids': np.array(self._new_ids, dtype=str),
+                  'stale': self._stale, 'deleted': self._deleted}
+        for field, added in self._added.items():
+            arrays[f'{field}.values'] = np.array(list(added), dtype=str)
+            arrays[f'{field}.offsets'] = np.cumsum([0] + [len(codes) for codes in added.values()])
+            arrays[f'{field}.codes'] = np.concatenate([np.empty(0, dtype=np.int32)] + list(added.values())).astype(np.int32)
+        _write_npz(delta_path(path), arrays)
+
+    @classmethod
+    def load(cls, path=INDEX_PATH):
+        """
+        Load an index saved by save, with the delta segments saved next to it.
+
+        The arrays are memory-mapped rather than read, so only the pages a query or a delta touches
+        are loaded from disk.
+
+        Parameters:
+        path (str): The path of the file. Defaults to INDEX_PATH from constants module.
+
+        Returns:
+        MultiFieldIndex: The index.
+        """
+        arrays = _map_npz(path)
+        fields = {field: (arrays[f'{field}.values'], arrays[f'{field}.offsets'], arrays[f'{field}.codes'])
+                  for field in arrays['fields']}
+        base_id = str(arrays['base_id']) if 'base_id' in arrays else None
+        index = cls(arrays['ids'], fields, base_id, path)
+
+        # Delta segments saved over another version of the arrays, e.g. before a compaction, are stale
+        if base_id is not None and os.path.exists(delta_path(path)):
+            with np.load(delta_path(path)) as delta:
+                if str(delta['base_id']) == base_id:
+                    index._new_ids = delta['new_ids'].tolist()
+                    index._new_codes = {user_id: len(index.ids) + i for i, user_id in enumerate(index._new_ids)}
+                    index._stale = delta['stale']
+                    index._deleted = delta['deleted']
+                    for field in index.fields:
+                        values, offsets, codes = delta[f'{field}.values'], delta[f'{field}.offsets'], delta[f'{field}.codes']
+                        index._added[field] = {value: codes[offsets[i]:offsets[i + 1]] for i, value in enumerate(values.tolist())}
+        return index
+
+
+def delta_path(path=INDEX_PATH):
+    """Return the path of the delta segments saved next to the index saved at path."""
+    root, extension = os.path.splitext(path)
+    return f'{root}.delta{extension}'
+
+
+def _write_npz(path, arrays):
+    """Write arrays to an uncompressed .npz file, replacing the file at path only once it is complete."""
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(temp_path, path)
+
+
+def _map_npz(path):
+    """
+    Memory-map every array of an uncompressed .npz file, as np.load only maps .npy files.
+
+    Each array is stored as a .npy file within the zip archive, so it is mapped at the offset of its data.
+    """
+    readers = {(1, 0): np.lib.format.read_array_header_1_0, (2, 0): np.lib.format.read_array_header_2_0}
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as file:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(archive.open(info))
+                continue
+            # The data follows the local file header, whose name and extra field lengths may differ from the central directory
+            file.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', file.read(4))
+            file.seek(info.header_offset + 30 + name_length + extra_length)
+            shape, fortran_order, dtype = readers[np.lib.format.read_magic(file)](file)
+            if dtype.hasobject or 0 in shape:
+                file.seek(info.header_offset + 30 + name_length + extra_length)
+                arrays[name] = np.lib.format.read_array(file, allow_pickle=False)
+            else:
+                arrays[name] = np.memmap(file, dtype=dtype, mode='r', shape=shape, offset=file.tell(),
+                                         order='F' if fortran_order else 'C')
+    return arrays
+
+
+def _csr(value_positions, user_codes, value_count, user_count):
+    """Sort and deduplicate (value position, user code) pairs into the offsets and codes arrays of a field."""
+    pairs = np.unique(value_positions.astype(np.int64) * max(user_count, 1) + user_codes)
+    value_positions, user_codes = np.divmod(pairs, max(user_count, 1))
+    offsets = np.searchsorted(value_positions, np.arange(value_count + 1))
+    return offsets, user_codes.astype(np.int32)
+
+
+def _intersect(left, right):
+    """Intersect two sorted arrays of unique codes by binary searching the smaller in the larger."""
+    if len(left) > len(right):
+        left, right = right, left
+    if len(left) == 0:
+        return left
+    positions = np.minimum(np.searchsorted(right, left), len(right) - 1)
+    return left[right[positions] == left]
+
+
+def _difference(left, right):
+    """Remove the codes in right from left, both sorted arrays of unique codes."""
+    if len(left) == 0 or len(right) == 0:
+        return left
+    positions = np.minimum(np.searchsorted(right, left), len(right) - 1)
+    return left[right[positions] != left]
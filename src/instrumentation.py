@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import uuid
+import resource
+import tracemalloc
+import pandas as pd
+from datetime import datetime, timezone
+
+# Per-thread I/O counters, which Linux keeps for each thread separately
+_THREAD_IO_PATH = '/proc/thread-self/io'
+
+# Measurements exported as Prometheus gauges, with their help text
+PROMETHEUS_METRICS = {
+    'seconds': 'Wall time of the stage in seconds',
+    'cpu_seconds': 'CPU time of the stage thread in seconds',
+    'rows_in': 'Rows of the DataFrame inputs of the stage',
+    'rows_out': 'Rows of the DataFrame output of the stage',
+    'bytes_written': 'Bytes written by the stage thread',
+    'peak_bytes': 'Peak memory allocated by the stage in bytes, when traced',
+    'max_rss_bytes': 'Peak resident memory of the process by the end of the stage in bytes',
+    'cached': 'Whether the stage was skipped because its output was cached',
+    'failed': 'Whether the stage raised an error',
+}
+
+
+def count_rows(value):
+    """Return the number of rows of a DataFrame or Series, or None for anything else."""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    return None
+
+
+def _bytes_written():
+    """Return the bytes the current thread has passed to write calls, or None where Linux does not report them."""
+    try:
+        with open(_THREAD_IO_PATH) as file:
+            for line in file:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def _snapshot():
+    """Take a tracemalloc snapshot, leaving out the memory of the earlier snapshots themselves."""
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+class Instrumentation:
+    """
+    Measurements of each stage of a pipeline run, exported as JSON lines and in the Prometheus text format.
+
+    Every stage records its wall time, the CPU time and bytes written of the thread it ran on, the rows of
+    its DataFrame inputs and output, and the resident memory high-water mark of the process. With
+    trace_memory, it also records the peak memory the stage allocated and the source lines that
+    allocated the most memory still held when it finished. The memory tracing slows stages down a lot.
+    A stage that raises is recorded too, measured up to the error and marked as failed.
+    Work done in other processes or background threads is not counted.
+    """
+
+    def __init__(self, trace_memory=False, hotspots=0):
+        """
+        Parameters:
+        trace_memory (bool): Trace allocations with tracemalloc. Stages must then run one at a time for their
+                             peaks to be their own. Defaults to False.
+        hotspots (int): The number of top allocating source lines to record per stage when tracing. Defaults to 0.
+        """
+        self.trace_memory = trace_memory
+        self.hotspots = hotspots
+        self.run_id = uuid.uuid4().hex
+        self.records = []
+
+    def measure(self, name, func, args=(), kwargs=None):
+        """
+        Call func(*args, **kwargs) as the stage of the given name and record its measurements.
+
+        Parameters:
+        name (str): The name of the stage.
+        func (callable): The function of the stage.
+        args (Iterable): Its positional arguments. The rows of those that are DataFrames or Series are counted as its input.
+        kwargs (dict, optional): Its keyword arguments.
+
+        Returns:
+        The output of func.
+
+        Raises:
+        Any error func raises, once the stage is recorded as failed.
+        """
+        record = {'stage': name, 'cached': False, 'failed': False}
+        before = _snapshot() if self.trace_memory and self.hotspots else None
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start_written = _bytes_written()
+        start, start_cpu = time.perf_counter(), time.thread_time()
+
+        output = None
+        try:
+            output = func(*args, **(kwargs or {}))
+        except BaseException:
+            record['failed'] = True
+            raise
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            record['cpu_seconds'] = time.thread_time() - start_cpu
+            end_written = _bytes_written()
+            record['bytes_written'] = end_written - start_written if start_written is not None and end_written is not None else None
+            rows_in = [count_rows(value) for value in args]
+            record['rows_in'] = sum(rows for rows in rows_in if rows is not None) if any(rows is not None for rows in rows_in) else None
+            record['rows_out'] = count_rows(output)
+            if self.trace_memory:
+                record['peak_bytes'] = tracemalloc.get_traced_memory()[1] - start_memory
+            if before is not None:
+                statistics = [statistic for statistic in _snapshot().compare_to(before, 'lineno') if statistic.size_diff > 0]
+                record['hotspots'] = [{'line': str(statistic.traceback), 'bytes': statistic.size_diff, 'count': statistic.count_diff}
+                                      for statistic in statistics[:self.hotspots]]
+            record['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            self.records.append(record)
+        return output
+
+    def skip(self, name):
+        """Record that the stage of the given name was skipped as cached."""
+        self.records.append({'stage': name, 'cached': True})
+
+    def peak_memory(self):
+        """Return the peak memory allocated by each traced stage, in bytes."""
+        return {record['stage']: record['peak_bytes'] for record in self.records if 'peak_bytes' in record}
+
+    def write_jsonl(self, path):
+        """
+        Append the records of this run to a JSON lines file, one line per stage.
+
+        Parameters:
+        path (str): The metrics file.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        timestamp = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        with open(path, 'a') as file:
+            for record in self.records:
+                file.write(json.dumps({'run_id': self.run_id, 'timestamp': timestamp, **record}) + '\n')
+
+    def write_prometheus(self, path, prefix='etl_stage'):
+        """
+        Write the records of this run in the Prometheus text format, replacing the file atomically so
+        a textfile collector never reads it half written.
+
+        Parameters:
+        path (str): The metrics file.
+        prefix (str): The prefix of the metric names. Defaults to 'etl_stage'.
+        """
+        lines = []
+        for metric, help_text in PROMETHEUS_METRICS.items():
+            samples = [(record['stage'], record[metric]) for record in self.records if record.get(metric) is not None]
+            if not samples:
+                continue
+            lines.append(f'# HELP {prefix}_{metric} {help_text}')
+            lines.append(f'# TYPE {prefix}_{metric} gauge')
+            lines.extend(f'{prefix}_{metric}{{stage="{stage}"}} {int(value) if isinstance(value, int) else value}'
+                         for stage, value in samples)
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temp_path, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, path)
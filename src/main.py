@@ -1,150 +1,605 @@
 import os, sys
+import argparse
 import logging
 import pandas as pd
 import data_processing as dp 
 import db_operations as db_ops
-
-from constants import DATA_PATH, STAGING_FOLDER, DB_PATH
+import index_engine
+import validation
+import parsers
+import fingerprints
+from fingerprints import FingerprintStore, hash_keys
+import rankings
+from rankings import AgeGroupRankings
+from pipeline import Pipeline, file_hash
+import snapshots
+from snapshots import SnapshotWriter
+import constants
+
+from constants import DATA_PATH, EXPECTATION_SUITE_PATH, STAGING_FOLDER, DB_PATH, INDEX_PATH, FINGERPRINT_PATH, BATCH_SIZE, SNAPSHOT_FORMAT, TRANSFORMED_DATA_INDEXES, METRICS_PATH, PROMETHEUS_PATH, SEARCH_FIELDS, DATA_QUALITY_EXCLUDED_EXPECTATIONS
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../test/data_quality')))
 
-from test_data_quality import test_data_quality
+# The tables written by the load and indexes stages, whose state a cached run of those stages must match
+LOAD_TABLES = ['transformed_data', 'users', 'widgets', 'locations', 'age_group_rankings'] + [f'{field}_search' for field in SEARCH_FIELDS]
+INDEX_TABLES = ['inverted_index', 'location_postings']
+
+# Every module the stages run through, directly or through each other, whose source is part of every cache key
+STAGE_MODULES = [dp, parsers, snapshots, db_ops, rankings, index_engine, validation, fingerprints, constants]
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
 # Main execution start
-def main():
+def main(chunksize=None, incremental=False, use_cache=True, refresh_expectations=False, workers=None, parser='pandas',
+         compact=False, memory_report=False, star_schema=False, hotspots=0, debug_sample=0, search_index=False):
 
-    # Run data quality tests first
-    logging.info("Running data quality tests...")
+    # Stream the input in bounded batches instead if requested
+    if chunksize is not None:
+        return main_streaming(chunksize, incremental=incremental, parser=parser)
+
+    # Tasks 9 to 11 write through one database session, committed once every stage has run and every
+    # snapshot written in the background is on disk
+    pipeline = None
     try:
-        test_data_quality() 
-    except AssertionError as e: 
-        logging.error(f"Data quality tests failed: {e}")
-        raise
-    logging.info("Data quality tests passed.")
+        with db_ops.Session(DB_PATH, bulk_load=True) as session, SnapshotWriter() as writer:
+            pipeline = build_pipeline(session, writer, incremental=incremental, refresh_expectations=refresh_expectations,
+                                      workers=workers, parser=parser, compact=compact, star_schema=star_schema,
+                                      debug_sample=debug_sample, search_index=search_index)
+            outputs = pipeline.run(force=not use_cache, profile_memory=memory_report, hotspots=hotspots, commit=False)
+            # Let query services drop the results they cached before this run, if it changed the export
+            if session.conn.total_changes:
+                db_ops.bump_generation(DB_PATH, session=session)
+        # Cache the outputs of the database stages only once what they wrote is committed
+        pipeline.commit()
+    finally:
+        # A failed run is written too, with the stages measured before it stopped and the one that failed marked
+        if pipeline is not None:
+            pipeline.metrics.write_jsonl(METRICS_PATH)
+            pipeline.metrics.write_prometheus(PROMETHEUS_PATH)
+            logging.info(f"Stage metrics appended to {METRICS_PATH} and written to {PROMETHEUS_PATH}")
+
+    if memory_report:
+        report = '\n'.join(f"{name:<24}{peak / 2 ** 20:>10.1f} MiB" for name, peak in pipeline.peak_memory.items())
+        logging.info(f"Peak memory allocated by each stage ({'compact' if compact else 'default'} dtypes):\n{report}")
+        for record in pipeline.metrics.records:
+            if record.get('hotspots'):
+                lines = '\n'.join(f"{hotspot['bytes'] / 2 ** 20:>10.1f} MiB  {hotspot['line']}" for hotspot in record['hotspots'])
+                logging.info(f"Top allocations held at the end of stage '{record['stage']}':\n{lines}")
+
+    # Record the ingested records only once they are committed
+    if incremental:
+        ingested = outputs['load'][1]
+        ingested.save()
+        logging.info(f"{len(ingested)} ingested records fingerprinted in {FINGERPRINT_PATH}")
+
+
+def build_pipeline(session, writer, incremental=False, refresh_expectations=False, workers=None, parser='pandas',
+                   compact=False, star_schema=False, debug_sample=0, search_index=False):
+    """
+    Build the stage graph of the ETL process.
+
+    Stages whose inputs, parameters and code are unchanged since an earlier run are skipped, and
+    independent stages run concurrently: top user reporting alongside flattening, and the inverted
+    index build alongside the database load. Database stages are chained, since they share the session.
+
+    Parameters:
+    session (db_ops.Session): The session the database stages write through.
+    writer (SnapshotWriter): The writer snapshots are written in the background on.
+    incremental (bool): Upsert only new or changed rows instead of replacing the transformed_data table.
+    refresh_expectations (bool): Profile the raw data again for a new expectation suite. Defaults to False.
+    workers (int, optional): Parse the input on this many processes. The extracted data is the same either way.
+    parser (str): The parser backend of the extract, 'pandas' or 'typed'. Defaults to 'pandas'.
+    compact (bool): Hold the data in compact types from extraction on, see dp.compact_dtypes. Defaults to False.
+    star_schema (bool): Load transformed_data as a view over users, widgets and locations tables, see
+                        db_ops.load_star_schema. Only applies to full loads. Defaults to False.
+    debug_sample (int): Log up to this many of the rows removed by deduplication. Defaults to 0.
+    search_index (bool): Also store a search index over the SEARCH_FIELDS, see db_ops.search. Defaults to False.
+
+    Returns:
+    Pipeline: The pipeline.
+    """
+    pipeline = Pipeline(modules=STAGE_MODULES)
+    pipeline.add_stage('extract', extract, params={'parser': parser, 'compact': compact}, resources={'workers': workers},
+                       files=[DATA_PATH])
+    pipeline.add_stage('data_quality', check_data_quality, inputs=['extract'], params={'refresh': refresh_expectations},
+                       files=[EXPECTATION_SUITE_PATH], cache=not refresh_expectations)
+    pipeline.add_stage('snapshot_extracted', snapshot, inputs=['extract'], params={'name': 'extracted_data'},
+                       resources={'writer': writer}, valid=os.path.exists)
+    # Not cached when a sample of the removed rows is asked for, as a cache hit would skip logging it
+    pipeline.add_stage('deduplicate', deduplicate, inputs=['extract'], resources={'debug_sample': debug_sample},
+                       after=['data_quality'], cache=not debug_sample)
+    pipeline.add_stage('snapshot_deduplicated', snapshot, inputs=['deduplicate'], params={'name': 'deduplicated_data'},
+                       resources={'writer': writer}, valid=os.path.exists)
+    pipeline.add_stage('rank', rank, inputs=['deduplicate'])
+    pipeline.add_stage('top_users', report_top_users, inputs=['rank'])
+    pipeline.add_stage('flatten', flatten, inputs=['rank'], params={'compact': compact})
+    pipeline.add_stage('snapshot_transformed', snapshot, inputs=['flatten'], params={'name': 'transformed_data'},
+                       resources={'writer': writer}, valid=os.path.exists)
+    pipeline.add_stage('convert', convert, inputs=['flatten'])
+
+    resources = {'session': session, 'writer': writer}
+    if incremental:
+        # The fingerprint store already skips records ingested by earlier runs, so these always run
+        pipeline.add_stage('load', load_incremental, inputs=['convert'], params={'search_index': search_index},
+                           resources={'session': session}, cache=False)
+        pipeline.add_stage('indexes', update_indexes, inputs=['convert', 'load'], resources=resources, cache=False)
+    else:
+        pipeline.add_stage('load', load, inputs=['convert', 'rank'],
+                           params={'star_schema': star_schema, 'search_index': search_index},
+                           resources={'session': session},
+                           state=lambda: db_ops.state_fingerprint(DB_PATH, LOAD_TABLES))
+        pipeline.add_stage('build_indexes', build_indexes, inputs=['convert'])
+        pipeline.add_stage('indexes', store_indexes, inputs=['build_indexes'], after=['load'], resources=resources,
+                           state=lambda: db_ops.state_fingerprint(DB_PATH, INDEX_TABLES) + file_hash(INDEX_PATH)
+                                         + file_hash(index_engine.delta_path(INDEX_PATH)))
+    return pipeline
+
+
+def check_data_quality(data, refresh=False):
+    """
+    Validate the extracted data with the native validator, against the saved expectation suite and the
+    default expectations of each column's semantic type. Great Expectations is only loaded to profile a
+    new suite, when there is none yet or a refresh is requested.
+    """
+    if refresh or not os.path.exists(EXPECTATION_SUITE_PATH):
+        from profiler import load_expectation_suite  # Loading Great Expectations takes seconds
+        load_expectation_suite(data=data, refresh=True)
 
-    # Data extraction
+    logging.info("Running data quality tests...")
+    expectations = validation.load_expectations(EXPECTATION_SUITE_PATH, excluded=DATA_QUALITY_EXCLUDED_EXPECTATIONS) \
+                   + validation.default_expectations()
+    results = validation.validate(data, expectations)
+    if not results['success']:
+        failed = validation.failures(results)
+        logging.error("Data quality tests failed:\n" + '\n'.join(failed))
+        raise validation.ValidationError(f"{len(failed)} of {len(expectations)} data quality expectations failed")
+    logging.info(f"Data quality tests passed, {results['statistics']['evaluated_expectations']} expectations met.")
+
+
+def extract(parser='pandas', compact=False, workers=None):
+    """Extract the raw data with the given parser backend, on a process pool if more than one worker is given, and run Task 1."""
     logging.info("Extracting data...")
     try:
-        data = dp.extract(DATA_PATH)
+        data = dp.extract(DATA_PATH, max_workers=workers, backend=parser)
     except ValueError as e:
         logging.error(f"Value Error during data extraction: {e}")
         raise
     logging.info("Successfully extracted data")
+    if compact:
+        data = dp.compact_dtypes(data)
 
-    # Create snapshot of extracted data
-    extracted_snapshot_path = dp.export_snapshot(data, STAGING_FOLDER, 'extracted_data')
-    logging.info(f"Snapshot of extracted data snapshot created in staging at {extracted_snapshot_path}")
+    # Task 1: Output number of rows
+    logging.info(f"There are {len(data)} rows in the original data")
+    return data
 
 
-    # Task 1: Output number of rows
-    row_count = len(data)
-    logging.info(f"There are {row_count} rows in the original data")
+def snapshot(data, name, writer):
+    """Start writing a snapshot of a stage's output to staging, returning its path."""
+    snapshot_path = dp.export_snapshot(data, STAGING_FOLDER, name, fmt=SNAPSHOT_FORMAT, writer=writer)
+    logging.info(f"Snapshot of {name.replace('_', ' ')} is being written to staging at {snapshot_path}")
+    return snapshot_path
 
 
+def deduplicate(data, debug_sample=0):
+    """Run Tasks 2 and 3, logging a sample of the removed rows if debug_sample is above 0."""
     # Task 2: Data dedupe
     logging.info("Deduplicating data...")
     deduplicated_data = dp.deduplicate(data)
     logging.info("Data deduplication complete")
 
-    # Deduplication comparison
-    # dupe_data = pd.merge(data, deduplicated_data, how='left', indicator=True)
-    # dupe_data = dupe_data.loc[dupe_data['_merge'] == 'left_only']
-    # logging.info(dupe_data)
-    logging.info(data[~data.index.isin(deduplicated_data.index)])
-    logging.info(data[data['id'] == 'fef784c0-dde6-4e48-b2bb-8f0d4dd62770'])
-
-
-    # Create snapshot of deduplicated data
-    dedupe_snapshot_path = dp.export_snapshot(deduplicated_data, STAGING_FOLDER, 'deduplicated_data')
-    logging.info(f"Snapshot of deduplicated data created in staging at {dedupe_snapshot_path}")
-
+    # Deduplication comparison, only rendered when asked for as formatting the frame is costly
+    if debug_sample > 0:
+        removed = data[~data.index.isin(deduplicated_data.index)]
+        logging.info(f"Sample of {min(debug_sample, len(removed))} of {len(removed)} removed rows:\n{removed.head(debug_sample)}")
 
     # Task 3: Output number of rows removed
-    dropped_row_count = row_count - len(deduplicated_data)
+    dropped_row_count = len(data) - len(deduplicated_data)
     logging.info(f"There are {dropped_row_count} rows removed")
+    return deduplicated_data
 
 
+def rank(deduplicated_data):
+    """Run Task 4."""
     # Task 4: Calculate user rank in age group based on user score for age group rank column
     logging.info("Ranking users...")
     ranked_data = dp.rank_users(deduplicated_data)
     logging.info("User ranking complete")
+    return ranked_data
 
 
+def report_top_users(ranked_data):
+    """Run Task 5."""
     # Task 5: id, email and age group for top user per age group (ascending)
     logging.info("Retrieving top users per age group...")
     top_user_data = dp.get_top_user_per_age_group(ranked_data)
     logging.info(f"Below are the top users for each age group\n{top_user_data}")
+    return top_user_data
 
 
-    # Task 6: Flattening the widget list
-    logging.info("Flattening widget list...")
-    flattened_data = dp.flatten_widget_list(ranked_data)
-    logging.info("Widget list flattening complete")
-
+def flatten(ranked_data, compact=False):
+    """Run Tasks 6 to 8, in compact types if requested."""
+    # Tasks 6 and 8: Flattening the widget list and adding widget name and widget amount columns in one pass
+    logging.info("Flattening widget list and extracting widget info...")
+    transformed_data = dp.flatten_and_extract_widgets(ranked_data)
+    logging.info("Widget list flattening and widget info extraction complete")
+    if compact:
+        # User columns are now repeated once per widget
+        transformed_data = dp.compact_dtypes(transformed_data)
 
     # Task 7: New total number of rows
-    row_count = len(flattened_data)
+    row_count = len(transformed_data)
     logging.info(f"There are currently {row_count} rows in the data")
+    return transformed_data
 
 
-    # Task 8: add widget name and widget amount columns
-    logging.info("Extracting widget info...")
-    transformed_data = dp.extract_widget_info(flattened_data)
-    logging.info("Widget info extraction complete")
-    
-    # Create snapshot of transformed data
-    transformed_snapshot_path = dp.export_snapshot(transformed_data, STAGING_FOLDER, 'transformed_data')
-    logging.info(f"Snapshot of transformed data created in staging at {transformed_snapshot_path}")
+def convert(transformed_data):
+    """Convert the nested columns of the transformed data for the database stages."""
+    return dp.convert_unsupported_data_types(transformed_data)
 
-    
-    # Task 9: Store table in SQLite database (loading from snapshot first)
-    logging.info("Loading transformed data from staging...")
+
+def load(transformed_data, ranked_data, session, star_schema=False, search_index=False):
+    """
+    Run Task 9, replacing the transformed_data and age_group_rankings tables. Returns the rows loaded.
+
+    With star_schema, transformed_data is a view over normalized users, widgets and locations tables instead,
+    and otherwise those tables are dropped.
+    With search_index, the search tables of the SEARCH_FIELDS are replaced too, and otherwise dropped.
+    """
+    logging.info("Loading data into SQLite database...")
     try:
-        # Extract the file name from the full path
-        file_name = os.path.basename(transformed_snapshot_path)
-        transformed_data = dp.load_from_staging(STAGING_FOLDER, file_name)
+        if star_schema:
+            row_count = db_ops.load_star_schema(transformed_data, DB_PATH, session=session)
+        else:
+            row_count = db_ops.bulk_load(transformed_data, DB_PATH, table_name='transformed_data', indexes=TRANSFORMED_DATA_INDEXES, session=session)
+            db_ops.drop_star_schema(DB_PATH, session=session)
+        db_ops.store_rankings(AgeGroupRankings.from_data(ranked_data), DB_PATH, replace=True, session=session)
+        if search_index:
+            row_counts = db_ops.store_search_index(transformed_data, SEARCH_FIELDS, DB_PATH, session=session)
+            logging.info(f"Search index stored, {', '.join(f'{count} terms in {table}' for table, count in row_counts.items())}")
+        else:
+            db_ops.drop_search_index(SEARCH_FIELDS, DB_PATH, session=session)
     except Exception as e:
-        logging.error(f"ERROR! Unable to load transformed data from staging: {e}")
+        logging.error(f"ERROR! Unable to load data into database: {e}")
         raise
-    logging.info("Successfully loaded transformed data from staging")
-    
+    logging.info("Successfully loaded data into database")
+    return row_count
+
+
+def load_incremental(transformed_data, session, search_index=False):
+    """
+    Run Task 9, upserting only the records not ingested by earlier runs. Ranks were still computed over every record.
+
+    With search_index, the users with new records are applied to the search tables of the SEARCH_FIELDS,
+    which are built in full if they do not exist yet. Otherwise they are dropped.
+
+    Returns:
+    tuple: The rows of the users with new records, to apply to the stored indexes, or None if they must be
+           rebuilt, and the fingerprint store of ingested records, to save once the session is committed.
+    """
     logging.info("Loading data into SQLite database...")
+    delta = None
     try:
-        transformed_data = dp.convert_unsupported_data_types(transformed_data)
-        db_ops.load(transformed_data, DB_PATH, table_name='transformed_data')
+        ingested = FingerprintStore.open(FINGERPRINT_PATH)
+        if len(ingested) and not db_ops.is_upserted(DB_PATH, 'transformed_data', session=session):
+            # A full load replaced the table since these records were ingested, and the upsert replaces it
+            # again, so every record is loaded and fingerprinted anew
+            logging.info("transformed_data was replaced by a full load, reloading every record")
+            ingested = FingerprintStore(path=FINGERPRINT_PATH)
+        first_run = len(ingested) == 0
+        new_data = transformed_data[~ingested.contains(hash_keys(transformed_data))]
+        logging.info(f"{len(transformed_data) - len(new_data)} rows were ingested by earlier runs")
+        changed_row_count = 0
+        age_group_rankings = db_ops.load_rankings(DB_PATH, session=session)
+        if not len(age_group_rankings):
+            # No rankings were stored yet, or only per user by an earlier version, so every record is ranked
+            age_group_rankings = AgeGroupRankings.from_data(transformed_data)
+        if not new_data.empty:
+            # The fingerprint store already decides what is new, so late records before the high-water mark
+            # are loaded too, and every row given is written before its key is fingerprinted
+            changed_row_count = db_ops.upsert(new_data, DB_PATH, table_name='transformed_data', watermark=False,
+                                              session=session)
+            ingested.add(hash_keys(new_data))
+            age_group_rankings.upsert(new_data)
+        logging.info(f"{changed_row_count} rows inserted, updated or removed")
+        logging.info(f"{db_ops.store_rankings(age_group_rankings, DB_PATH, session=session)} records re-ranked")
+        if not search_index:
+            db_ops.drop_search_index(SEARCH_FIELDS, DB_PATH, session=session)
+        elif first_run or any(db_ops.row_count(DB_PATH, f'{field}_search', session=session) is None for field in SEARCH_FIELDS):
+            db_ops.store_search_index(transformed_data, SEARCH_FIELDS, DB_PATH, session=session)
+            logging.info("Search index built")
+        elif not new_data.empty:
+            db_ops.update_search_index(transformed_data[transformed_data['id'].isin(new_data['id'].unique())],
+                                       SEARCH_FIELDS, DB_PATH, session=session)
+            logging.info("Search index updated")
+        # The users with new records are the delta applied to the stored indexes
+        if not first_run and os.path.exists(INDEX_PATH):
+            delta = transformed_data[transformed_data['id'].isin(new_data['id'].unique())]
     except Exception as e:
         logging.error(f"ERROR! Unable to load data into database: {e}")
         raise
     logging.info("Successfully loaded data into database")
+    return delta, ingested
+
+
+def update_indexes(transformed_data, loaded, session, writer):
+    """Run Tasks 10 and 11 after an incremental load, applying the changed users to the stored indexes if possible."""
+    delta = loaded[0]
+    if delta is None:
+        return store_indexes(build_indexes(transformed_data), session, writer)
+
+    # Tasks 10 and 11: Apply the changed users to the stored indexes instead of rebuilding them
+    logging.info(f"Updating inverted indexes for {delta['id'].nunique()} changed users...")
+    try:
+        index = index_engine.MultiFieldIndex.load(INDEX_PATH)
+        index.apply_delta(delta)
+        index.save(INDEX_PATH)
+        changed_locations = db_ops.update_posting_lists(delta, DB_PATH, field='location', session=session)
+        affected = transformed_data[transformed_data['location'].isin(changed_locations)]
+        db_ops.update_inverted_index(affected, changed_locations, DB_PATH, table_name='inverted_index', session=session)
+    except (db_ops.IndexCreationError, db_ops.IndexStorageError) as e:
+        logging.error(f"Index Update Error: {e}")
+        raise
+    logging.info(f"Successfully updated inverted indexes, {len(changed_locations)} locations changed")
 
 
+def build_indexes(transformed_data):
+    """
+    Run Task 10, building every inverted index from the transformed data.
+
+    Parameters:
+    transformed_data (pd.DataFrame): The transformed data.
+
+    Returns:
+    tuple: The inverted index, the location posting lists and the multi-field index.
+    """
     # Task 10: Create inverted index dataset
     logging.info("Creating inverted index dataset...")
     try:
         inverted_index = db_ops.create_inverted_index(transformed_data)
+        location_postings = db_ops.create_posting_lists(transformed_data, field='location')
     except db_ops.IndexCreationError as e: 
         logging.error(f"Index Creation Error: {e}")
         raise
     logging.info("Successfully created inverted index")
 
+    # Multi-field index for boolean queries
+    multi_field_index = index_engine.MultiFieldIndex.build(transformed_data)
+    return inverted_index, location_postings, multi_field_index
+
+
+def store_indexes(indexes, session, writer):
+    """
+    Run Task 11, storing the indexes from build_indexes.
+
+    Parameters:
+    indexes (tuple): The inverted index, the location posting lists and the multi-field index.
+    session (db_ops.Session): The session the index tables are written through.
+    writer (SnapshotWriter): The writer the inverted index snapshot is written in the background on.
+
+    Returns:
+    dict: The number of rows stored in each index table.
+    """
+    inverted_index, location_postings, multi_field_index = indexes
+
+    # Multi-field index, saved next to the database
+    multi_field_index.save(INDEX_PATH)
+    logging.info(f"Multi-field index saved at {INDEX_PATH}")
+
     # Create snapshot of inverted index table
-    inverted_snapshot_path = dp.export_snapshot(inverted_index, STAGING_FOLDER, 'inverted_index')
-    logging.info(f"Snapshot of inverted index data created in staging at {inverted_snapshot_path}")
+    inverted_snapshot_path = dp.export_snapshot(inverted_index, STAGING_FOLDER, 'inverted_index', fmt=SNAPSHOT_FORMAT,
+                                                writer=writer)
+    logging.info(f"Snapshot of inverted index data is being written to staging at {inverted_snapshot_path}")
 
 
     # Task 11: Store inverted index table
     logging.info("Storing inverted index table...")
     try:
-        db_ops.store_inverted_index(inverted_index, DB_PATH, table_name='inverted_index')
+        db_ops.store_inverted_index(inverted_index, DB_PATH, table_name='inverted_index', session=session)
+        db_ops.store_posting_lists(location_postings, DB_PATH, table_name='location_postings', session=session)
     except db_ops.IndexStorageError as e:
         logging.error(f"Index Storage Error: {e}")
         raise
     logging.info("Successfully stored inverted index table")
+    return {'inverted_index': len(inverted_index), 'location_postings': len(location_postings)}
+
+
+def transform_batches(batches, score_index, stats, index_parts, posting_parts, field_parts, ranking_parts):
+    """
+    Run Tasks 4 to 8 over a stream of deduplicated batches.
+
+    Parameters:
+    batches (Iterable[pd.DataFrame]): The deduplicated batches.
+    score_index (dict): The per age group score distribution from dp.build_score_index.
+    stats (dict): Running counters, updated in place with 'flattened_rows' and 'top_users', the first rank 1
+                  user seen in each age group.
+    index_parts (list): Collects the partial inverted index of every batch.
+    posting_parts (list): Collects the partial location posting lists of every batch.
+    field_parts (list): Collects the indexed fields of every batch, for the multi-field index.
+    ranking_parts (list): Collects the id, created_at, age_group and user_score of every batch, for the
+                          age group rankings.
+
+    Yields:
+    pd.DataFrame: Each transformed batch, ready to be loaded into the database.
+    """
+    for batch in batches:
+        if batch.empty:
+            continue
+
+        # Task 4: Rank against the score distribution of the whole dataset
+        ranked_batch = dp.rank_users(batch, score_index=score_index)
+
+        # Task 5: The first rank 1 user seen per age group is the top user, so one row per age group is kept
+        top_users = dp.top_k_per_group(ranked_batch, 1)[['id', 'email', 'age_group']]
+        stats['top_users'] = pd.concat([stats['top_users'], top_users]).drop_duplicates(subset='age_group')
+        ranking_parts.append(ranked_batch[['id', 'created_at', 'age_group', 'user_score']])
+
+        # Tasks 6 and 8: Flatten the widget list and add widget name and amount columns
+        transformed_batch = dp.flatten_and_extract_widgets(ranked_batch)
+        stats['flattened_rows'] += len(transformed_batch)
+
+        transformed_batch = dp.convert_unsupported_data_types(transformed_batch)
+        index_parts.append(db_ops.create_inverted_index(transformed_batch))
+        posting_parts.append(db_ops.create_posting_lists(transformed_batch, field='location'))
+        field_parts.append(index_engine.index_columns(transformed_batch))
+        yield transformed_batch
+
+
+def main_streaming(chunksize=BATCH_SIZE, incremental=False, parser='pandas'):
+    """
+    Run the ETL process over the raw data in batches of at most chunksize records.
+
+    The raw, deduplicated and transformed records are only held a batch at a time, so the memory
+    they take is bounded by the batch size rather than the input size. The input is read twice:
+    the first pass collects the dedup keys and the score distribution needed for ranking, the
+    second pass transforms and loads each batch.
+
+    The state kept across batches still grows with the input, though far slower than the records:
+    the 8-byte fingerprint of every dedup key, one score per record in the score distribution, and the
+    partial rankings and indexes of every batch, which hold the key and score of each record and the
+    id, location and indexed fields of each row until they are stored at the end.
+
+    Parameters:
+    chunksize (int): The number of records per batch. Defaults to BATCH_SIZE from constants module.
+    incremental (bool): Upsert only new or changed rows instead of replacing the transformed_data table.
+    parser (str): The JSON parser backend of dp.extract, 'pandas' or 'typed'. Defaults to 'pandas'.
+    """
+    logging.warning("Data quality tests are skipped in streaming mode")
+
+    # Pass 1: Count rows, deduplicate and collect the score distribution of each age group
+    logging.info(f"Streaming data in batches of {chunksize} records...")
+    stats = {'rows': 0, 'flattened_rows': 0, 'top_users': None}
+
+    def count_rows(batches):
+        for batch in batches:
+            stats['rows'] += len(batch)
+            yield batch
+
+    try:
+        seen = FingerprintStore()
+        batches = count_rows(dp.extract(DATA_PATH, chunksize=chunksize, backend=parser))
+        score_index = dp.build_score_index(dp.deduplicate(batch, seen=seen) for batch in batches)
+    except ValueError as e:
+        logging.error(f"Value Error during data extraction: {e}")
+        raise
+    logging.info("Successfully extracted data")
+    logging.info(f"Deduplicated {seen.stats['rows']} rows in {seen.stats['batches']} batches "
+                 f"at {seen.throughput:.0f} rows/s, keeping {len(seen)} keys in {seen.nbytes / 2**20:.1f} MiB")
+
+    # Task 1: Output number of rows
+    logging.info(f"There are {stats['rows']} rows in the original data")
+
+    # Task 3: Output number of rows removed
+    dropped_row_count = stats['rows'] - sum(len(scores) for scores in score_index.values())
+    logging.info(f"There are {dropped_row_count} rows removed")
+
+    # Pass 2: Deduplicate, transform and load each batch, snapshotting every stage on the way
+    seen = FingerprintStore()
+    batches = dp.export_snapshot_batches(dp.extract(DATA_PATH, chunksize=chunksize, backend=parser), STAGING_FOLDER, 'extracted_data')
+    batches = (dp.deduplicate(batch, seen=seen) for batch in batches)
+    batches = dp.export_snapshot_batches(batches, STAGING_FOLDER, 'deduplicated_data')
+    index_parts = []
+    posting_parts = []
+    field_parts = []
+    ranking_parts = []
+    batches = transform_batches(batches, score_index, stats, index_parts, posting_parts, field_parts, ranking_parts)
+    batches = dp.export_snapshot_batches(batches, STAGING_FOLDER, 'transformed_data')
+
+    # Tasks 9 to 11 write through one database session, committed once the inverted index is stored
+    with db_ops.Session(DB_PATH, bulk_load=True) as session:
+        # Task 9: Store table in SQLite database
+        logging.info("Loading data into SQLite database...")
+        try:
+            if incremental:
+                changed_row_count = db_ops.upsert(batches, DB_PATH, table_name='transformed_data', session=session)
+                logging.info(f"{changed_row_count} rows inserted, updated or removed")
+            else:
+                db_ops.bulk_load(batches, DB_PATH, table_name='transformed_data', indexes=TRANSFORMED_DATA_INDEXES, session=session)
+                db_ops.drop_star_schema(DB_PATH, session=session)
+            # Every record was streamed through, so the rankings cover every record in both modes
+            db_ops.store_rankings(pd.concat(ranking_parts, ignore_index=True), DB_PATH, replace=True, session=session)
+        except Exception as e:
+            logging.error(f"ERROR! Unable to load data into database: {e}")
+            raise
+        logging.info("Successfully loaded data into database")
+
+        top_user_data = stats['top_users'].sort_values(by='age_group')
+        logging.info(f"Below are the top users for each age group\n{top_user_data}")
+
+        # Task 7: New total number of rows
+        logging.info(f"There are currently {stats['flattened_rows']} rows in the data")
+        logging.info(f"Deduplicated {seen.stats['rows']} rows in {seen.stats['batches']} batches at {seen.throughput:.0f} rows/s")
+
+        # Task 10: Merge the partial inverted indexes of every batch, joining their id lists per location
+        logging.info("Creating inverted index dataset...")
+        try:
+            inverted_index = db_ops.create_inverted_index(pd.concat(index_parts))
+            location_postings = db_ops.create_posting_lists(pd.concat(posting_parts).rename(columns={'user_id': 'id'}),
+                                                            field='location')
+        except db_ops.IndexCreationError as e:
+            logging.error(f"Index Creation Error: {e}")
+            raise
+        logging.info("Successfully created inverted index")
+
+        index_engine.MultiFieldIndex.build(pd.concat(field_parts, ignore_index=True)).save(INDEX_PATH)
+        logging.info(f"Multi-field index saved at {INDEX_PATH}")
+
+        inverted_snapshot_path = dp.export_snapshot(inverted_index, STAGING_FOLDER, 'inverted_index', fmt=SNAPSHOT_FORMAT)
+        logging.info(f"Snapshot of inverted index data created in staging at {inverted_snapshot_path}")
+
+        # Task 11: Store inverted index table
+        logging.info("Storing inverted index table...")
+        try:
+            db_ops.store_inverted_index(inverted_index, DB_PATH, table_name='inverted_index', session=session)
+            db_ops.store_posting_lists(location_postings, DB_PATH, table_name='location_postings', session=session)
+        except db_ops.IndexStorageError as e:
+            logging.error(f"Index Storage Error: {e}")
+            raise
+        logging.info("Successfully stored inverted index table")
+
+        db_ops.bump_generation(DB_PATH, session=session)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the ETL process.")
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help="Stream the input in batches of this many records to bound memory use")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Upsert only new or changed rows since the last run instead of reloading every table")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Run every stage, ignoring the outputs cached by earlier runs")
+    parser.add_argument('--refresh-expectations', action='store_true',
+                        help="Profile the raw data again for a new expectation suite instead of reusing the saved one")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Parse the input file in parallel on this many processes")
+    parser.add_argument('--parser', choices=dp.PARSER_BACKENDS, default='pandas',
+                        help="Parse the input with pd.read_json, or with the faster typed parser into compact column types")
+    parser.add_argument('--compact', action='store_true',
+                        help="Hold repeated strings as categories and integers in the smallest type throughout the run")
+    parser.add_argument('--memory-report', action='store_true',
+                        help="Trace memory and report the peak of each stage, running stages one at a time")
+    parser.add_argument('--star-schema', action='store_true',
+                        help="Store transformed_data as users, widgets and locations tables behind a view of the same shape")
+    parser.add_argument('--hotspots', type=int, default=0,
+                        help="With --memory-report, also log the source lines holding the most memory after each stage")
+    parser.add_argument('--debug-sample', type=int, default=0,
+                        help="Log up to this many of the rows removed by deduplication, for debugging")
+    parser.add_argument('--search-index', action='store_true',
+                        help="Also store a prefix and term search index over emails and widget names")
+    args = parser.parse_args()
+    if args.star_schema and (args.incremental or args.chunksize is not None):
+        parser.error("--star-schema only applies to full, non-streaming loads")
+    if args.chunksize is not None:
+        # Streaming runs skip the stage pipeline, so its caching, validation, tuning and reporting flags have no effect
+        for flag, given in [('--search-index', args.search_index), ('--workers', args.workers is not None),
+                            ('--compact', args.compact), ('--no-cache', args.no_cache),
+                            ('--refresh-expectations', args.refresh_expectations),
+                            ('--memory-report', args.memory_report), ('--hotspots', args.hotspots > 0),
+                            ('--debug-sample', args.debug_sample > 0)]:
+            if given:
+                parser.error(f"{flag} does not apply to streaming loads")
+    main(chunksize=args.chunksize, incremental=args.incremental, use_cache=not args.no_cache,
+         refresh_expectations=args.refresh_expectations, workers=args.workers, parser=args.parser,
+         compact=args.compact, memory_report=args.memory_report, star_schema=args.star_schema, hotspots=args.hotspots,
+         debug_sample=args.debug_sample, search_index=args.search_index)
\ No newline at end of file
@@ -0,0 +1,168 @@
+import json
+import numpy as np
+import pandas as pd
+from itertools import chain
+
+from constants import RAW_DATA_DTYPES
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class WidgetColumn:
+    """
+    The widget lists of a set of records, held as flat arrays instead of one list of dicts per record.
+
+    The widgets of record i are at positions offsets[i] to offsets[i + 1] of names and amounts.
+    Records whose widget list is missing hold no widgets.
+    """
+
+    def __init__(self, offsets, names, amounts):
+        """
+        Parameters:
+        offsets (np.ndarray): The int64 start of each record's widgets, plus the total widget count at the end.
+        names (np.ndarray): The object array of widget names.
+        amounts (np.ndarray): The widget amounts.
+        """
+        self.offsets = offsets
+        self.names = names
+        self.amounts = amounts
+
+    @classmethod
+    def from_lists(cls, widget_lists):
+        """
+        Build the flat arrays from one list of {'name': ..., 'amount': ...} dicts per record.
+
+        Parameters:
+        widget_lists (list): The widget list of each record, or None.
+
+        Returns:
+        WidgetColumn: The widget column.
+        """
+        lengths = np.fromiter((len(x) if isinstance(x, list) else 0 for x in widget_lists), dtype=np.int64,
+                              count=len(widget_lists))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        widgets = list(chain.from_iterable(x for x in widget_lists if isinstance(x, list)))
+        names = np.array([widget.get('name') for widget in widgets], dtype=object)
+        amounts = pd.to_numeric(pd.Series([widget.get('amount') for widget in widgets], dtype=object)).to_numpy()
+        return cls(offsets, names, amounts)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        """Return the number of widgets of each record."""
+        return np.diff(self.offsets)
+
+    def take(self, positions):
+        """
+        Return the widgets of the records at the given positions, in that order.
+
+        Parameters:
+        positions (array-like): The record positions.
+
+        Returns:
+        WidgetColumn: The widget column of the selected records.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        offsets = np.zeros(len(positions) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return WidgetColumn(offsets, self.names[flat], self.amounts[flat])
+
+
+def loads_lines(lines):
+    """
+    Parse JSON lines into a list of records, with orjson if it is installed.
+
+    Parameters:
+    lines (list): The lines, as str or bytes. Blank lines are skipped.
+
+    Returns:
+    list: The parsed records.
+    """
+    if orjson is not None:
+        return [orjson.loads(line) for line in lines if line.strip()]
+    return [json.loads(line) for line in lines if line.strip()]
+
+
+def parse_lines(lines, dtypes=RAW_DATA_DTYPES, widgets=True):
+    """
+    Parse JSON lines straight into typed columns, without the type inference of pd.read_json.
+
+    Each field is gathered into one list per column and converted to its declared dtype once.
+    Integer columns are stored as the smallest integer type holding their values, falling back to
+    float if any value is missing. Fields without a declared dtype are kept as objects, and a
+    declared dtype the values do not fit falls back to pandas inference for that column.
+
+    Parameters:
+    lines (list): The lines, as str or bytes.
+    dtypes (dict): The dtype of each column. 'widgets' columns also get flat WidgetColumn arrays.
+                   Defaults to RAW_DATA_DTYPES from constants module.
+    widgets (bool): Whether to build the WidgetColumn arrays. Callers only reading the
+                    DataFrame pass False to skip them. Defaults to True.
+
+    Returns:
+    tuple: The pd.DataFrame of the records, and a dict of the WidgetColumn of each 'widgets' column,
+           empty if widgets is False.
+    """
+    records = loads_lines(lines)
+    if not records:
+        return pd.DataFrame(), {}
+
+    columns = list(dict.fromkeys(chain.from_iterable(records)))
+    data = {}
+    widget_columns = {}
+    for column in columns:
+        try:
+            values = [record[column] for record in records]
+        except KeyError:
+            values = [record.get(column) for record in records]
+        dtype = dtypes.get(column)
+        if dtype == 'widgets' and widgets:
+            widget_columns[column] = WidgetColumn.from_lists(values)
+        data[column] = _typed_column(values, dtype)
+    return pd.DataFrame(data), widget_columns
+
+
+def _typed_column(values, dtype):
+    """Convert the values of one column to their declared dtype."""
+    try:
+        if dtype in ('int', 'int8', 'int16', 'int32', 'int64'):
+            array = np.array(values)
+            if array.dtype.kind != 'i':
+                raise TypeError("not all values are integers")
+            if dtype != 'int':
+                return array.astype(dtype)
+            low, high = (array.min(), array.max()) if len(array) else (0, 0)
+            return array.astype(next(t for t in (np.int8, np.int16, np.int32, np.int64)
+                                     if np.iinfo(t).min <= low and high <= np.iinfo(t).max))
+        if dtype in ('float32', 'float64'):
+            return np.array([np.nan if value is None else value for value in values], dtype=dtype)
+        if dtype == 'datetime':
+            return _parse_datetimes(values)
+        if dtype == 'category':
+            return pd.Categorical(values)
+    except (TypeError, ValueError, OverflowError):
+        return pd.Series(values).infer_objects()
+    if dtype in ('string', 'widgets'):
+        array = np.empty(len(values), dtype=object)
+        array[:] = values
+        return array
+    return pd.Series(values).infer_objects()
+
+
+def _parse_datetimes(values):
+    """Parse ISO 8601 strings to UTC datetimes, with numpy's fast parser when every value is in UTC."""
+    try:
+        utc = np.array([value[:-1] if value.endswith('Z') else None for value in values], dtype='datetime64[ns]')
+    except (AttributeError, ValueError):
+        return pd.to_datetime(values, utc=True, format='ISO8601')
+    if np.isnat(utc).any():
+        return pd.to_datetime(values, utc=True, format='ISO8601')
+    return pd.DatetimeIndex(utc).tz_localize('UTC')
@@ -0,0 +1,313 @@
+import os
+import json
+import hashlib
+import inspect
+import logging
+import tracemalloc
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from constants import CACHE_FOLDER, CACHE_MAX_BYTES
+from instrumentation import Instrumentation
+
+
+class PipelineError(Exception):
+    """An exception class for invalid pipeline definitions."""
+
+
+class Stage:
+    """A named step of a Pipeline, wrapping a function of the outputs of earlier stages."""
+
+    def __init__(self, name, func, inputs=(), params=None, resources=None, after=(), files=(), cache=True,
+                 valid=None, state=None):
+        """
+        Parameters:
+        name (str): The name of the stage, unique within its pipeline.
+        func (callable): Called as func(*input_outputs, **params) to run the stage.
+        inputs (Iterable[str]): The stages whose outputs are passed to func, in order.
+        params (dict, optional): Keyword arguments of func that are part of its cache key. They must have a stable repr.
+        resources (dict, optional): Keyword arguments of func that are not, such as a database session.
+        after (Iterable[str]): Stages that must run first, without passing their outputs.
+        files (Iterable[str]): Files read by the stage, whose contents are part of its cache key.
+        cache (bool): Whether the output is cached. Defaults to True.
+        valid (callable, optional): Called with the cached output on a cache hit. If it returns False, the
+                                    stage runs again, e.g. because a snapshot it wrote has since been deleted.
+                                    The output is then loaded to check it, so it should be small, such as a path.
+        state (callable, optional): Called with no arguments, returns a fingerprint of the external state the
+                                    stage writes, such as database tables, as a string or number. The output of
+                                    such a stage is only cached by Pipeline.commit, once that state is committed,
+                                    along with the fingerprint, and a cache hit needs the fingerprint to still match.
+        """
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.params = params or {}
+        self.resources = resources or {}
+        self.after = list(after)
+        self.files = list(files)
+        self.cache = cache
+        self.valid = valid
+        self.state = state
+
+    @property
+    def upstream(self):
+        """Every stage this stage depends on."""
+        return self.inputs + [name for name in self.after if name not in self.inputs]
+
+
+def file_hash(path):
+    """Return the SHA-256 of a file's contents, or an empty string if the file does not exist."""
+    if not os.path.exists(path):
+        return ''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _func_fingerprint(func):
+    """Identify a function or module by its source, so editing a stage invalidates its cache."""
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        return f'{getattr(func, "__module__", "")}.{getattr(func, "__qualname__", repr(func))}'
+
+
+class Pipeline:
+    """
+    A DAG of stages, run on a thread pool with their outputs cached on disk.
+
+    Each stage's cache key hashes its function's source, the source of the modules the stages call into,
+    its parameters, the contents of the files it reads and the keys of its upstream stages, so a key only changes when something the stage depends
+    on does. On a run, stages whose key is already in the cache are skipped, and their outputs are
+    only loaded if a stage that does run needs them. Each output is pickled next to a small JSON file
+    holding the fingerprint of the state it was cached with, so a cache hit is decided without it. Stages whose upstream stages are done run
+    concurrently. The cache folder is kept under a size limit by evicting the least recently used outputs.
+    """
+
+    def __init__(self, cache_folder=CACHE_FOLDER, max_cache_bytes=CACHE_MAX_BYTES, max_workers=4, modules=()):
+        """
+        Parameters:
+        cache_folder (str): Where stage outputs are cached. Defaults to CACHE_FOLDER from constants module.
+        max_cache_bytes (int): The size the cache folder is trimmed to after a run. Defaults to CACHE_MAX_BYTES.
+        max_workers (int): The number of stages run at once. Defaults to 4.
+        modules (Iterable[module]): Modules the stages call into, whose source is part of every cache key,
+                                    so editing them invalidates the cache too.
+        """
+        self.cache_folder = cache_folder
+        self.max_cache_bytes = max_cache_bytes
+        self.max_workers = max_workers
+        self.modules = list(modules)
+        self.stages = {}
+        self.uncommitted = {}
+        self.peak_memory = {}
+        self.metrics = Instrumentation()
+
+    def add_stage(self, name, func, inputs=(), params=None, resources=None, after=(), files=(), cache=True,
+                  valid=None, state=None):
+        """
+        Add a stage, see Stage for the parameters. Upstream stages must be added first.
+
+        Raises:
+        PipelineError: If the name is taken or an upstream stage is unknown.
+        """
+        if name in self.stages:
+            raise PipelineError(f"Stage '{name}' already exists")
+        stage = Stage(name, func, inputs, params, resources, after, files, cache, valid, state)
+        missing = [upstream for upstream in stage.upstream if upstream not in self.stages]
+        if missing:
+            raise PipelineError(f"Stage '{name}' depends on unknown stages: {', '.join(missing)}")
+        self.stages[name] = stage
+        return stage
+
+    def keys(self):
+        """Return the cache key of every stage."""
+        keys = {}
+        file_hashes = {}
+        modules = hashlib.sha256()
+        for module in self.modules:
+            modules.update(_func_fingerprint(module).encode())
+        for name, stage in self.stages.items():
+            digest = hashlib.sha256()
+            digest.update(name.encode())
+            digest.update(modules.digest())
+            digest.update(_func_fingerprint(stage.func).encode())
+            digest.update(repr(sorted(stage.params.items())).encode())
+            for path in stage.files:
+                if path not in file_hashes:
+                    file_hashes[path] = file_hash(path)
+                digest.update(file_hashes[path].encode())
+            for upstream in stage.upstream:
+                digest.update(keys[upstream].encode())
+            keys[name] = digest.hexdigest()
+        return keys
+
+    def _cache_path(self, name, key):
+        return os.path.join(self.cache_folder, f'{name}-{key[:16]}.pkl')
+
+    @staticmethod
+    def _meta_path(cache_path):
+        return cache_path[:-len('.pkl')] + '.meta.json'
+
+    def _is_cached(self, stage, key, loaded):
+        """
+        Whether a stage's output is cached for its key and still valid. Only the metadata file is read,
+        unless the stage has a validity check, in which case the output it loads is kept in loaded.
+        """
+        path = self._cache_path(stage.name, key)
+        meta_path = self._meta_path(path)
+        if not stage.cache or not os.path.exists(path) or not os.path.exists(meta_path):
+            return False
+        if stage.state is not None:
+            with open(meta_path) as file:
+                if json.load(file)['state'] != stage.state():
+                    return False
+        if stage.valid is None:
+            return True
+        loaded[stage.name] = self._load(stage.name, key)
+        return bool(stage.valid(loaded[stage.name]))
+
+    def _load(self, name, key):
+        return pd.read_pickle(self._cache_path(name, key))
+
+    def _store(self, name, key, output, state=None):
+        """Cache a stage's output, then its metadata, so an entry with metadata is always complete."""
+        path = self._cache_path(name, key)
+        pd.to_pickle(output, path)
+        with open(self._meta_path(path), 'w') as file:
+            json.dump({'state': state}, file)
+
+    def commit(self):
+        """
+        Cache the outputs of the stages with external state that ran, with a fingerprint of that state.
+
+        Called by run, unless it was told the state is committed later, as by a database session.
+        """
+        for name, (output, key) in self.uncommitted.items():
+            self._store(name, key, output, self.stages[name].state())
+        self.uncommitted = {}
+
+    def run(self, force=False, profile_memory=False, hotspots=0, commit=True):
+        """
+        Run the stages that are not cached, and those needed to feed them.
+
+        Parameters:
+        force (bool): Ignore the cache and run every stage. Defaults to False.
+        profile_memory (bool): Trace Python and NumPy allocations, recording in peak_memory how far above
+                               the memory held at its start each stage peaked. Stages then run one at a time,
+                               so each peak is their own. Defaults to False.
+        hotspots (int): When profiling memory, also record the source lines allocating the most memory
+                        still held at the end of each stage, up to this many. Defaults to 0.
+        commit (bool): Cache the outputs of the stages with external state at the end of the run. Pass False
+                       if that state is only committed later, and call commit once it is, so a failed run
+                       leaves no cache entries for state that was rolled back. Defaults to True.
+
+        Returns:
+        dict: The output of every stage that was run or whose cached output was loaded.
+        """
+        os.makedirs(self.cache_folder, exist_ok=True)
+        self.uncommitted = {}
+        keys = self.keys()
+        loaded = {}
+        cached = {name: not force and self._is_cached(stage, keys[name], loaded) for name, stage in self.stages.items()}
+
+        # Stages to run, plus the cached stages whose outputs they need
+        to_run = {name for name in self.stages if not cached[name]}
+        to_load = {upstream for name in to_run for upstream in self.stages[name].inputs if cached[upstream]}
+        self.metrics = Instrumentation(trace_memory=profile_memory, hotspots=hotspots)
+        for name in self.stages:
+            if cached[name]:
+                logging.info(f"Stage '{name}' is unchanged, skipping it")
+                self.metrics.skip(name)
+                os.utime(self._cache_path(name, keys[name]))  # Mark as recently used
+        outputs = {name: loaded[name] if name in loaded else self._load(name, keys[name]) for name in to_load}
+
+        tracing = profile_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        try:
+            self._schedule(to_run, outputs, keys, profile_memory)
+        finally:
+            if tracing:
+                tracemalloc.stop()
+            self.peak_memory = self.metrics.peak_memory()
+
+        if commit:
+            self.commit()
+        self.evict(keep=[self._cache_path(name, key) for name, key in keys.items()])
+        return outputs
+
+    def _schedule(self, to_run, outputs, keys, profile_memory):
+        """Run the given stages as their upstream stages finish, caching their outputs."""
+        pending = set(to_run)
+        running = {}
+        with ThreadPoolExecutor(max_workers=1 if profile_memory else self.max_workers) as executor:
+            while pending or running:
+                ready = [name for name in self.stages if name in pending
+                         and all(upstream not in pending and upstream not in running.values()
+                                 for upstream in self.stages[name].upstream)]
+                if profile_memory:
+                    # Start each stage only once the last one is done and cached, so its peak is its own
+                    ready = [] if running else ready[:1]
+                for name in ready:
+                    stage = self.stages[name]
+                    pending.discard(name)
+                    args = [outputs[upstream] for upstream in stage.inputs]
+                    running[executor.submit(self._run_measured, stage, args)] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        outputs[name] = future.result()
+                    except BaseException:
+                        # Let the stages already running finish, but start no more
+                        pending.clear()
+                        for other in running:
+                            other.cancel()
+                        raise
+                    stage = self.stages[name]
+                    if stage.cache and stage.state is not None:
+                        self.uncommitted[name] = (outputs[name], keys[name])
+                    elif stage.cache:
+                        self._store(name, keys[name], outputs[name])
+
+    def _run_measured(self, stage, args):
+        """Run a stage on the calling worker thread, recording its measurements in metrics."""
+        output = self.metrics.measure(stage.name, stage.func, args, {**stage.params, **stage.resources})
+        if self.metrics.trace_memory:
+            # Traced stages run one at a time, so the last record is this stage's
+            peak = self.metrics.records[-1]['peak_bytes']
+            logging.info(f"Stage '{stage.name}' peak memory: {peak / 2 ** 20:.1f} MiB")
+        return output
+
+    def evict(self, keep=()):
+        """
+        Delete the least recently used cached outputs until the cache folder fits in max_cache_bytes.
+
+        Parameters:
+        keep (Iterable[str]): Paths that are never deleted, such as the outputs of the current run.
+        """
+        keep = set(keep)
+        entries = []
+        total = 0
+        for file_name in os.listdir(self.cache_folder):
+            path = os.path.join(self.cache_folder, file_name)
+            if not os.path.isfile(path) or not path.endswith('.pkl'):
+                continue
+            # Each output is evicted along with its metadata file
+            files = [path]
+            if os.path.exists(self._meta_path(path)):
+                files.append(self._meta_path(path))
+            size = sum(os.path.getsize(file) for file in files)
+            total += size
+            if path not in keep:
+                entries.append((os.stat(path).st_mtime, size, files))
+
+        for _, size, files in sorted(entries):
+            if total <= self.max_cache_bytes:
+                break
+            for file in files:
+                os.remove(file)
+            total -= size
@@ -0,0 +1,216 @@
+import sys
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
+
+import db_operations as db_ops
+from constants import DB_PATH, QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_MAX_BYTES
+
+# The rows returned by the query service. They are immutable, so cached results can be shared between callers
+TopUser = namedtuple('TopUser', ['age_group', 'age_group_rank', 'id', 'email', 'user_score'])
+UserWidget = namedtuple('UserWidget', ['created_at', 'age_group', 'age_group_rank', 'user_score', 'location',
+                                       'widget_name', 'widget_amount'])
+
+# The statements behind each query, and sqlite3 keeps them prepared on each pooled connection. The top users are
+# read from the age_group_rankings table, which every run keeps current, walking its (age_group, user_score) index
+# one age group at a time: the k-th highest score of each group bounds its records with a rank up to k. The ranks
+# of a user's widgets are counted the same way, as the age_group_rank column of transformed_data is not rewritten
+# for records an incremental run leaves alone. Records are matched on the instant of created_at, whichever way it
+# was written. Only the emails and widgets are read from the transformed_data
+# table or view, by id, so the queries work on every export
+_QUERIES = {
+    'top_users': 'WITH RECURSIVE age_groups(age_group) AS ('
+                 ' SELECT MIN(age_group) FROM age_group_rankings'
+                 ' UNION ALL SELECT (SELECT MIN(age_group) FROM age_group_rankings WHERE age_group > age_groups.age_group)'
+                 ' FROM age_groups WHERE age_group IS NOT NULL) '
+                 'SELECT DISTINCT ranked.age_group, (SELECT COUNT(*) FROM age_group_rankings AS higher'
+                 ' WHERE higher.age_group = ranked.age_group AND higher.user_score > ranked.user_score) + 1 AS age_group_rank,'
+                 ' ranked.id, (SELECT email FROM transformed_data WHERE id = ranked.id LIMIT 1), ranked.user_score '
+                 'FROM age_groups JOIN age_group_rankings AS ranked ON ranked.age_group = age_groups.age_group '
+                 'WHERE ranked.user_score >= IFNULL((SELECT user_score FROM age_group_rankings'
+                 ' WHERE age_group = age_groups.age_group ORDER BY user_score DESC LIMIT 1 OFFSET ? - 1), -1e308) '
+                 'ORDER BY ranked.age_group, age_group_rank, ranked.id',
+    'ids_by_location': 'SELECT user_id FROM location_postings WHERE location = ? ORDER BY user_id',
+    'user_widgets': 'SELECT record.created_at, record.age_group, CASE WHEN ranked.id IS NOT NULL THEN'
+                    ' (SELECT COUNT(*) FROM age_group_rankings AS higher'
+                    ' WHERE higher.age_group = ranked.age_group AND higher.user_score > ranked.user_score) + 1 END,'
+                    ' record.user_score, record.location, record.widget_name, record.widget_amount '
+                    'FROM transformed_data AS record LEFT JOIN age_group_rankings AS ranked'
+                    ' ON ranked.id = record.id AND julianday(ranked.created_at) = julianday(record.created_at) '
+                    'WHERE record.id = ? ORDER BY record.created_at',
+}
+
+
+def _nbytes(value):
+    """Estimate the memory held by a result, counting shared values once per reference."""
+    size = sys.getsizeof(value)
+    if isinstance(value, tuple):
+        size += sum(_nbytes(item) for item in value)
+    return size
+
+
+class LRUCache:
+    """
+    A thread-safe mapping that evicts its least recently used entries beyond a number of entries or bytes.
+
+    Values larger than the byte limit on their own are not stored.
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_MAX_ENTRIES, max_bytes=QUERY_CACHE_MAX_BYTES):
+        """
+        Parameters:
+        max_entries (int): The most entries held. Defaults to QUERY_CACHE_MAX_ENTRIES from constants module.
+        max_bytes (int): The most bytes held, as estimated when each value is stored. Defaults to QUERY_CACHE_MAX_BYTES.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the value of a key, marking it as recently used, or default if it is not cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used entries until the cache is within its limits."""
+        size = _nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+                self.nbytes -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+class QueryService:
+    """
+    Cached read queries over the SQLite export for the common questions asked of it.
+
+    Results are kept in an LRU cache tagged with the run generation of the database, which every pipeline
+    run that changes the export increments when it commits (see db_operations.bump_generation). Each query
+    first reads the generation, a single-row lookup, and drops the whole cache if it has moved on, so a
+    repeated query is answered from memory and never returns data older than the last committed run.
+    Queries run on a pool of read-only connections, so they can be made from many threads and while a
+    pipeline run writes to the database.
+    """
+
+    def __init__(self, db_path=DB_PATH, pool_size=4, max_entries=QUERY_CACHE_MAX_ENTRIES,
+                 max_bytes=QUERY_CACHE_MAX_BYTES):
+        """
+        Parameters:
+        db_path (str): The path to the SQLite database, which must already exist. Defaults to DB_PATH from constants module.
+        pool_size (int): The number of pooled connections. Defaults to 4.
+        max_entries (int): The most results cached. Defaults to QUERY_CACHE_MAX_ENTRIES from constants module.
+        max_bytes (int): The most bytes of results cached. Defaults to QUERY_CACHE_MAX_BYTES from constants module.
+
+        Raises:
+        DatabaseError: If a database connection error occurs.
+        """
+        self.pool = db_ops.ReaderPool(db_path, size=pool_size)
+        self.cache = LRUCache(max_entries, max_bytes)
+        self.generation = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _query(self, name, params, row_type=None):
+        """Return the rows of a named query, from the cache if the database has not changed since they were read."""
+        with self.pool.connection() as conn:
+            try:
+                generation = db_ops.run_generation(conn)
+                with self._lock:
+                    if generation != self.generation:
+                        self.cache.clear()
+                        self.generation = generation
+                key = (name, params)
+                rows = self.cache.get(key)
+                if rows is not None:
+                    return rows
+                cursor = conn.execute(_QUERIES[name], params)
+                rows = tuple(row_type._make(row) for row in cursor) if row_type else tuple(row for row, in cursor)
+            except sqlite3.Error as e:
+                raise db_ops.DatabaseError(f"Database error: {e}")
+        # Only cache results read at the generation the cache holds, in case a run committed in between
+        with self._lock:
+            if generation == self.generation:
+                self.cache.put(key, rows)
+        return rows
+
+    def top_users(self, k=1):
+        """
+        Return the top k users of each age group by user_score, ties included.
+
+        Parameters:
+        k (int): The lowest age group rank returned. Defaults to 1.
+
+        Returns:
+        tuple: TopUser rows ordered by age group, rank and id, one per ranked record of each user, as ranks
+               are given by rank_users, but once for records of the same user with equal scores.
+
+        Raises:
+        DatabaseError: If a database error occurs.
+        """
+        return self._query('top_users', (k,), TopUser)
+
+    def ids_by_location(self, location):
+        """
+        Return the ids of the users at a location.
+
+        Parameters:
+        location (str): The location.
+
+        Returns:
+        tuple: The sorted user ids, empty if no user is at the location.
+
+        Raises:
+        DatabaseError: If a database error occurs.
+        """
+        return self._query('ids_by_location', (location,))
+
+    def user_widgets(self, user_id):
+        """
+        Return the widgets of a user, with the rank and score of each of the user's records.
+
+        Parameters:
+        user_id (str): The user id.
+
+        Returns:
+        tuple: UserWidget rows ordered by created_at, with None widget fields for records without widgets.
+               Ranks are read from the age group rankings, and None for a record missing from them.
+               Empty for unknown users.
+
+        Raises:
+        DatabaseError: If a database error occurs.
+        """
+        return self._query('user_widgets', (user_id,), UserWidget)
+
+    def close(self):
+        """Drop the cache and close the pooled connections."""
+        self.cache.clear()
+        self.pool.close()
@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+
+# The columns keying a record, as in deduplication and the upsert of the transformed_data table
+KEY_COLUMNS = ['id', 'created_at']
+
+
+class AgeGroupRankings:
+    """
+    Order statistics of user_score within each age_group, maintained under inserts, score updates and deletes.
+
+    Records are keyed on (id, created_at), as rank_users ranks every deduplicated record, so a user with
+    several records holds one entry per record. Each age group keeps its records' scores in an ascending
+    sorted array, with a parallel array of record keys, and a dict maps each key to its age group and
+    score. A record's rank or a group's top k are then read with a binary search or a slice, in
+    logarithmic time or O(k), without re-sorting. Changes are applied a batch at a time, costing one
+    array insert or delete per age group per batch.
+
+    Ranks follow rank_users: one more than the number of strictly higher scores in the same age group.
+    """
+
+    def __init__(self):
+        self._scores = {}
+        self._keys = {}
+        self._records = {}
+        self._changed = set()
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        Build the rankings of every record in the data.
+
+        Parameters:
+        data (pd.DataFrame): The data, with 'id', 'created_at', 'age_group' and 'user_score' columns.
+
+        Returns:
+        AgeGroupRankings: The rankings.
+        """
+        rankings = cls()
+        rankings.upsert(data)
+        return rankings
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, key):
+        return self._key(*key) in self._records
+
+    @property
+    def age_groups(self):
+        """The age groups holding at least one record, in ascending order."""
+        return sorted(age_group for age_group, scores in self._scores.items() if len(scores))
+
+    @staticmethod
+    def _key(user_id, created_at):
+        """Return the key of a record, with created_at as a UTC timestamp whether it was given as one or as text."""
+        timestamp = pd.Timestamp(created_at)
+        return user_id, timestamp.tz_convert('UTC') if timestamp.tzinfo else timestamp.tz_localize('UTC')
+
+    @staticmethod
+    def _keys_of(data):
+        """Return the key of each row of the data as an object array of tuples."""
+        created_at = pd.to_datetime(data['created_at'], utc=True)
+        return pd.MultiIndex.from_arrays([data['id'], created_at]).to_numpy()
+
+    def upsert(self, data):
+        """
+        Insert new records and move existing records to their new age group and score.
+
+        Parameters:
+        data (pd.DataFrame): The data, with 'id', 'created_at', 'age_group' and 'user_score' columns, e.g. the
+                             flattened data. If a record appears more than once, its last row wins.
+
+        Raises:
+        ValueError: If required columns are missing.
+        """
+        required_columns = KEY_COLUMNS + ['age_group', 'user_score']
+        if not all(col in data.columns for col in required_columns):
+            raise ValueError(f"Missing required columns: {', '.join(required_columns)}")
+
+        records = data[required_columns].assign(key=self._keys_of(data)).drop_duplicates(subset='key', keep='last')
+        self._remove([key for key in records['key'] if key in self._records])
+
+        for age_group, group in records.groupby('age_group', sort=False):
+            # Sort the new entries descending and insert each before the equal scores already present,
+            # so equal scores keep their arrival order when read from the top
+            order = np.lexsort((np.arange(len(group))[::-1], group['user_score'].to_numpy(dtype=float)))
+            new_scores = group['user_score'].to_numpy(dtype=float)[order]
+            new_keys = group['key'].to_numpy(dtype=object)[order]
+            scores = self._scores.get(age_group, np.empty(0))
+            positions = np.searchsorted(scores, new_scores, side='left')
+            self._scores[age_group] = np.insert(scores, positions, new_scores)
+            self._keys[age_group] = np.insert(self._keys.get(age_group, np.empty(0, dtype=object)), positions, new_keys)
+            self._records.update(zip(new_keys, zip([age_group] * len(new_keys), new_scores)))
+        self._changed.update(records['key'])
+
+    def delete(self, keys):
+        """
+        Remove records from the rankings. Unknown records are ignored.
+
+        Parameters:
+        keys (Iterable[tuple]): The (id, created_at) keys of the records to remove.
+        """
+        keys = [key for key in (self._key(*key) for key in keys) if key in self._records]
+        self._remove(keys)
+        self._changed.update(keys)
+
+    def _remove(self, keys):
+        """Remove known records from the sorted arrays and the record dict."""
+        positions = {}
+        for key in keys:
+            age_group, score = self._records.pop(key)
+            scores, group_keys = self._scores[age_group], self._keys[age_group]
+            start, end = np.searchsorted(scores, score, side='left'), np.searchsorted(scores, score, side='right')
+            # Compared one by one, as numpy would compare a tuple with the array element-wise
+            offset = next(i for i, group_key in enumerate(group_keys[start:end]) if group_key == key)
+            positions.setdefault(age_group, []).append(start + offset)
+        for age_group, group_positions in positions.items():
+            self._scores[age_group] = np.delete(self._scores[age_group], group_positions)
+            self._keys[age_group] = np.delete(self._keys[age_group], group_positions)
+
+    def rank(self, user_id, created_at):
+        """
+        Return the rank of a record within its age group.
+
+        Raises:
+        KeyError: If the record is not in the rankings.
+        """
+        age_group, score = self._records[self._key(user_id, created_at)]
+        scores = self._scores[age_group]
+        return len(scores) - int(np.searchsorted(scores, score, side='right')) + 1
+
+    def top_k(self, age_group, k):
+        """
+        Return the k highest scoring records of an age group.
+
+        Returns:
+        pd.DataFrame: The 'id', 'created_at' and 'user_score' of up to k records, highest score first.
+        """
+        scores = self._scores.get(age_group, np.empty(0))
+        keys = self._keys.get(age_group, np.empty(0, dtype=object))
+        start = max(len(scores) - k, 0)
+        return self._frame(keys[start:][::-1], {'user_score': scores[start:][::-1]})
+
+    def score_index(self):
+        """
+        Return the sorted scores of each age group, in the form dp.rank_users accepts as its score_index.
+
+        The arrays are the rankings' own and must not be modified.
+        """
+        return {age_group: scores for age_group, scores in self._scores.items() if len(scores)}
+
+    def to_frame(self):
+        """
+        Return every record of the rankings.
+
+        Returns:
+        pd.DataFrame: The 'id', 'created_at', 'age_group' and 'user_score' of each record.
+        """
+        return self._frame(list(self._records), self._columns(self._records.values()))
+
+    def pop_changes(self):
+        """
+        Return the records changed since the last call, so only they need to be persisted.
+
+        Returns:
+        tuple: A DataFrame of the 'id', 'created_at', 'age_group' and 'user_score' of inserted or updated
+               records, and a list of the (id, created_at) keys of deleted records.
+        """
+        changed, self._changed = self._changed, set()
+        upserted = [key for key in changed if key in self._records]
+        deleted = [key for key in changed if key not in self._records]
+        return self._frame(upserted, self._columns(self._records[key] for key in upserted)), deleted
+
+    @staticmethod
+    def _columns(entries):
+        """Split (age_group, user_score) entries into columns."""
+        entries = list(entries)
+        return {'age_group': [age_group for age_group, _ in entries], 'user_score': [score for _, score in entries]}
+
+    @staticmethod
+    def _frame(keys, columns):
+        """Return a DataFrame of the id and created_at of each key, followed by the given columns."""
+        return pd.DataFrame({'id': [user_id for user_id, _ in keys],
+                             'created_at': pd.DatetimeIndex([created_at for _, created_at in keys], tz='UTC'),
+                             **columns})
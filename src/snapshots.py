@@ -0,0 +1,346 @@
+import os
+import json
+import uuid
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class SnapshotFormatError(Exception):
+    """An exception class for unknown or unreadable snapshot formats."""
+
+
+# Registry of snapshot formats: name -> (file extension, writer, reader)
+SNAPSHOT_FORMATS = {}
+
+
+def register_snapshot_format(name, extension, writer, reader):
+    """
+    Register a snapshot format so export_snapshot and load_from_staging can use it.
+
+    Parameters:
+    name (str): The name of the format, as passed to export_snapshot.
+    extension (str): The file extension identifying snapshots of this format, including the dot.
+    writer (callable): Called as writer(data, path) to write a snapshot.
+    reader (callable): Called as reader(path, mmap) to read a snapshot back into a DataFrame.
+    """
+    SNAPSHOT_FORMATS[name] = (extension, writer, reader)
+
+
+def get_snapshot_format(name):
+    """
+    Look up a registered snapshot format by name.
+
+    Parameters:
+    name (str): The name of the format.
+
+    Returns:
+    tuple: The (extension, writer, reader) of the format.
+
+    Raises:
+    SnapshotFormatError: If no format is registered under the name.
+    """
+    try:
+        return SNAPSHOT_FORMATS[name]
+    except KeyError:
+        raise SnapshotFormatError(f"Unknown snapshot format '{name}', expected one of: {', '.join(SNAPSHOT_FORMATS)}")
+
+
+def detect_snapshot_format(path):
+    """
+    Find the registered snapshot format of a file from its extension.
+
+    Parameters:
+    path (str): The path of the snapshot.
+
+    Returns:
+    tuple: The (extension, writer, reader) of the format.
+
+    Raises:
+    SnapshotFormatError: If the extension does not match any registered format.
+    """
+    for extension, writer, reader in SNAPSHOT_FORMATS.values():
+        if path.endswith(extension):
+            return extension, writer, reader
+    raise SnapshotFormatError(f"No snapshot format registered for {path}")
+
+
+def write_csv(data, path):
+    """Write a snapshot as CSV, without the index."""
+    data.to_csv(path, index=False)
+
+
+def read_csv(path, mmap=False):
+    """Read a CSV snapshot. CSV has no schema, so types are inferred again on read."""
+    return pd.read_csv(path)
+
+
+def write_csv_gz(data, path):
+    """Write a snapshot as gzip-compressed CSV, without the index."""
+    data.to_csv(path, index=False, compression='gzip')
+
+
+def read_csv_gz(path, mmap=False):
+    """Read a gzip-compressed CSV snapshot."""
+    return pd.read_csv(path, compression='gzip')
+
+
+def write_npy(data, path):
+    """
+    Write a snapshot as a directory of NumPy arrays, one per column, alongside a schema.json.
+
+    Numeric and datetime columns are written as raw arrays, so they can be memory-mapped
+    on read. String columns are written as fixed-width unicode arrays, and columns holding
+    lists or dicts (such as widget_list) as JSON text. The index is not stored.
+    """
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    def save(file_name, values, allow_pickle):
+        np.save(os.path.join(path, file_name), values, allow_pickle=allow_pickle)
+
+    schema = _write_columns(data, save)
+    with open(os.path.join(path, 'schema.json'), 'w') as file:
+        json.dump(schema, file, indent=2)
+
+
+def read_npy(path, mmap=True):
+    """
+    Read a snapshot written by write_npy, restoring the stored column types.
+
+    Numeric, datetime and categorical columns are backed by memory-mapped arrays when mmap
+    is set, so reading them is close to free until the data is used. String and JSON
+    columns are decoded into Python objects.
+    """
+    try:
+        with open(os.path.join(path, 'schema.json')) as file:
+            schema = json.load(file)
+    except (OSError, ValueError) as e:
+        raise SnapshotFormatError(f"Unable to read snapshot schema from {path}: {e}")
+
+    def load(file_name, allow_pickle):
+        return np.load(os.path.join(path, file_name), mmap_mode='r' if mmap and not allow_pickle else None,
+                       allow_pickle=allow_pickle)
+
+    return _read_columns(schema, load)
+
+
+def write_npz(data, path):
+    """
+    Write a snapshot as a single compressed .npz archive of the arrays write_npy writes.
+
+    The archive is smaller than an 'npy' snapshot, but is decompressed in full on read.
+    """
+    arrays = {}
+
+    def save(file_name, values, allow_pickle):
+        arrays[file_name] = values
+
+    schema = _write_columns(data, save)
+    with open(path, 'wb') as file:
+        np.savez_compressed(file, **arrays, **{'schema.json': np.array(json.dumps(schema))})
+
+
+def read_npz(path, mmap=False):
+    """Read a snapshot written by write_npz. Nothing is memory-mapped, the arrays being compressed."""
+    try:
+        archive = np.load(path, allow_pickle=True)
+        schema = json.loads(str(archive['schema.json']))
+    except (OSError, ValueError, KeyError) as e:
+        raise SnapshotFormatError(f"Unable to read snapshot schema from {path}: {e}")
+
+    with archive:
+        return _read_columns(schema, lambda file_name, allow_pickle: archive[file_name])
+
+
+def _write_columns(data, save):
+    """
+    Encode each column of the data as arrays, passing them to save(file_name, values, allow_pickle).
+
+    Returns:
+    dict: The schema describing how to decode the arrays.
+    """
+    schema = {'columns': []}
+    for position, (name, series) in enumerate(data.items()):
+        file_name = f'{position}.npy'
+        column = {'name': name, 'file': file_name, 'dtype': str(series.dtype)}
+
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            column['kind'] = 'category'
+            column['ordered'] = bool(series.cat.ordered)
+            column['categories'] = f'{position}.categories.npy'
+            save(file_name, series.cat.codes.to_numpy(), False)
+            categories = series.cat.categories.to_numpy()
+            save(column['categories'], categories.astype(str) if categories.dtype == object else categories, False)
+        elif isinstance(series.dtype, pd.DatetimeTZDtype):
+            column['kind'] = 'datetime'
+            column['tz'] = str(series.dt.tz)
+            save(file_name, series.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy(), False)
+        elif isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biufcmM':
+            column['kind'] = 'numeric'
+            save(file_name, series.to_numpy(), False)
+        else:
+            values = series.to_numpy(dtype=object)
+            mask = pd.isna(series).to_numpy()
+            present = values[~mask]
+            if all(isinstance(value, str) for value in present):
+                column['kind'] = 'string'
+                encoded = np.where(mask, '', values).astype(str)
+            elif all(isinstance(value, (list, dict, str, int, float, bool)) for value in present):
+                column['kind'] = 'json'
+                encoded = np.array([json.dumps(value) if not missing else '' for value, missing in zip(values, mask)], dtype=str)
+            else:
+                column['kind'] = 'object'
+                encoded = values
+            save(file_name, encoded, column['kind'] == 'object')
+            if mask.any() and column['kind'] != 'object':
+                column['mask'] = f'{position}.mask.npy'
+                # Remember whether missing values were None or NaN, e.g. extract_widget_info gives None
+                column['missing'] = None if values[mask][0] is None else 'nan'
+                save(column['mask'], mask, False)
+
+        schema['columns'].append(column)
+    return schema
+
+
+def _read_columns(schema, load):
+    """Decode the columns described by a schema from the arrays returned by load(file_name, allow_pickle)."""
+    columns = {}
+    for column in schema['columns']:
+        kind = column['kind']
+        values = load(column['file'], kind == 'object')
+
+        if kind == 'category':
+            categories = load(column['categories'], False)
+            if categories.dtype.kind == 'U':
+                categories = categories.astype(object)
+            columns[column['name']] = pd.Categorical.from_codes(values, categories=categories, ordered=column['ordered'])
+        elif kind == 'datetime':
+            unit = np.datetime_data(values.dtype)[0]
+            columns[column['name']] = pd.arrays.DatetimeArray(values, dtype=pd.DatetimeTZDtype(unit=unit, tz='UTC'), copy=False)\
+                                        .tz_convert(column['tz'])
+        elif kind == 'numeric':
+            columns[column['name']] = values
+        else:
+            if kind == 'json':
+                decoded = np.empty(len(values), dtype=object)
+                for i, value in enumerate(values):
+                    decoded[i] = json.loads(value) if value else None
+                values = decoded
+            else:
+                values = values.astype(object)
+            if 'mask' in column:
+                values[load(column['mask'], False)] = np.nan if column['missing'] else None
+            columns[column['name']] = values
+
+    return pd.DataFrame(columns, columns=[column['name'] for column in schema['columns']], copy=False)
+
+
+register_snapshot_format('csv', '.csv', write_csv, read_csv)
+register_snapshot_format('csv.gz', '.csv.gz', write_csv_gz, read_csv_gz)
+register_snapshot_format('npy', '.npsnap', write_npy, read_npy)
+register_snapshot_format('npz', '.npz', write_npz, read_npz)
+
+
+def write_snapshot(data, path, fmt):
+    """
+    Write a snapshot atomically: it is written under a temporary name in the same folder, then
+    renamed into place, so a reader never sees a partly written snapshot at path.
+
+    Parameters:
+    data (pd.DataFrame): The data.
+    path (str): The path of the snapshot.
+    fmt (str): The name of a registered snapshot format.
+
+    Returns:
+    str: The path of the snapshot.
+
+    Raises:
+    SnapshotFormatError: If the format is not registered.
+    """
+    _, writer, _ = get_snapshot_format(fmt)
+    folder, file_name = os.path.split(path)
+    temp_path = os.path.join(folder, f'.{file_name}.{uuid.uuid4().hex}.tmp')
+    try:
+        writer(data, temp_path)
+        if os.path.isdir(path):
+            shutil.rmtree(path)  # A directory can only be renamed over an empty one
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.isdir(temp_path):
+            shutil.rmtree(temp_path, ignore_errors=True)
+        elif os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return path
+
+
+class SnapshotWriter:
+    """
+    Writes snapshots on a background thread pool, so the pipeline does not wait on disk I/O.
+
+    Each snapshot is written atomically by write_snapshot. The data passed to submit is written as it
+    is when the write runs, so it must not be modified until then. flush waits for every submitted
+    write, raising the first error, and is called when the writer is used as a context manager exits.
+    """
+
+    def __init__(self, max_workers=2):
+        """
+        Parameters:
+        max_workers (int): The number of snapshots written at once. Defaults to 2.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='snapshot')
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            # Still wait for the writes if the run failed, but let its error propagate
+            if exc_type is None:
+                self.flush()
+            else:
+                wait(self._futures)
+        finally:
+            self._executor.shutdown()
+
+    def submit(self, data, path, fmt):
+        """
+        Start writing a snapshot in the background.
+
+        Parameters:
+        data (pd.DataFrame): The data.
+        path (str): The path of the snapshot.
+        fmt (str): The name of a registered snapshot format.
+
+        Returns:
+        concurrent.futures.Future: Resolves to the path once the snapshot is written.
+
+        Raises:
+        SnapshotFormatError: If the format is not registered.
+        """
+        get_snapshot_format(fmt)
+        future = self._executor.submit(write_snapshot, data, path, fmt)
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def flush(self):
+        """
+        Wait for every snapshot submitted so far to be written.
+
+        Returns:
+        list: The paths of the snapshots written since the last flush.
+
+        Raises:
+        Exception: The first error raised by a write, once every write has finished.
+        """
+        with self._lock:
+            futures, self._futures = self._futures, []
+        wait(futures)
+        return [future.result() for future in futures]
@@ -0,0 +1,427 @@
+import os
+import json
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from constants import DATA_QUALITY_SEMANTIC_TYPES, VALIDATION_PATTERNS, VALIDATION_CHUNKSIZE, PIPELINE_SCHEMA
+
+# Number of unexpected values listed in each result, as in Great Expectations' BASIC result format
+PARTIAL_UNEXPECTED_COUNT = 20
+
+# Python types matched by the native type names Great Expectations accepts in a type_list
+NATIVE_TYPES = {
+    'str': [str], 'string': [str], 'int': [int], 'integer': [int], 'float': [float],
+    'bool': [bool], 'boolean': [bool], 'list': [list], 'dict': [dict],
+}
+
+
+class ValidationError(Exception):
+    """An exception class for data failing validation and expectation suites that cannot be read."""
+
+
+def default_expectations(semantic_types=DATA_QUALITY_SEMANTIC_TYPES, patterns=VALIDATION_PATTERNS, schema=PIPELINE_SCHEMA):
+    """
+    Build the expectations every raw data set must meet, from the semantic type of each column.
+
+    Every column must be non-null and of its semantic type, with nested columns (such as widget_list)
+    holding lists, and string columns must match their pattern if they have one.
+
+    Parameters:
+    semantic_types (dict): The columns of each semantic type. Defaults to DATA_QUALITY_SEMANTIC_TYPES from constants module.
+    patterns (dict): The regular expression each string column must match. Defaults to VALIDATION_PATTERNS.
+    schema (dict): The pipeline schema, telling nested columns apart. Defaults to PIPELINE_SCHEMA.
+
+    Returns:
+    list: The expectation configurations, as dicts of 'expectation_type' and 'kwargs'.
+    """
+    type_lists = {'string': ['str'], 'numeric': ['int', 'int8', 'int16', 'int32', 'float', 'float32'], 'datetime': ['datetime64', 'Timestamp']}
+    expectations = []
+    for semantic_type, columns in semantic_types.items():
+        for column in columns:
+            type_list = ['list'] if schema.get(column) == 'nested' else type_lists[semantic_type]
+            expectations.append(_config('expect_column_values_to_not_be_null', column=column))
+            expectations.append(_config('expect_column_values_to_be_in_type_list', column=column, type_list=type_list))
+    for column, pattern in patterns.items():
+        expectations.append(_config('expect_column_values_to_match_regex', column=column, regex=pattern))
+    return expectations
+
+
+def load_expectations(suite_path, excluded=()):
+    """
+    Read the expectations of an expectation suite saved as JSON, without loading Great Expectations.
+
+    Parameters:
+    suite_path (str): The path of the suite, as saved by profiler.load_expectation_suite.
+    excluded (Iterable[str]): Expectation types to leave out, such as those pinned to the aggregates of
+                              the profiled data by suites saved before they were excluded from profiling.
+
+    Returns:
+    list: The expectation configurations.
+
+    Raises:
+    ValidationError: If the suite cannot be read.
+    """
+    try:
+        with open(suite_path) as file:
+            expectations = _read_expectations(json.load(file))[1]
+    except (OSError, ValueError) as e:
+        raise ValidationError(f"Unable to read expectation suite from {suite_path}: {e}")
+    excluded = set(excluded)
+    return [config for config in expectations if config['expectation_type'] not in excluded]
+
+
+def failures(results):
+    """
+    Summarize the failed expectations of a validation result, one line per expectation.
+
+    Parameters:
+    results (dict): A result of validate, or of Great Expectations as a JSON dict.
+
+    Returns:
+    list: A description of each failed expectation.
+    """
+    descriptions = []
+    for result in results['results']:
+        if result['success']:
+            continue
+        config, details = result['expectation_config'], result['result']
+        column = config['kwargs'].get('column')
+        if result['exception_info']['raised_exception']:
+            outcome = result['exception_info']['exception_message']
+        elif 'unexpected_count' in details:
+            outcome = f"{details['unexpected_count']} unexpected values, e.g. {details['partial_unexpected_list'][:3]}"
+        else:
+            outcome = f"observed {details.get('observed_value')}"
+        descriptions.append(f"{config['expectation_type']}{f' on {column}' if column else ''}: {outcome}")
+    return descriptions
+
+
+def validate(data, expectations=None, chunksize=VALIDATION_CHUNKSIZE, max_workers=None):
+    """
+    Validate the data against expectations, without Great Expectations.
+
+    Expectations on individual values (nulls, types, ranges, sets and patterns) and on the number of distinct
+    values are checked with vectorized pandas operations over chunks of chunksize rows, in parallel on a
+    process pool started from a fork server. Distinct values are counted by their 64-bit hashes, merged across chunks. Other expectations
+    on whole columns (min, max, mean, median, quantiles) and on the table are computed once over the full
+    columns, matching Great Expectations' results exactly. Results follow Great Expectations' validation result and BASIC result format, so either
+    can be read the same way.
+
+    Parameters:
+    data (pd.DataFrame): The data to validate.
+    expectations (optional): An ExpectationSuite, its JSON dict, or a list of expectation configurations.
+                             Defaults to default_expectations().
+    chunksize (int): The number of rows checked per task. Defaults to VALIDATION_CHUNKSIZE from constants module.
+    max_workers (int, optional): The number of processes. Defaults to the number of CPUs, with no pool for a single chunk.
+
+    Returns:
+    dict: The validation result, with 'success', 'results', 'statistics' and 'meta'.
+
+    Raises:
+    ValidationError: If the expectations cannot be read.
+    """
+    suite_name, configs = _read_expectations(expectations)
+    chunked = [_is_chunked(data, config) for config in configs]
+    chunk_configs = [config for config, is_chunked in zip(configs, chunked) if is_chunked]
+
+    # Check the chunked expectations chunk by chunk, in parallel if there is more than one chunk
+    bounds = [(start, min(start + chunksize, len(data))) for start in range(0, len(data), chunksize)] or [(0, 0)]
+    workers = min(max_workers or os.cpu_count() or 1, len(bounds))
+    if workers > 1 and chunk_configs:
+        # Validation runs on a pipeline thread, and forking a process with other threads running can copy a
+        # lock one of them holds, so workers are started from a single-threaded fork server instead, and
+        # each is sent its chunk, holding only the columns checked chunk by chunk
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        columns = list(dict.fromkeys(config['kwargs']['column'] for config in chunk_configs))
+        chunks = (data.iloc[start:end][columns] for start, end in bounds)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            partials = list(executor.map(_check_chunk, chunks, [chunk_configs] * len(bounds)))
+    else:
+        partials = [_check_chunk(data.iloc[start:end], chunk_configs) for start, end in bounds]
+    chunk_results = iter(_merge_partials(chunk_configs, partials))
+
+    results = []
+    for config, is_chunked in zip(configs, chunked):
+        result = next(chunk_results) if is_chunked else _check_aggregate(data, config)
+        results.append(result)
+
+    successful = sum(result['success'] for result in results)
+    return {
+        'success': successful == len(results),
+        'results': results,
+        'evaluation_parameters': {},
+        'statistics': {
+            'evaluated_expectations': len(results),
+            'successful_expectations': successful,
+            'unsuccessful_expectations': len(results) - successful,
+            'success_percent': 100.0 * successful / len(results) if results else None,
+        },
+        'meta': {'expectation_suite_name': suite_name, 'engine': 'native', 'chunks': len(bounds), 'workers': workers},
+    }
+
+
+def _config(expectation_type, **kwargs):
+    return {'expectation_type': expectation_type, 'kwargs': kwargs, 'meta': {}}
+
+
+def _read_expectations(expectations):
+    """Return the suite name and the expectation configurations of the accepted kinds of expectations."""
+    if expectations is None:
+        return 'default', default_expectations()
+    if hasattr(expectations, 'to_json_dict'):
+        expectations = expectations.to_json_dict()
+    if isinstance(expectations, dict):
+        suite_name = expectations.get('expectation_suite_name', 'default')
+        expectations = expectations.get('expectations')
+    else:
+        suite_name = 'default'
+    if not isinstance(expectations, list) or \
+       not all(isinstance(config, dict) and 'expectation_type' in config for config in expectations):
+        raise ValidationError("Expected an expectation suite or a list of expectation configurations")
+    return suite_name, [_config(config['expectation_type'], **config.get('kwargs', {})) for config in expectations]
+
+
+def _is_chunked(data, config):
+    """Whether an expectation is checked value by value or on distinct values, so it can be checked chunk by chunk."""
+    expectation_type, column = config['expectation_type'], config['kwargs'].get('column')
+    if column not in data.columns:
+        return False
+    if expectation_type == 'expect_column_values_to_be_in_type_list':
+        return data[column].dtype == object
+    return expectation_type in MAP_EXPECTATIONS or expectation_type in DISTINCT_EXPECTATIONS
+
+
+def _resolve_types(type_list):
+    """Resolve the type names of a type_list to types, as Great Expectations does for pandas."""
+    types = []
+    for type_name in type_list:
+        try:
+            types.append(np.dtype(type_name).type)
+        except (TypeError, ValueError):
+            for namespace in (pd, pd.core.dtypes.dtypes):
+                candidate = getattr(namespace, type_name, None)
+                if isinstance(candidate, type):
+                    types.append(candidate)
+        types.extend(NATIVE_TYPES.get(type_name, []))
+    return tuple(types)
+
+
+def _unexpected_types(values, type_list):
+    types = _resolve_types(type_list)
+    # All strings is the common case, recognized without looking at each value
+    if str in types and pd.api.types.infer_dtype(values, skipna=True) == 'string':
+        return np.zeros(len(values), dtype=bool)
+    return ~np.fromiter((isinstance(value, types) for value in values), dtype=bool, count=len(values))
+
+
+def _unexpected_between(values, min_value=None, max_value=None, strict_min=False, strict_max=False, **kwargs):
+    if isinstance(values.dtype, pd.DatetimeTZDtype) or values.dtype.kind == 'M':
+        min_value = pd.Timestamp(min_value) if min_value is not None else None
+        max_value = pd.Timestamp(max_value) if max_value is not None else None
+    unexpected = np.zeros(len(values), dtype=bool)
+    if min_value is not None:
+        unexpected |= (values <= min_value if strict_min else values < min_value).to_numpy()
+    if max_value is not None:
+        unexpected |= (values >= max_value if strict_max else values > max_value).to_numpy()
+    return unexpected
+
+
+# Value by value expectations: each returns a mask of the unexpected non-null values
+MAP_EXPECTATIONS = {
+    'expect_column_values_to_be_in_type_list': lambda values, type_list, **kwargs: _unexpected_types(values, type_list),
+    'expect_column_values_to_be_between': _unexpected_between,
+    'expect_column_values_to_be_in_set':
+        lambda values, value_set, **kwargs: ~values.isin(value_set).to_numpy(),
+    'expect_column_values_to_not_be_in_set':
+        lambda values, value_set, **kwargs: values.isin(value_set).to_numpy(),
+    'expect_column_values_to_match_regex':
+        lambda values, regex, **kwargs: ~_as_text(values).str.contains(regex, regex=True).to_numpy(dtype=bool),
+    'expect_column_values_to_not_match_regex':
+        lambda values, regex, **kwargs: _as_text(values).str.contains(regex, regex=True).to_numpy(dtype=bool),
+    'expect_column_value_lengths_to_be_between':
+        lambda values, min_value=None, max_value=None, **kwargs: _unexpected_between(values.str.len(), min_value, max_value),
+    'expect_column_values_to_not_be_null': None,
+}
+
+# Expectations on the number of distinct values, counted from the hashes of each chunk's distinct values
+DISTINCT_EXPECTATIONS = {
+    'expect_column_proportion_of_unique_values_to_be_between',
+    'expect_column_unique_value_count_to_be_between',
+}
+
+
+def _as_text(values):
+    """
+    Return the values as text, leaving them as they are. pandas can write the converted strings back into an
+    object column unpickled in a worker, which would then list its unexpected values as text.
+    """
+    return values.copy().astype(str)
+
+
+def _check_chunk(chunk, configs):
+    """Return the element, missing and unexpected counts, or the distinct value hashes, of each expectation over a chunk."""
+    partials = []
+    for config in configs:
+        expectation_type, kwargs = config['expectation_type'], dict(config['kwargs'])
+        column = chunk[kwargs.pop('column')]
+        missing = column.isna().to_numpy()
+        partial = {'element_count': len(column), 'missing_count': int(missing.sum()), 'exception': None}
+        try:
+            if expectation_type in DISTINCT_EXPECTATIONS:
+                partial['hashes'] = np.unique(_hash_values(column[~missing]))
+                partials.append(partial)
+                continue
+            if expectation_type == 'expect_column_values_to_not_be_null':
+                unexpected_values = column[missing]
+            else:
+                kwargs.pop('mostly', None)
+                values = column[~missing]
+                unexpected_values = values[MAP_EXPECTATIONS[expectation_type](values, **kwargs)]
+            partial['unexpected_count'] = len(unexpected_values)
+            partial['partial_unexpected_list'] = unexpected_values.iloc[:PARTIAL_UNEXPECTED_COUNT].tolist()
+        except Exception as e:
+            partial['exception'] = f'{type(e).__name__}: {e}'
+        partials.append(partial)
+    return partials
+
+
+def _hash_values(values):
+    """Hash values to 64 bits, hashing unhashable values such as lists by their text."""
+    if values.dtype == object and len(values) and not all(isinstance(value, (str, int, float, bool)) for value in values.iloc[:100]):
+        values = values.astype(str)
+    return pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+
+def _merge_partials(configs, chunk_partials):
+    """Combine the per chunk partial results of each chunked expectation into its result."""
+    results = []
+    for position, config in enumerate(configs):
+        partials = [chunk[position] for chunk in chunk_partials]
+        exceptions = [partial['exception'] for partial in partials if partial['exception']]
+        if exceptions:
+            results.append(_result(config, False, exception=exceptions[0]))
+            continue
+
+        element_count = sum(partial['element_count'] for partial in partials)
+        missing_count = sum(partial['missing_count'] for partial in partials)
+        if config['expectation_type'] in DISTINCT_EXPECTATIONS:
+            unique_count = len(np.unique(np.concatenate([partial['hashes'] for partial in partials])))
+            nonnull_count = element_count - missing_count
+            if config['expectation_type'] == 'expect_column_unique_value_count_to_be_between':
+                observed = unique_count
+            else:
+                observed = unique_count / nonnull_count if nonnull_count else None
+            bounds = {key: config['kwargs'].get(key) for key in ('min_value', 'max_value', 'strict_min', 'strict_max')}
+            results.append(_result(config, _between(observed, **bounds), {'observed_value': observed}))
+            continue
+
+        unexpected_count = sum(partial['unexpected_count'] for partial in partials)
+        nonmissing_count = element_count - missing_count
+        if config['expectation_type'] == 'expect_column_values_to_not_be_null':
+            nonmissing_count = element_count
+        partial_unexpected_list = [value for partial in partials for value in partial['partial_unexpected_list']]
+
+        unexpected_ratio = unexpected_count / nonmissing_count if nonmissing_count else 0.0
+        result = {
+            'element_count': element_count,
+            'unexpected_count': unexpected_count,
+            'unexpected_percent': 100.0 * unexpected_ratio,
+            'partial_unexpected_list': partial_unexpected_list[:PARTIAL_UNEXPECTED_COUNT],
+        }
+        if config['expectation_type'] != 'expect_column_values_to_not_be_null':
+            result['missing_count'] = missing_count
+            result['missing_percent'] = 100.0 * missing_count / element_count if element_count else None
+        mostly = config['kwargs'].get('mostly')
+        success = unexpected_count == 0 if mostly is None else 1 - unexpected_ratio >= mostly
+        results.append(_result(config, success, result))
+    return results
+
+
+def _between(value, min_value=None, max_value=None, strict_min=False, strict_max=False):
+    """Whether a value lies within optional, inclusive unless strict, bounds."""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return False
+    if isinstance(value, pd.Timestamp):
+        min_value = pd.Timestamp(min_value) if min_value is not None else None
+        max_value = pd.Timestamp(max_value) if max_value is not None else None
+    above = min_value is None or (value > min_value if strict_min else value >= min_value)
+    below = max_value is None or (value < max_value if strict_max else value <= max_value)
+    return above and below
+
+
+def _observed(value):
+    """Convert a NumPy scalar to a plain Python value, as found in a JSON result."""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _check_aggregate(data, config):
+    """Check an expectation on a whole column or on the table."""
+    expectation_type, kwargs = config['expectation_type'], config['kwargs']
+    bounds = {key: kwargs.get(key) for key in ('min_value', 'max_value', 'strict_min', 'strict_max')}
+    try:
+        if expectation_type == 'expect_table_columns_to_match_ordered_list':
+            observed = list(data.columns)
+            return _result(config, observed == list(kwargs['column_list']), {'observed_value': observed})
+        if expectation_type == 'expect_table_row_count_to_be_between':
+            return _result(config, _between(len(data), **bounds), {'observed_value': len(data)})
+        if expectation_type == 'expect_table_column_count_to_equal':
+            return _result(config, len(data.columns) == kwargs['value'], {'observed_value': len(data.columns)})
+
+        column = data[kwargs['column']]
+        if expectation_type == 'expect_column_values_to_be_in_type_list':
+            types = _resolve_types(kwargs['type_list'])
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                # A categorical column is of the type of its categories, as if it were decoded
+                categories = column.cat.categories.to_numpy(dtype=object)
+                success = not _unexpected_types(categories, kwargs['type_list']).any()
+                return _result(config, success, {'observed_value': column.cat.categories.dtype.type.__name__})
+            return _result(config, column.dtype.type in types, {'observed_value': column.dtype.type.__name__})
+        if expectation_type == 'expect_column_to_exist':
+            return _result(config, True)
+
+        if expectation_type == 'expect_column_values_to_be_unique':
+            values = column.dropna()
+            duplicated = values[values.duplicated(keep=False)]
+            result = {'element_count': len(column), 'unexpected_count': len(duplicated),
+                      'unexpected_percent': 100.0 * len(duplicated) / len(values) if len(values) else 0.0,
+                      'partial_unexpected_list': duplicated.iloc[:PARTIAL_UNEXPECTED_COUNT].tolist()}
+            return _result(config, len(duplicated) == 0, result)
+
+        statistics = {
+            'expect_column_min_to_be_between': column.min,
+            'expect_column_max_to_be_between': column.max,
+            'expect_column_mean_to_be_between': column.mean,
+            'expect_column_median_to_be_between': column.median,
+            'expect_column_sum_to_be_between': column.sum,
+            'expect_column_stdev_to_be_between': column.std,
+        }
+        if expectation_type in statistics:
+            observed = _observed(statistics[expectation_type]())
+            return _result(config, _between(observed, **bounds), {'observed_value': observed})
+        if expectation_type == 'expect_column_quantile_values_to_be_between':
+            quantile_ranges = kwargs['quantile_ranges']
+            interpolation = kwargs.get('allow_relative_error') or 'nearest'
+            observed = column.quantile(quantile_ranges['quantiles'], interpolation=interpolation).tolist()
+            success = all(_between(value, low, high) for value, (low, high) in zip(observed, quantile_ranges['value_ranges']))
+            return _result(config, success, {'observed_value': {'quantiles': quantile_ranges['quantiles'], 'values': observed}})
+    except Exception as e:
+        return _result(config, False, exception=f'{type(e).__name__}: {e}')
+    return _result(config, False, exception=f"Unsupported expectation type '{expectation_type}'")
+
+
+def _result(config, success, result=None, exception=None):
+    """Build a result in the shape of a Great Expectations validation result."""
+    return {
+        'success': bool(success),
+        'expectation_config': config,
+        'result': result or {},
+        'meta': {},
+        'exception_info': {
+            'raised_exception': exception is not None,
+            'exception_traceback': None,
+            'exception_message': exception,
+        },
+    }
@@ -1,34 +1,62 @@
 import os, sys
+import json
+import logging
 import great_expectations as ge
 
+from great_expectations.core import ExpectationSuite
 from great_expectations.profile.user_configurable_profiler import UserConfigurableProfiler
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
 
 import data_processing as dp
-from constants import DATA_PATH
+from constants import DATA_PATH, EXPECTATION_SUITE_PATH, DATA_QUALITY_SEMANTIC_TYPES, DATA_QUALITY_EXCLUDED_EXPECTATIONS
 
-def profile_data(data_path):
-    data = dp.extract(data_path)
+def profile_data(data_path=DATA_PATH, data=None):
+    if data is None:
+        data = dp.extract(data_path)
     ge_data = ge.from_pandas(data)
     
-    # Define the semantic types dictionary
-    semantic_types_dict = {
-        "string": ["id", "email", "location", "widget_list"],
-        "numeric": ["age_group", "user_score", "revenue"],
-        "datetime": ["created_at"],
-    }
-    
     profiler = UserConfigurableProfiler(
         profile_dataset=ge_data,
-        semantic_types_dict=semantic_types_dict
+        semantic_types_dict=DATA_QUALITY_SEMANTIC_TYPES,
+        excluded_expectations=DATA_QUALITY_EXCLUDED_EXPECTATIONS
     )
     
     expectation_suite = profiler.build_suite()
     
     return expectation_suite
 
+def load_expectation_suite(data_path=DATA_PATH, data=None, suite_path=EXPECTATION_SUITE_PATH, refresh=False):
+    """
+    Load the expectation suite saved at suite_path, profiling the data and saving the suite there first
+    if there is none yet or a refresh is requested.
+
+    Profiling takes seconds while loading is close to free, so the suite is only rebuilt on request.
+    The expectations pinned to the aggregates of the profiled data are left out, see
+    DATA_QUALITY_EXCLUDED_EXPECTATIONS, so other valid data, such as more records, still passes.
+
+    Parameters:
+    data_path (str): The raw data to profile, if data is not given. Defaults to DATA_PATH from constants module.
+    data (pd.DataFrame, optional): The already extracted data to profile.
+    suite_path (str): The path of the saved suite. Defaults to EXPECTATION_SUITE_PATH from constants module.
+    refresh (bool): Profile the data again, replacing the saved suite. Defaults to False.
+
+    Returns:
+    ExpectationSuite: The expectation suite.
+    """
+    if not refresh and os.path.exists(suite_path):
+        with open(suite_path) as file:
+            return ExpectationSuite(**json.load(file))
+
+    logging.info(f"Profiling the data for a new expectation suite at {suite_path}...")
+    expectation_suite = profile_data(data_path, data=data)
+    temp_path = f'{suite_path}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(expectation_suite.to_json_dict(), file, indent=2)
+    os.replace(temp_path, suite_path)
+    return expectation_suite
+
 if __name__ == "__main__":
-    data_path = DATA_PATH
-    expectation_suite = profile_data(data_path)
+    # Profile the raw data again, replacing the saved expectation suite
+    expectation_suite = load_expectation_suite(DATA_PATH, refresh=True)
     print(expectation_suite.to_json_dict())
@@ -1,31 +1,38 @@
 import os, sys
 import great_expectations as ge
+import pandas as pd
 import pytest
 import logging
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
 
 import data_processing as dp
-from constants import DATA_PATH
-from profiler import profile_data 
+from constants import DATA_PATH, DATA_QUALITY_EXCLUDED_EXPECTATIONS
+import profiler
+from profiler import load_expectation_suite
 
 logging.basicConfig(level=logging.INFO)
 
-def test_data_quality(data_path=DATA_PATH):
+def test_data_quality(data_path=DATA_PATH, data=None, refresh=False):
     """
     Validate the quality of data processed by the data_processing module
     using the Great Expectations library.
+
+    The data is validated against the saved expectation suite, which is only profiled
+    when there is none yet or refresh is set. Passing the already extracted data
+    skips extracting it again.
     """
     logging.info("Starting data quality test...")
 
     try:
-        data = dp.extract(data_path=data_path)
+        if data is None:
+            data = dp.extract(data_path=data_path)
         ge_data = ge.from_pandas(data)
     except Exception as e:
         pytest.fail(f"Data extraction or conversion failed: {e}")
 
-    # Get the auto-generated expectation suite
-    expectation_suite = profile_data(data_path)
+    # Get the saved expectation suite
+    expectation_suite = load_expectation_suite(data_path, data=data, refresh=refresh)
 
     # Validate data against the expectations suite
     results = ge_data.validate(expectation_suite=expectation_suite)
@@ -35,5 +42,46 @@ def test_data_quality(data_path=DATA_PATH):
     
     logging.info("Data quality test completed successfully.")
 
+def test_expectation_suite_cache(tmp_path, monkeypatch):
+    """
+    Test that the expectation suite is profiled once, saved, and reused until refreshed.
+    """
+    logging.info("Starting expectation suite cache test...")
+
+    suite_path = str(tmp_path / 'expectation_suite.json')
+    data = dp.extract(data_path=DATA_PATH)
+    expectation_suite = load_expectation_suite(data=data, suite_path=suite_path)
+    assert os.path.exists(suite_path)
+
+    # Loading the saved suite must not profile the data again
+    def fail_profiling(*args, **kwargs):
+        raise AssertionError("The data was profiled again")
+
+    monkeypatch.setattr(profiler, 'profile_data', fail_profiling)
+    assert load_expectation_suite(data=data, suite_path=suite_path) == expectation_suite
+    with pytest.raises(AssertionError, match="profiled again"):
+        load_expectation_suite(data=data, suite_path=suite_path, refresh=True)
+
+    logging.info("Expectation suite cache test completed successfully.")
+
+def test_expectation_suite_generalizes(tmp_path):
+    """
+    Test that the saved expectation suite is not pinned to the aggregates of the profiled data.
+    """
+    logging.info("Starting expectation suite generalization test...")
+
+    suite_path = str(tmp_path / 'expectation_suite.json')
+    data = dp.extract(data_path=DATA_PATH)
+    expectation_suite = load_expectation_suite(data=data, suite_path=suite_path)
+    expectation_types = {expectation.expectation_type for expectation in expectation_suite.expectations}
+    assert not expectation_types & set(DATA_QUALITY_EXCLUDED_EXPECTATIONS)
+    assert {'expect_column_values_to_not_be_null', 'expect_column_values_to_be_in_type_list'} <= expectation_types
+
+    # Twice the records, one of them changed, are still valid
+    more_data = pd.concat([data, data.assign(user_score=data['user_score'] / 2)], ignore_index=True)
+    assert ge.from_pandas(more_data).validate(expectation_suite=expectation_suite)["success"]
+
+    logging.info("Expectation suite generalization test completed successfully.")
+
 if __name__ == "__main__":
     pytest.main()
@@ -1,6 +1,9 @@
 import pytest
 import os
 import sys
+import json
+import functools
+import subprocess
 import pandas as pd
 import sqlite3
 import logging
@@ -8,8 +11,10 @@ import logging
 # Append the path to access the modules from the src directory
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
 
+import main as etl
 from main import main
-from constants import DB_PATH
+from pipeline import Pipeline
+from constants import DB_PATH, DATA_PATH
 
 # Configure logging for testing
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -63,5 +68,88 @@ def test_etl_process(setup_teardown):
         logging.error(f"An unexpected error occurred: {e}")
         raise  # Re-raise the exception to fail the test
 
+def test_stage_modules():
+    """
+    Test that the cache keys of the ETL stages cover every module under src they run through, so editing
+    any of them invalidates the cache. Only the pipeline's own machinery and main itself are left out.
+    """
+    logging.info("Testing the modules hashed into the stage cache keys")
+    # Imported in a fresh interpreter, as this one holds the modules of every test
+    src = os.path.dirname(etl.__file__)
+    code = ("import os, sys, main; print(' '.join(name for name, module in sys.modules.items() "
+            f"if os.path.dirname(getattr(module, '__file__', None) or '') == {src!r}))")
+    imported = set(subprocess.run([sys.executable, '-c', code], cwd=src, capture_output=True, text=True,
+                                  check=True).stdout.split())
+    assert imported - {'main', 'pipeline', 'instrumentation'} == {module.__name__ for module in etl.STAGE_MODULES}
+
+@pytest.fixture
+def scratch_paths(tmp_path, monkeypatch):
+    """Point the ETL at a copy of the raw data in a scratch folder, with its own database, indexes and cache."""
+    data_path = tmp_path / 'raw' / 'data.json'
+    data_path.parent.mkdir()
+    data_path.write_text(open(DATA_PATH).read())
+    paths = {'DATA_PATH': data_path, 'DB_PATH': tmp_path / 'export' / 'database.db',
+             'INDEX_PATH': tmp_path / 'export' / 'index.npz', 'FINGERPRINT_PATH': tmp_path / 'export' / 'fingerprints.npz',
+             'STAGING_FOLDER': tmp_path / 'staging', 'METRICS_PATH': tmp_path / 'metrics' / 'stages.jsonl',
+             'PROMETHEUS_PATH': tmp_path / 'metrics' / 'stages.prom'}
+    (tmp_path / 'export').mkdir()
+    (tmp_path / 'staging').mkdir()
+    for name, path in paths.items():
+        monkeypatch.setattr(etl, name, str(path))
+    monkeypatch.setattr(etl, 'Pipeline', functools.partial(Pipeline, cache_folder=str(tmp_path / 'cache')))
+    return {name: str(path) for name, path in paths.items()}
+
+def test_incremental_after_full_load(scratch_paths):
+    """
+    Test incremental runs after a full load, which replaces transformed_data without the key upsert writes.
+
+    Tests include:
+    1. The incremental run after the full load keeps every record and adds the new one.
+    2. A further incremental run with nothing new changes nothing.
+    """
+    logging.info("Testing incremental runs after a full load")
+
+    def row_count():
+        with sqlite3.connect(scratch_paths['DB_PATH']) as conn:
+            return conn.execute('SELECT COUNT(*) FROM transformed_data').fetchone()[0]
+
+    main(incremental=True)
+    main()
+    full_row_count = row_count()
+
+    # Append a new record of a new user, with two widgets
+    with open(scratch_paths['DATA_PATH']) as file:
+        record = json.loads(file.readline())
+    record.update(id='00000000-0000-4000-8000-000000000000', created_at='2020-08-01T00:00:00Z',
+                  widget_list=[{'name': 'widget1', 'amount': 1}, {'name': 'widget2', 'amount': 2}])
+    with open(scratch_paths['DATA_PATH'], 'a') as file:
+        file.write(json.dumps(record) + '\n')
+
+    main(incremental=True)
+    assert row_count() == full_row_count + 2
+    main(incremental=True)
+    assert row_count() == full_row_count + 2
+
+def test_streaming(scratch_paths):
+    """
+    Test streaming runs and the command line flags they take.
+
+    Tests include:
+    1. Streaming with the typed parser loads the same rows as with pd.read_json.
+    2. Flags that do not apply to streaming loads are rejected instead of ignored.
+    """
+    logging.info("Testing streaming runs")
+
+    tables = {}
+    for parser in ('pandas', 'typed'):
+        main(chunksize=400, parser=parser)
+        with sqlite3.connect(scratch_paths['DB_PATH']) as conn:
+            tables[parser] = pd.read_sql('SELECT * FROM transformed_data ORDER BY id, created_at, widget_name', conn)
+    pd.testing.assert_frame_equal(tables['pandas'], tables['typed'])
+
+    for flags in (['--workers', '2'], ['--no-cache'], ['--compact'], ['--parser', 'typed', '--memory-report']):
+        result = subprocess.run([sys.executable, etl.__file__, '--chunksize', '400', *flags], capture_output=True, text=True)
+        assert result.returncode == 2 and "does not apply to streaming loads" in result.stderr
+
 if __name__ == "__main__":
     pytest.main()
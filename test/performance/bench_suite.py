@@ -0,0 +1,384 @@
+import os, sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import sqlite3
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime, timezone
+import pandas as pd
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+sys.path.append(os.path.join(PROJECT_ROOT, 'src'))
+
+import data_processing as dp
+import db_operations as db_ops
+import validation
+from queries import QueryService
+from rankings import AgeGroupRankings
+from fingerprints import FingerprintStore
+from index_engine import MultiFieldIndex, email_domain
+from constants import TRANSFORMED_DATA_INDEXES
+from generate_data import generate_data
+
+# The same questions asked of the wide table and of the star schema, with ? standing for a location of the data
+STAR_SCHEMA_QUERIES = {
+    'revenue_per_location': (
+        'SELECT location, SUM(revenue) FROM (SELECT DISTINCT id, created_at, location, revenue FROM transformed_data) '
+        'GROUP BY location',
+        'SELECT l.location, SUM(u.revenue) FROM users u LEFT JOIN locations l ON l.location_key = u.location_key '
+        'GROUP BY l.location',
+    ),
+    'amount_per_widget': (
+        'SELECT widget_name, SUM(widget_amount) FROM transformed_data GROUP BY widget_name',
+        'SELECT name, SUM(amount) FROM widgets GROUP BY name',
+    ),
+    'users_in_location': (
+        'SELECT COUNT(DISTINCT id) FROM transformed_data WHERE location = ?',
+        'SELECT COUNT(DISTINCT u.id) FROM users u JOIN locations l ON l.location_key = u.location_key '
+        'WHERE l.location = ?',
+    ),
+    'full_scan': (
+        'SELECT * FROM transformed_data',
+        'SELECT * FROM transformed_data',
+    ),
+}
+
+
+def measure(func, *args, trace_memory=True):
+    """
+    Run func(*args) and measure it, once untraced for its times and once more under tracemalloc for its peak memory.
+
+    Returns:
+    tuple: The output of func, and a dict of its wall and CPU seconds and peak memory in bytes (None if not traced).
+    """
+    start, start_cpu = time.perf_counter(), time.process_time()
+    output = func(*args)
+    result = {'seconds': time.perf_counter() - start, 'cpu_seconds': time.process_time() - start_cpu, 'peak_bytes': None}
+    if trace_memory:
+        del output
+        tracemalloc.start()
+        try:
+            output = func(*args)
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return output, result
+
+
+def run_main(project_root, *flags):
+    """
+    Run main.py in a subprocess against the project tree at project_root.
+
+    Returns:
+    dict: The wall and CPU seconds of the run, and the peak resident memory of every subprocess so far in bytes.
+    """
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    # Import from the scratch tree's own path, as running main.py directly would resolve its symlinks
+    # and write to the real data folder
+    src = os.path.join(project_root, 'src')
+    code = (f"import sys, runpy; sys.path.insert(0, {src!r}); sys.argv = ['main.py', *{list(flags)!r}]; "
+            f"runpy.run_path({os.path.join(src, 'main.py')!r}, run_name='__main__')")
+    subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    seconds = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'seconds': seconds,
+            'cpu_seconds': after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime,
+            'peak_bytes': after.ru_maxrss * 1024}
+
+
+def run_transforms(data, compact):
+    """Run the in-memory transforms of the ETL, with or without compact dtypes, returning the transformed data."""
+    if compact:
+        data = dp.compact_dtypes(data)
+    data = dp.flatten_and_extract_widgets(dp.rank_users(dp.deduplicate(data)))
+    if compact:
+        data = dp.compact_dtypes(data)
+    return dp.convert_unsupported_data_types(data)
+
+
+def stream_fingerprints(data, batch_size):
+    """Stream the (id, created_at) keys of the data through a new FingerprintStore in batches, returning the store."""
+    store = FingerprintStore(capacity=len(data))
+    for start in range(0, len(data), batch_size):
+        batch = data.iloc[start:start + batch_size]
+        store.update(batch[~batch.duplicated(['id', 'created_at'])])
+    return store
+
+
+def validate_great_expectations(data, suite):
+    """Validate the data with Great Expectations, imported here as it is slow to import and only needed to compare."""
+    import great_expectations as ge
+    return ge.from_pandas(data).validate(expectation_suite=suite)
+
+
+def benchmark_stages(data_path, db_folder, trace_memory=True, delta_fraction=0.01, cached_calls=100,
+                     batch_size=100000, great_expectations=False):
+    """
+    Time each data_processing and db_operations function of the ETL in turn, each on the previous one's output.
+
+    Beyond the stages of a full run, this covers the paths they replaced, so their speedups can be tracked:
+    Tasks 6 and 8 as separate steps, extraction with the pandas parser and without partitions, the transforms
+    without compact dtypes, and db_ops.load through pandas.to_sql. It also covers the cross-batch
+    FingerprintStore and the MultiFieldIndex, incremental runs, upserting and updating the posting lists and
+    search index for a delta of changed users, and reads: the same questions asked of the wide table and of
+    the star schema, searches through the search index against LIKE scans, and the QueryService, cold and cached.
+
+    Parameters:
+    data_path (str): The JSON lines file to benchmark on.
+    db_folder (str): The folder the benchmark databases are written to.
+    trace_memory (bool): Also run each function under tracemalloc for its peak memory. Defaults to True.
+    delta_fraction (float): The fraction of users changed by the incremental benchmarks. Defaults to 0.01.
+    cached_calls (int): The number of calls each cached QueryService benchmark times, as one is too quick to
+                        time. Defaults to 100.
+    batch_size (int): The rows per batch streamed through the FingerprintStore. Defaults to 100000.
+    great_expectations (bool): Also validate with Great Expectations, against the suite profiled from the
+                               data plus the default expectations, to compare with validation.validate.
+                               Defaults to False.
+
+    Returns:
+    dict: The measurements of each function, with the rows it was given and its throughput.
+    """
+    results = {}
+
+    def record(name, rows, func, *args):
+        output, result = measure(func, *args, trace_memory=trace_memory)
+        result['rows'] = rows
+        result['rows_per_second'] = rows / result['seconds'] if result['seconds'] else None
+        results[name] = result
+        return output
+
+    with open(data_path, 'rb') as file:
+        line_count = sum(1 for _ in file)
+    data = record('dp.extract', line_count, dp.extract, data_path)
+    record('dp.extract[typed]', line_count, lambda: dp.extract(data_path, backend='typed'))
+    record('dp.extract[partitioned]', line_count, lambda: dp.extract(data_path, max_workers=os.cpu_count()))
+    record('validation.validate', len(data), validation.validate, data)
+    if great_expectations:
+        sys.path.append(os.path.join(PROJECT_ROOT, 'test', 'data_quality'))
+        from profiler import profile_data
+        from great_expectations.core import ExpectationConfiguration
+        suite = profile_data(data=data)
+        for config in validation.default_expectations():
+            suite.add_expectation(ExpectationConfiguration(**config))
+        record('validation.validate[profiled suite]', len(data), validation.validate, data, suite)
+        record('great_expectations.validate[profiled suite]', len(data), validate_great_expectations, data, suite)
+    record('FingerprintStore.update', len(data), stream_fingerprints, data, batch_size)
+    deduplicated = record('dp.deduplicate', len(data), dp.deduplicate, data)
+    ranked = record('dp.rank_users', len(deduplicated), dp.rank_users, deduplicated)
+    record('dp.get_top_user_per_age_group', len(ranked), dp.get_top_user_per_age_group, ranked)
+    flattened = record('dp.flatten_and_extract_widgets', len(ranked), dp.flatten_and_extract_widgets, ranked)
+    record('dp.flatten_widget_list+extract_widget_info', len(ranked),
+           lambda: dp.extract_widget_info(dp.flatten_widget_list(ranked)))
+    record('dp.compact_dtypes', len(flattened), dp.compact_dtypes, flattened)
+    converted = record('dp.convert_unsupported_data_types', len(flattened), dp.convert_unsupported_data_types, flattened)
+    record('transforms', len(data), run_transforms, data, False)
+    record('transforms[compact]', len(data), run_transforms, data, True)
+    postings = record('db_ops.create_posting_lists', len(converted), db_ops.create_posting_lists, converted)
+    record('db_ops.create_inverted_index', len(converted), db_ops.create_inverted_index, converted)
+    index = record('MultiFieldIndex.build', len(converted), MultiFieldIndex.build, converted)
+    locations = converted['location'].dropna().drop_duplicates()
+    domain = email_domain(converted['email'].dropna()).iloc[0]
+    index_queries = {
+        'location': f'location="{locations.iloc[0]}"',
+        'location_and_widget': f'location="{locations.iloc[0]}" AND widget_name="{converted["widget_name"].dropna().iloc[0]}"',
+        'or_not': f'(location="{locations.iloc[0]}" OR location="{locations.iloc[-1]}") AND NOT email_domain={domain}',
+    }
+    for name, index_query in index_queries.items():
+        record(f'MultiFieldIndex.query_codes.{name}', len(index.ids), index.query_codes, index_query)
+
+    # Full loads
+    rows = len(converted)
+    wide_path = os.path.join(db_folder, 'wide.db')
+    star_path = os.path.join(db_folder, 'star.db')
+    record('db_ops.load', rows, lambda: db_ops.load(converted, os.path.join(db_folder, 'to_sql.db'),
+                                                    table_name='transformed_data'))
+    record('db_ops.bulk_load', rows, lambda: db_ops.bulk_load(converted, wide_path, table_name='transformed_data',
+                                                              indexes=TRANSFORMED_DATA_INDEXES))
+    record('db_ops.load_star_schema', rows, lambda: db_ops.load_star_schema(converted, star_path))
+    record('db_ops.store_posting_lists', len(postings), db_ops.store_posting_lists, postings, wide_path)
+    record('db_ops.store_search_index', rows, lambda: db_ops.store_search_index(converted, db_path=wide_path))
+    record('db_ops.store_rankings', len(ranked), lambda: db_ops.store_rankings(AgeGroupRankings.from_data(ranked),
+                                                                                  wide_path, replace=True))
+
+    # Incremental loads of a delta of users whose scores and locations changed
+    changed_ids = converted['id'].drop_duplicates().sample(frac=delta_fraction, random_state=0)
+    delta = converted[converted['id'].isin(changed_ids)]
+    delta = delta.assign(user_score=1 - delta['user_score'], location=delta['location'].iloc[::-1].to_numpy())
+    upsert_path = os.path.join(db_folder, 'upsert.db')
+    record('db_ops.upsert[full]', rows, lambda: db_ops.upsert(converted, upsert_path, watermark=False))
+    record('db_ops.upsert[delta]', len(delta), lambda: db_ops.upsert(delta, upsert_path, watermark=False))
+    record('db_ops.update_posting_lists', len(delta), lambda: db_ops.update_posting_lists(delta, wide_path))
+    record('db_ops.update_search_index', len(delta), lambda: db_ops.update_search_index(delta, db_path=wide_path))
+
+    # The same questions asked of the wide table and of the star schema
+    location = converted['location'].dropna().iloc[0]
+    for name, (wide_sql, star_sql) in STAR_SCHEMA_QUERIES.items():
+        params = (location,) if '?' in wide_sql else ()
+        record(f'sqlite[wide].{name}', rows, query, wide_path, wide_sql, params)
+        record(f'sqlite[star].{name}', rows, query, star_path, star_sql, params)
+
+    # Searches through the search index against LIKE scans of the wide table
+    domain = converted['email'].iloc[0].split('@')[1]
+    prefix = converted['widget_name'].dropna().iloc[0][:4]
+    searches = {'email_domain': (f'%@{domain}', (domain, 'email', 'term')),
+                'widget_name_prefix': (f'{prefix}%', (prefix, 'widget_name', 'prefix'))}
+    for name, (pattern, (value, field, match)) in searches.items():
+        like_sql = f'SELECT DISTINCT id FROM transformed_data WHERE {field} LIKE ? ORDER BY id'
+        record(f'sqlite[like].{name}', rows, query, wide_path, like_sql, (pattern,))
+        record(f'db_ops.search.{name}', rows, lambda: db_ops.search(value, field, match, db_path=wide_path))
+
+    # The query service, on its first call and then from its cache
+    db_ops.bump_generation(wide_path)
+    arguments = {'top_users': (1,), 'ids_by_location': (converted['location'].iloc[0],),
+                 'user_widgets': (converted['id'].iloc[0],)}
+    with QueryService(wide_path) as service:
+        for name, args in arguments.items():
+            method = getattr(service, name)
+            record(f'QueryService.{name}[cold]', rows, lambda: (service.cache.clear(), method(*args)))
+            record(f'QueryService.{name}[cached x{cached_calls}]', rows, lambda: [method(*args) for _ in range(cached_calls)])
+    return results
+
+
+def query(db_path, sql, params=()):
+    """Fetch every row of a query on a new connection."""
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute(sql, params).fetchall()
+
+
+def benchmark_main(data_path, rows):
+    """
+    Run main.py on the data from a scratch copy of the project tree, so the real data folder is left alone.
+
+    The first run profiles the expectation suite and fills the stage cache, the second reruns every stage
+    with the suite saved, and the third finds every stage cached.
+
+    Returns:
+    dict: The measurements of each run.
+    """
+    project_root = tempfile.mkdtemp()
+    try:
+        for folder in ('src', 'test'):
+            os.symlink(os.path.join(PROJECT_ROOT, folder), os.path.join(project_root, folder))
+        for folder in ('raw', 'staging', 'export'):
+            os.makedirs(os.path.join(project_root, 'data', folder))
+        os.symlink(os.path.abspath(data_path), os.path.join(project_root, 'data', 'raw', 'data.json'))
+
+        results = {}
+        for name, flags in [('main[cold]', ()), ('main[no-cache]', ('--no-cache',)), ('main[cached]', ())]:
+            results[name] = run_main(project_root, *flags)
+            results[name]['rows'] = rows
+            results[name]['rows_per_second'] = rows / results[name]['seconds']
+        return results
+    finally:
+        shutil.rmtree(project_root)
+
+
+def git_commit():
+    """Return the commit of the working tree, or None outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_suite(rows=1000000, data_path=None, trace_memory=True, include_main=True, great_expectations=False,
+                    **params):
+    """
+    Generate data at the given scale and benchmark each ETL function and the full main.py run on it.
+
+    Parameters:
+    rows (int): The number of rows to generate.
+    data_path (str, optional): An existing JSON lines file to benchmark on instead of generated data.
+    trace_memory (bool): Also run each function under tracemalloc for its peak memory. Defaults to True.
+    include_main (bool): Also benchmark main.py. Defaults to True.
+    great_expectations (bool): Also time Great Expectations validation. Defaults to False.
+    params: Parameters of generate_data.generate_records.
+
+    Returns:
+    dict: The environment, the data and the measurements of every benchmark.
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        if data_path is None:
+            data_path = os.path.join(folder, 'data.json')
+            generate_data(data_path, rows, **params)
+        benchmarks = benchmark_stages(data_path, folder, trace_memory, great_expectations=great_expectations)
+        if include_main:
+            benchmarks.update(benchmark_main(data_path, benchmarks['dp.extract']['rows']))
+        return {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'cpus': os.cpu_count(),
+            'data': {'rows': benchmarks['dp.extract']['rows'], 'bytes': os.path.getsize(data_path), 'params': params},
+            'benchmarks': benchmarks,
+        }
+    finally:
+        shutil.rmtree(folder)
+
+
+def compare(results, baseline, threshold=1.1):
+    """
+    Compare the wall times of two benchmark results.
+
+    Parameters:
+    results (dict): The new results.
+    baseline (dict): The results to compare against.
+    threshold (float): The ratio of new to baseline seconds above which a benchmark counts as a regression.
+
+    Returns:
+    list: The (name, baseline seconds, new seconds, ratio) of every benchmark in both, and the names of the regressions.
+    """
+    rows = []
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        before = baseline['benchmarks'][name]['seconds']
+        ratio = result['seconds'] / before if before else float('inf')
+        rows.append((name, before, result['seconds'], ratio))
+        if ratio > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the ETL and the full run on synthetic data.")
+    parser.add_argument('--rows', type=int, default=1000000, help="Rows of synthetic data to generate")
+    parser.add_argument('--data-path', default=None, help="Benchmark on this JSON lines file instead of generated data")
+    parser.add_argument('--duplicate-rate', type=float, default=0.006, help="Fraction of generated lines repeating an earlier line")
+    parser.add_argument('--max-widgets', type=int, default=3, help="Longest generated widget_list")
+    parser.add_argument('--locations', type=int, default=115, help="Distinct generated locations")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the traced runs measuring peak memory")
+    parser.add_argument('--no-main', action='store_true', help="Skip benchmarking main.py")
+    parser.add_argument('--great-expectations', action='store_true', help="Also time Great Expectations validation")
+    parser.add_argument('--output', default='benchmark_results.json', help="Where to write the results as JSON")
+    parser.add_argument('--baseline', default=None, help="Earlier results to compare against")
+    parser.add_argument('--threshold', type=float, default=1.1, help="Slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    results = benchmark_suite(args.rows, args.data_path, trace_memory=not args.no_memory, include_main=not args.no_main,
+                              great_expectations=args.great_expectations, duplicate_rate=args.duplicate_rate, max_widgets=args.max_widgets, locations=args.locations)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+
+    print(f"{results['data']['rows']} rows, results written to {args.output}")
+    for name, result in results['benchmarks'].items():
+        peak = f"{result['peak_bytes'] / 2 ** 20:8.1f} MiB" if result['peak_bytes'] is not None else '         -'
+        print(f"{name:<48}{result['seconds']:9.3f}s {result['cpu_seconds']:9.2f}s cpu {peak} "
+              f"{result['rows_per_second'] or 0:12,.0f} rows/s")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            rows, regressions = compare(results, json.load(file), args.threshold)
+        for name, before, after, ratio in rows:
+            print(f"{name:<48}{before:9.3f}s -> {after:9.3f}s ({ratio:.2f}x){'  REGRESSION' if name in regressions else ''}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,145 @@
+import os, sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
+
+from constants import DATA_PATH
+
+# First and last timestamp of the created_at values, matching the span of the raw data
+CREATED_AT_RANGE = ('2019-08-12T00:00:00', '2020-08-12T00:00:00')
+
+EMAIL_DOMAINS = ['example.com', 'example.org', 'example.net', 'mail.test', 'users.test']
+
+# Earlier lines kept as a uniform sample for duplicates to repeat, bounding memory at any scale
+RESERVOIR_SIZE = 100000
+
+
+def generate_records(rows, duplicate_rate=0.006, max_widgets=3, widget_skew=1.0, locations=115, score_skew=1.0,
+                     widget_names=500, seed=0, chunk_rows=100000, reservoir_size=RESERVOIR_SIZE):
+    """
+    Generate JSON lines in the schema of the raw data, one chunk of lines at a time.
+
+    The defaults match the shape of data/raw/data.json. Duplicates repeat an earlier line verbatim, so they
+    share its (id, created_at) key and are removed by deduplication. The earlier line is drawn from the whole
+    output so far, not just the current chunk, so duplicates also span the batches of a streaming run and
+    the runs of an incremental load over split files. Lines of earlier chunks are drawn from a reservoir
+    sample of them, which keeps memory bounded.
+
+    Parameters:
+    rows (int): The number of lines to generate, duplicates included.
+    duplicate_rate (float): The fraction of lines that repeat an earlier line.
+    max_widgets (int): The longest widget_list. Lengths run from 0 to max_widgets.
+    widget_skew (float): The skew of the widget_list lengths. 1 draws every length equally often, and larger
+                         values favour shorter lists.
+    locations (int): The number of distinct locations.
+    score_skew (float): The skew of user_score over [0, 1). 1 is uniform, and larger values favour low scores.
+    widget_names (int): The number of distinct widget names.
+    seed (int): The random seed. The same parameters and seed always give the same lines.
+    chunk_rows (int): The number of lines generated at once.
+    reservoir_size (int): The number of lines of earlier chunks sampled for duplicates, at least 1. Defaults to RESERVOIR_SIZE.
+
+    Yields:
+    list: The lines of each chunk, as str without line breaks.
+    """
+    rng = np.random.default_rng(seed)
+    location_names = [json.dumps(f'Location {number}') for number in range(locations)]
+    names = [json.dumps(f'Widget {number}') for number in range(widget_names)]
+    start, end = (np.datetime64(value, 's').astype(np.int64) for value in CREATED_AT_RANGE)
+
+    reservoir = []
+    offset = 0
+    while offset < rows:
+        count = min(chunk_rows, rows - offset)
+
+        # Random version 4 UUIDs
+        uuid_bytes = rng.integers(0, 256, size=(count, 16), dtype=np.uint8)
+        uuid_bytes[:, 6] = (uuid_bytes[:, 6] & 0x0F) | 0x40
+        uuid_bytes[:, 8] = (uuid_bytes[:, 8] & 0x3F) | 0x80
+        hexes = uuid_bytes.tobytes().hex()
+        ids = [f'{hexes[i:i + 8]}-{hexes[i + 8:i + 12]}-{hexes[i + 12:i + 16]}-{hexes[i + 16:i + 20]}-{hexes[i + 20:i + 32]}'
+               for i in range(0, 32 * count, 32)]
+
+        domains = rng.integers(0, len(EMAIL_DOMAINS), size=count).tolist()
+        age_groups = rng.integers(1, 5, size=count).tolist()
+        scores = np.round(rng.random(count) ** score_skew, 9).tolist()
+        revenues = np.round(rng.uniform(1, 1000, size=count), 2).tolist()
+        location_codes = rng.integers(0, locations, size=count).tolist()
+        created_at = np.datetime_as_string(rng.integers(start, end, size=count).astype('datetime64[s]'), unit='s').tolist()
+
+        lengths = np.floor((max_widgets + 1) * rng.random(count) ** widget_skew).astype(np.int64)
+        widget_codes = rng.integers(0, widget_names, size=int(lengths.sum())).tolist()
+        amounts = rng.integers(1, 100000, size=len(widget_codes)).tolist()
+        widget_lists = []
+        position = 0
+        for length in lengths.tolist():
+            widget_lists.append(','.join(f'{{"name":{names[widget_codes[i]]},"amount":{amounts[i]}}}'
+                                         for i in range(position, position + length)))
+            position += length
+
+        lines = [f'{{"id":"{ids[i]}","email":"user{offset + i}@{EMAIL_DOMAINS[domains[i]]}","age_group":{age_groups[i]},'
+                 f'"user_score":{scores[i]},"revenue":{revenues[i]},"widget_list":[{widget_lists[i]}],'
+                 f'"location":{location_names[location_codes[i]]},"created_at":"{created_at[i]}Z"}}'
+                 for i in range(count)]
+
+        # Each duplicate repeats a line drawn uniformly from every earlier line, taken from the reservoir
+        # when the draw falls in an earlier chunk, which it samples uniformly
+        duplicates = np.flatnonzero(rng.random(count) < duplicate_rate)
+        duplicates = duplicates[offset + duplicates > 0]
+        sources = (rng.random(len(duplicates)) * (offset + duplicates)).astype(np.int64) - offset
+        picks = rng.integers(0, max(len(reservoir), 1), size=len(duplicates))
+        for position, source, pick in zip(duplicates.tolist(), sources.tolist(), picks.tolist()):
+            lines[position] = lines[source] if source >= 0 else reservoir[pick]
+
+        # Reservoir sampling: the n-th line replaces a random entry with probability reservoir_size / n
+        filled = min(max(reservoir_size - len(reservoir), 0), count)
+        reservoir.extend(lines[:filled])
+        slots = (rng.random(count - filled) * np.arange(offset + filled + 1, offset + count + 1)).astype(np.int64)
+        for position, slot in zip(np.flatnonzero(slots < reservoir_size).tolist(), slots[slots < reservoir_size].tolist()):
+            reservoir[slot] = lines[filled + position]
+
+        yield lines
+        offset += count
+
+
+def generate_data(data_path, rows, **params):
+    """
+    Write generated JSON lines to a file, see generate_records for the parameters.
+
+    Parameters:
+    data_path (str): The file to write.
+    rows (int): The number of lines to generate.
+
+    Returns:
+    int: The number of bytes written.
+    """
+    folder = os.path.dirname(data_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(data_path, 'w') as file:
+        for lines in generate_records(rows, **params):
+            file.write('\n'.join(lines))
+            file.write('\n')
+    return os.path.getsize(data_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic raw data in the schema of data/raw/data.json.")
+    parser.add_argument('--rows', type=int, default=1000000, help="Lines to generate, duplicates included")
+    parser.add_argument('--output', default=os.path.join(os.path.dirname(DATA_PATH), 'synthetic.json'),
+                        help="The file to write")
+    parser.add_argument('--duplicate-rate', type=float, default=0.006, help="Fraction of lines repeating an earlier line")
+    parser.add_argument('--max-widgets', type=int, default=3, help="Longest widget_list")
+    parser.add_argument('--widget-skew', type=float, default=1.0, help="Above 1 favours shorter widget lists")
+    parser.add_argument('--locations', type=int, default=115, help="Distinct locations")
+    parser.add_argument('--score-skew', type=float, default=1.0, help="Above 1 favours low user scores")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    size = generate_data(args.output, args.rows, duplicate_rate=args.duplicate_rate, max_widgets=args.max_widgets,
+                         widget_skew=args.widget_skew, locations=args.locations, score_skew=args.score_skew,
+                         seed=args.seed)
+    print(f"Wrote {args.rows} rows ({size / 1e6:.0f} MB) to {args.output} in {time.perf_counter() - start:.1f}s")
@@ -1,11 +1,14 @@
 import os, sys
+import json
 import pytest
+import numpy as np
 import pandas as pd
 import logging
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
 
 import data_processing as dp
+import snapshots
 from constants import DATA_PATH
 
 logging.basicConfig(level=logging.INFO)
@@ -49,6 +52,66 @@ def test_extract():
     logging.info("test_extract completed successfully.")
 
 
+def test_extract_chunked():
+    """
+    Test the streaming mode of the extract function from the dp module.
+
+    Tests include:
+    1. Batches hold at most chunksize records and add up to the full extract.
+    2. Handling of an invalid chunksize.
+    3. Handling of a nonexistent file path.
+    """
+    logging.info("Starting test_extract_chunked...")
+
+    data = dp.extract(data_path=DATA_PATH)
+    batches = list(dp.extract(data_path=DATA_PATH, chunksize=300))
+    assert [len(batch) for batch in batches] == [300, 300, 300, len(data) - 900]
+    pd.testing.assert_frame_equal(pd.concat(batches), data)
+
+    with pytest.raises(ValueError, match="chunksize must be a positive integer"):
+        dp.extract(data_path=DATA_PATH, chunksize=0)
+
+    with pytest.raises(ValueError, match="Failed to load data from nonexistent_path"):
+        dp.extract(data_path="nonexistent_path", chunksize=300)
+
+    logging.info("test_extract_chunked completed successfully.")
+
+
+def test_extract_partitions(tmp_path):
+    """
+    Test the extract_partitions and merge_partitions functions from the dp module.
+
+    Tests include:
+    1. Every record lands in the partition of its id, in file order, and merging restores the serial extract.
+    2. Deduplicating each partition on its own matches deduplicating the merged data.
+    3. Parallel extract returns the same data as serial extract.
+    4. Handling of a nonexistent file path and of an empty file.
+    """
+    logging.info("Starting test_extract_partitions...")
+
+    data = dp.extract(data_path=DATA_PATH)
+    partitions = dp.extract_partitions(data_path=DATA_PATH, partitions=3, max_workers=2)
+    assert len(partitions) == 3 and sum(len(partition) for partition in partitions) == len(data)
+    for number, partition in enumerate(partitions):
+        assert (dp.partition_of(partition['id'], 3) == number).all()
+        assert partition.index.is_monotonic_increasing
+    pd.testing.assert_frame_equal(dp.merge_partitions(partitions), data)
+
+    deduplicated = pd.concat([dp.deduplicate(partition) for partition in partitions]).sort_index()
+    pd.testing.assert_frame_equal(deduplicated, dp.deduplicate(data))
+
+    pd.testing.assert_frame_equal(dp.extract(data_path=DATA_PATH, max_workers=2), data)
+
+    with pytest.raises(ValueError, match="Failed to load data from nonexistent_path"):
+        dp.extract_partitions(data_path="nonexistent_path")
+    empty_path = str(tmp_path / 'empty.json')
+    open(empty_path, 'w').close()
+    with pytest.raises(ValueError, match="Failed to load data from .*: the file is empty"):
+        dp.extract_partitions(data_path=empty_path, max_workers=2)
+
+    logging.info("test_extract_partitions completed successfully.")
+
+
 def test_export_snapshot(tmp_path, sample_data):
     """
     Test the export_snapshot function from the dp module.
@@ -81,6 +144,66 @@ def test_load_from_staging(tmp_path, sample_data):
 
     logging.info("test_load_from_staging completed successfully.")
 
+def test_npy_snapshot_round_trip(tmp_path):
+    """
+    Test exporting and loading a snapshot in the 'npy' format.
+
+    Tests include:
+    1. Column types, nested values and missing values survive the round trip.
+    2. Numeric columns are memory-mapped on load.
+    3. Handling of an unknown snapshot format.
+    """
+    logging.info("Starting test_npy_snapshot_round_trip...")
+
+    data = pd.DataFrame({
+        'id': ['a', 'b', None],
+        'age_group': [1, 2, 3],
+        'widget_list': [[{'name': 'widget1', 'amount': 10}], [], float('nan')],
+        'created_at': pd.to_datetime(['2020-01-31T14:50:26Z', '2020-07-16T18:32:48Z', '2020-01-01T00:00:00Z']),
+        'location': pd.Categorical(['Poland', 'Greece', 'Poland'])
+    })
+    snapshot_path = dp.export_snapshot(data, tmp_path, 'test_snapshot', fmt='npy')
+    loaded_data = dp.load_from_staging(str(tmp_path), os.path.basename(snapshot_path))
+    pd.testing.assert_frame_equal(data, loaded_data)
+    assert isinstance(loaded_data['age_group'].values, np.memmap)
+
+    with pytest.raises(snapshots.SnapshotFormatError, match="Unknown snapshot format"):
+        dp.export_snapshot(data, tmp_path, 'test_snapshot', fmt='xml')
+
+    logging.info("test_npy_snapshot_round_trip completed successfully.")
+
+def test_snapshot_writer(tmp_path):
+    """
+    Test exporting snapshots in the background with the SnapshotWriter class from the snapshots module.
+
+    Tests include:
+    1. Compressed 'npz' and 'csv.gz' snapshots survive the round trip.
+    2. Submitted writes resolve to their paths, and flush waits for every write.
+    3. A failed write is raised by flush and leaves neither the snapshot nor a temporary file behind.
+    """
+    logging.info("Starting test_snapshot_writer...")
+
+    data = pd.DataFrame({
+        'id': ['a', 'b', None],
+        'widget_list': [[{'name': 'widget1', 'amount': 10}], [], float('nan')],
+        'created_at': pd.to_datetime(['2020-01-31T14:50:26Z', '2020-07-16T18:32:48Z', '2020-01-01T00:00:00Z'])
+    })
+    with snapshots.SnapshotWriter() as writer:
+        npz_path = dp.export_snapshot(data, tmp_path, 'npz_snapshot', fmt='npz', writer=writer)
+        csv_future = writer.submit(data[['created_at']], str(tmp_path / 'csv_snapshot.csv.gz'), 'csv.gz')
+        assert writer.flush() == [npz_path, csv_future.result()]
+    pd.testing.assert_frame_equal(data, dp.load_from_staging(str(tmp_path), os.path.basename(npz_path)))
+    assert dp.load_from_staging(str(tmp_path), 'csv_snapshot.csv.gz')['created_at'].tolist() == \
+           data['created_at'].astype(str).tolist()
+
+    with pytest.raises(AttributeError):
+        with snapshots.SnapshotWriter() as writer:
+            writer.submit(object(), str(tmp_path / 'broken.csv'), 'csv')
+    assert sorted(os.listdir(tmp_path)) == ['csv_snapshot.csv.gz', os.path.basename(npz_path)]
+
+    logging.info("test_snapshot_writer completed successfully.")
+
+
 def test_deduplicate(complex_data):
     """
     Test the deduplicate function from the dp module.
@@ -103,6 +226,25 @@ def test_deduplicate(complex_data):
     logging.info("test_deduplicate completed successfully.")
 
 
+def test_deduplicate_across_batches():
+    """
+    Test the deduplicate function from the dp module with keys seen in earlier batches.
+
+    Tests include:
+    1. Duplicates within and across batches are dropped.
+    """
+    logging.info("Starting test_deduplicate_across_batches...")
+
+    seen = set()
+    first = pd.DataFrame({'id': [1, 1, 2], 'created_at': ['2021-01-01', '2021-01-01', '2021-01-03']})
+    second = pd.DataFrame({'id': [2, 3], 'created_at': ['2021-01-03', '2021-01-03']})
+    assert len(dp.deduplicate(first, seen=seen)) == 2
+    assert list(dp.deduplicate(second, seen=seen)['id']) == [3]
+    assert len(seen) == 3
+
+    logging.info("test_deduplicate_across_batches completed successfully.")
+
+
 def test_rank_users(complex_data):
     """
     Test the rank_users function from the dp module.
@@ -132,6 +274,10 @@ def test_rank_users(complex_data):
     # Check the rank within each age group is as expected
     assert list(ranked_data['age_group_rank']) == [1, 2, 1, 2]
 
+    # Tied scores share the lowest rank
+    tied_data = pd.DataFrame({'age_group': [1, 1, 1, 1], 'user_score': [5, 7, 5, 3]})
+    assert dp.rank_users(tied_data)['age_group_rank'].tolist() == [1, 2, 2, 4]
+
     # Test with empty DataFrame
     with pytest.raises(ValueError, match="Input DataFrame is empty"):
         dp.rank_users(pd.DataFrame())
@@ -139,6 +285,64 @@ def test_rank_users(complex_data):
     logging.info("test_rank_users completed successfully.")
 
 
+def test_rank_users_with_score_index():
+    """
+    Test the rank_users function from the dp module with a score index built over several batches.
+
+    Tests include:
+    1. Ranking batches separately against the index matches ranking the whole data at once.
+    """
+    logging.info("Starting test_rank_users_with_score_index...")
+
+    data = pd.DataFrame({
+        'user_id': [1, 2, 3, 4, 5, 6],
+        'age_group': ['A', 'A', 'B', 'B', 'A', 'B'],
+        'user_score': [30, 40, 20, 10, 40, 50]
+    })
+    batches = [data.iloc[:3], data.iloc[3:]]
+    score_index = dp.build_score_index(batches)
+
+    ranked_batches = pd.concat(dp.rank_users(batch, score_index=score_index) for batch in batches)
+    expected = dp.rank_users(data)
+    assert ranked_batches['age_group_rank'].sort_index().tolist() == expected['age_group_rank'].sort_index().tolist()
+
+    logging.info("test_rank_users_with_score_index completed successfully.")
+
+
+def test_top_k_per_group(complex_data):
+    """
+    Test the top_k_per_group function from the dp module.
+
+    Tests include:
+    1. Partial selection on unranked data, with ties broken by row order.
+    2. Selection by rank on data ranked by rank_users gives the same rows.
+    3. Rows repeating a record, as in flattened data, count once on both paths.
+    4. Handling of an invalid k.
+    """
+    logging.info("Starting test_top_k_per_group...")
+
+    data = pd.DataFrame({
+        'id': [1, 2, 3, 4, 5, 6, 7],
+        'age_group': [2, 1, 1, 2, 1, 2, 1],
+        'user_score': [5, 3, 8, 6, 8, 9, 1]
+    })
+    top_users = dp.top_k_per_group(data, 2)
+    assert top_users['id'].tolist() == [3, 5, 6, 4]
+    assert dp.top_k_per_group(dp.rank_users(data), 2)['id'].tolist() == [3, 5, 6, 4]
+    assert dp.top_k_per_group(data, 10)['id'].tolist() == [3, 5, 2, 7, 6, 4, 1]
+
+    flattened = dp.flatten_and_extract_widgets(dp.rank_users(data.assign(
+        created_at=pd.Timestamp('2020-01-01'), widget_list=[[{'name': 'a', 'amount': 1}, {'name': 'b', 'amount': 2}]] * 7)))
+    assert len(flattened) == 14
+    assert dp.top_k_per_group(flattened, 2)['id'].tolist() == [3, 5, 6, 4]
+    assert dp.top_k_per_group(flattened.drop(columns=['age_group_rank']), 2)['id'].tolist() == [3, 5, 6, 4]
+
+    with pytest.raises(ValueError, match="k must be at least 1"):
+        dp.top_k_per_group(data, 0)
+
+    logging.info("test_top_k_per_group completed successfully.")
+
+
 def test_get_top_user_per_age_group(complex_data):
     """
     Test the get_top_user_per_age_group function from dp module.
@@ -184,6 +388,29 @@ def test_flatten_widget_list():
 
     logging.info("test_flatten_widget_list completed successfully.")
 
+def test_flatten_and_extract_widgets():
+    """
+    Test the flatten_and_extract_widgets function from dp module.
+
+    Tests include:
+    1. Same output as flatten_widget_list followed by extract_widget_info, including empty lists.
+    2. Handling of empty input data.
+    """
+    logging.info("Starting test_flatten_and_extract_widgets...")
+
+    data = pd.DataFrame({
+        'id': [1, 2, 3],
+        'widget_list': [[{'name': 'widget1', 'amount': 10}, {'name': 'widget2', 'amount': 20}], [], [{'name': 'widget3', 'amount': 30}]]
+    })
+    expected = dp.extract_widget_info(dp.flatten_widget_list(data))
+    pd.testing.assert_frame_equal(dp.flatten_and_extract_widgets(data), expected)
+
+    # Test with empty DataFrame
+    with pytest.raises(ValueError, match="Input DataFrame is empty"):
+        dp.flatten_and_extract_widgets(pd.DataFrame())
+
+    logging.info("test_flatten_and_extract_widgets completed successfully.")
+
 def test_convert_unsupported_data_types():
     """
     Test the convert_unsupported_data_types function from dp module.
@@ -198,6 +425,14 @@ def test_convert_unsupported_data_types():
     converted_data = dp.convert_unsupported_data_types(data)
     assert converted_data['list_column'].dtype == object
     assert converted_data['dict_column'].dtype == object
+    assert json.loads(converted_data['dict_column'][0]) == {'key': 'value'}
+
+    # Only columns declared as nested are converted, the rest pass through untouched
+    data = pd.DataFrame({'widget_list': [[{'name': 'widget1'}]], 'id': [['not', 'nested']], 'user_score': [0.5]})
+    converted_data = dp.convert_unsupported_data_types(data)
+    assert converted_data['widget_list'][0] == '[{"name": "widget1"}]'
+    assert converted_data['id'][0] == ['not', 'nested']
+    assert converted_data['user_score'].dtype == float
 
     # Test with empty DataFrame
     with pytest.raises(ValueError, match="Input DataFrame is empty"):
@@ -205,6 +440,41 @@ def test_convert_unsupported_data_types():
 
     logging.info("test_convert_unsupported_data_types completed successfully.")
 
+def test_compact_dtypes():
+    """
+    Test the compact_dtypes function from dp module.
+
+    Tests include:
+    1. Repeated strings become categorical and integers are downcast, without changing any value.
+    2. Mostly distinct strings, floats and nested columns are left as they are.
+    3. The compact types survive deduplication, ranking and widget flattening.
+    """
+    logging.info("Starting test_compact_dtypes...")
+
+    data = dp.extract(data_path=DATA_PATH)
+    flattened = dp.flatten_and_extract_widgets(dp.rank_users(dp.deduplicate(data)))
+    compacted = dp.compact_dtypes(flattened)
+    for column in ['id', 'email', 'location', 'widget_name']:
+        assert isinstance(compacted[column].dtype, pd.CategoricalDtype), column
+    assert compacted['age_group'].dtype == np.int8
+    assert compacted['user_score'].dtype == float and compacted['widget_list'].dtype == object
+    assert compacted.memory_usage(deep=True).sum() < flattened.memory_usage(deep=True).sum()
+    restored = compacted.astype(flattened.dtypes.to_dict())
+    # Categories hold missing widget names as NaN rather than None
+    restored['widget_name'] = restored['widget_name'].where(restored['widget_name'].notna(), None)
+    pd.testing.assert_frame_equal(restored, flattened)
+
+    # Emails are distinct before flattening
+    compacted = dp.compact_dtypes(data)
+    assert compacted['email'].dtype == object and isinstance(compacted['location'].dtype, pd.CategoricalDtype)
+
+    transformed = dp.flatten_and_extract_widgets(dp.rank_users(dp.deduplicate(compacted)))
+    assert isinstance(transformed['location'].dtype, pd.CategoricalDtype) and transformed['age_group'].dtype == np.int8
+    pd.testing.assert_frame_equal(transformed.astype(flattened.dtypes.to_dict()), flattened)
+
+    logging.info("test_compact_dtypes completed successfully.")
+
+
 def test_extract_widget_info():
     """
     Test the extract_widget_info function from dp module.
@@ -0,0 +1,410 @@
+import os, sys
+import sqlite3
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import logging
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
+
+import db_operations as db_ops
+from rankings import AgeGroupRankings
+
+logging.basicConfig(level=logging.INFO)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """Fixture to provide the path of an empty SQLite database for testing."""
+    return str(tmp_path / 'test.db')
+
+
+@pytest.fixture
+def transformed_data():
+    """Fixture to provide flattened user data for testing."""
+    return pd.DataFrame({
+        'id': ['a', 'a', 'b', 'c'],
+        'created_at': pd.to_datetime(['2020-01-01T00:00:00Z', '2020-01-01T00:00:00Z',
+                                      '2020-02-01T00:00:00Z', '2020-03-01T00:00:00Z']),
+        'location': ['Poland', 'Poland', 'Greece', 'Poland'],
+        'widget_name': ['widget1', 'widget2', 'widget3', None],
+        'widget_amount': [10.0, 20.0, 30.0, None]
+    })
+
+
+def test_load_batches(db_path, transformed_data):
+    """
+    Test the load function from the db_ops module with a stream of batches.
+
+    Tests include:
+    1. Batches are appended into one table, replacing any previous contents.
+    2. Handling of a stream without any rows.
+    """
+    logging.info("Starting test_load_batches...")
+
+    db_ops.load(transformed_data, db_path, table_name='transformed_data')
+    db_ops.load(iter([transformed_data.iloc[:2], transformed_data.iloc[2:]]), db_path, table_name='transformed_data')
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM transformed_data').fetchone()[0] == len(transformed_data)
+
+    with pytest.raises(ValueError, match="Input data is empty"):
+        db_ops.load(iter([]), db_path, table_name='transformed_data')
+
+    logging.info("test_load_batches completed successfully.")
+
+
+def test_bulk_load(db_path, transformed_data):
+    """
+    Test the bulk_load function from the db_ops module.
+
+    Tests include:
+    1. Rows and explicit column types are written and secondary indexes are built.
+    2. The journal mode is restored after the load.
+    3. Handling of empty input data.
+    """
+    logging.info("Starting test_bulk_load...")
+
+    row_count = db_ops.bulk_load(transformed_data, db_path, table_name='transformed_data', indexes=[['location']])
+    assert row_count == len(transformed_data)
+
+    with sqlite3.connect(db_path) as conn:
+        column_types = {name: column_type for _, name, column_type, _, _, _ in conn.execute('PRAGMA table_info(transformed_data)')}
+        rows = conn.execute('SELECT id, created_at, widget_amount FROM transformed_data').fetchall()
+        index_names = [name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+        journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+    assert column_types['created_at'] == 'TIMESTAMP' and column_types['widget_amount'] == 'REAL'
+    assert rows[0] == ('a', '2020-01-01 00:00:00+00:00', 10.0) and rows[3][2] is None
+    assert index_names == ['idx_transformed_data_location']
+    assert journal_mode == 'delete'
+
+    with pytest.raises(ValueError, match="Input data is empty"):
+        db_ops.bulk_load(pd.DataFrame(), db_path)
+
+    logging.info("test_bulk_load completed successfully.")
+
+
+def test_load_star_schema(db_path):
+    """
+    Test the load_star_schema and drop_star_schema functions from the db_ops module.
+
+    Tests include:
+    1. Users, widgets and locations are stored once each, keyed on integer surrogate keys.
+    2. The transformed_data view returns the rows a wide load stores, and a wide load can replace it.
+    3. The state fingerprint tells the view and the table apart, though their row counts match.
+    4. Dropping the star schema leaves the wide table alone.
+    5. Handling of missing columns.
+    """
+    logging.info("Starting test_load_star_schema...")
+
+    data = pd.DataFrame({
+        'id': ['a', 'a', 'b', 'c'],
+        'email': ['a@a.com', 'a@a.com', 'b@b.com', 'c@c.com'],
+        'age_group': [1, 1, 2, 1],
+        'user_score': [0.5, 0.5, 0.25, 0.75],
+        'revenue': [10.0, 10.0, 20.0, 30.0],
+        'widget_list': ['{"name": "w1", "amount": 1}', '{"name": "w2", "amount": 2}', '{"name": "w3", "amount": 3}', None],
+        'location': ['Poland', 'Poland', 'Greece', None],
+        'created_at': pd.to_datetime(['2020-01-01T00:00:00Z', '2020-01-01T00:00:00Z',
+                                      '2020-02-01T00:00:00Z', '2020-03-01T00:00:00Z']),
+        'age_group_rank': [2, 2, 1, 1],
+        'widget_name': ['w1', 'w2', 'w3', None],
+        'widget_amount': [1.0, 2.0, 3.0, None],
+    })
+    assert db_ops.load_star_schema(data, db_path) == len(data)
+    star_state = db_ops.state_fingerprint(db_path, ['transformed_data'])
+    assert db_ops.state_fingerprint(db_path, ['transformed_data']) == star_state
+
+    with sqlite3.connect(db_path) as conn:
+        users = conn.execute('SELECT user_key, id, location_key FROM users').fetchall()
+        widgets = conn.execute('SELECT user_key, position, name, amount FROM widgets').fetchall()
+        locations = conn.execute('SELECT location_key, location FROM locations').fetchall()
+        star = pd.read_sql('SELECT * FROM transformed_data', conn)
+    assert users == [(1, 'a', 1), (2, 'b', 2), (3, 'c', None)]
+    assert widgets == [(1, 0, 'w1', 1), (1, 1, 'w2', 2), (2, 0, 'w3', 3)]
+    assert locations == [(1, 'Poland'), (2, 'Greece')]
+
+    db_ops.bulk_load(data, db_path, table_name='transformed_data')
+    with sqlite3.connect(db_path) as conn:
+        wide = pd.read_sql('SELECT * FROM transformed_data', conn)
+    pd.testing.assert_frame_equal(star, wide)
+    assert db_ops.state_fingerprint(db_path, ['transformed_data']) != star_state
+
+    db_ops.drop_star_schema(db_path)
+    with sqlite3.connect(db_path) as conn:
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    assert tables == ['transformed_data']
+
+    with pytest.raises(ValueError, match="Missing required columns: email"):
+        db_ops.load_star_schema(data.drop(columns=['email']), db_path)
+
+    logging.info("test_load_star_schema completed successfully.")
+
+
+def test_upsert(db_path, transformed_data):
+    """
+    Test the upsert function from the db_ops module.
+
+    Tests include:
+    1. The first run inserts every row and a rerun of the same data changes nothing.
+    2. Rows before the high-water mark are skipped, changed and removed widgets after it are applied.
+    3. Late rows before the high-water mark are loaded when the mark is not applied.
+    4. Timestamps key the same rows whatever else their batch holds, such as sub-second timestamps.
+    5. A table replaced by a full load is replaced again with every row given, the mark notwithstanding.
+    6. Handling of empty input data.
+    """
+    logging.info("Starting test_upsert...")
+
+    assert db_ops.upsert(transformed_data, db_path) == 4
+    assert db_ops.upsert(transformed_data, db_path) == 0
+
+    # 'a' is before the high-water mark so its change is skipped, while 'c' gets a new amount
+    changed_data = transformed_data.copy()
+    changed_data['widget_amount'] = [11.0, 21.0, 30.0, 40.0]
+    assert db_ops.upsert(changed_data, db_path) == 1
+
+    # 'c' gains a second widget, then loses it again
+    new_widget = changed_data.iloc[[3]].assign(widget_name='widget4')
+    assert db_ops.upsert(pd.concat([changed_data.iloc[[3]], new_widget]), db_path) == 1
+    assert db_ops.upsert(changed_data.iloc[[3]], db_path) == 1
+
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute('SELECT id, widget_position, widget_amount FROM transformed_data ORDER BY id').fetchall()
+        high_water_mark = conn.execute('SELECT high_water_mark FROM load_state').fetchone()[0]
+    assert rows == [('a', 0, 10.0), ('a', 1, 20.0), ('b', 0, 30.0), ('c', 0, 40.0)]
+    assert high_water_mark == '2020-03-01 00:00:00+00:00'
+
+    # A late record of a new user is skipped behind the high-water mark, unless the mark is not applied
+    late = transformed_data.iloc[[0]].assign(id='e', created_at=pd.to_datetime(['2020-02-15T00:00:00Z']))
+    assert db_ops.upsert(late, db_path) == 0
+    assert db_ops.upsert(late, db_path, watermark=False) == 1
+    assert db_ops.high_water_mark(db_path) == '2020-03-01 00:00:00+00:00'
+
+    sub_second = changed_data.iloc[[3]].assign(id='f', created_at=pd.to_datetime(['2020-03-02T00:00:00.250Z']))
+    assert db_ops.upsert(pd.concat([changed_data.iloc[[3]], sub_second]), db_path) == 1
+    assert db_ops.high_water_mark(db_path) == '2020-03-02 00:00:00+00:00'
+    assert db_ops.is_upserted(db_path)
+
+    db_ops.bulk_load(transformed_data, db_path, table_name='transformed_data')
+    assert not db_ops.is_upserted(db_path)
+    assert db_ops.upsert(transformed_data, db_path) == 4 and db_ops.is_upserted(db_path)
+
+    with pytest.raises(ValueError, match="Input data is empty"):
+        db_ops.upsert(pd.DataFrame(), db_path)
+
+    logging.info("test_upsert completed successfully.")
+
+
+def test_session(db_path, transformed_data):
+    """
+    Test the Session class from the db_ops module.
+
+    Tests include:
+    1. Writes made through a session are committed together when it exits cleanly.
+    2. Writes are rolled back if an exception escapes the session.
+    3. Storing an empty inverted index raises IndexStorageError, with a session or without.
+    4. A bulk-load session runs its transaction with synchronous off, and bulk loads through it enlarge the
+       page cache, until it commits and restores them.
+    """
+    logging.info("Starting test_session...")
+
+    with db_ops.Session(db_path) as session:
+        db_ops.bulk_load(transformed_data, db_path, table_name='transformed_data', session=session)
+        db_ops.store_inverted_index(db_ops.create_inverted_index(transformed_data), db_path, session=session)
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM transformed_data').fetchone()[0] == len(transformed_data)
+        assert conn.execute('SELECT COUNT(*) FROM inverted_index').fetchone()[0] == 2
+
+    with pytest.raises(RuntimeError):
+        with db_ops.Session(db_path) as session:
+            db_ops.load(transformed_data.iloc[:1], db_path, table_name='transformed_data', session=session)
+            raise RuntimeError("Stage failed")
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM transformed_data').fetchone()[0] == len(transformed_data)
+
+    empty_index = db_ops.create_inverted_index(transformed_data).iloc[:0]
+    with pytest.raises(db_ops.IndexStorageError, match="empty"):
+        with db_ops.Session(db_path) as session:
+            db_ops.store_inverted_index(empty_index, db_path, session=session)
+    with pytest.raises(db_ops.IndexStorageError, match="empty"):
+        db_ops.store_inverted_index(empty_index, db_path)
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM inverted_index').fetchone()[0] == 2
+
+    session = db_ops.Session(db_path, bulk_load=True)
+    pragmas = [session.conn.execute(f'PRAGMA {pragma}').fetchone()[0] for pragma in ('synchronous', 'cache_size')]
+    with session:
+        db_ops.bulk_load(transformed_data, db_path, table_name='transformed_data', cache_size_kib=1024, session=session)
+        db_ops.bulk_load(transformed_data, db_path, table_name='transformed_data', cache_size_kib=1024, session=session)
+        assert session.conn.execute('PRAGMA synchronous').fetchone()[0] == 0
+        assert session.conn.execute('PRAGMA cache_size').fetchone()[0] == -1024
+        session.commit()
+        assert [session.conn.execute(f'PRAGMA {pragma}').fetchone()[0]
+                for pragma in ('synchronous', 'cache_size')] == pragmas
+
+    logging.info("test_session completed successfully.")
+
+
+def test_reader_pool(db_path, transformed_data):
+    """
+    Test the ReaderPool class from the db_ops module.
+
+    Tests include:
+    1. Concurrent reads from many threads while a session holds an open write transaction.
+    2. Pooled connections are read-only.
+    """
+    logging.info("Starting test_reader_pool...")
+
+    db_ops.bulk_load(transformed_data, db_path, table_name='transformed_data')
+    with db_ops.Session(db_path) as session, db_ops.ReaderPool(db_path, size=2) as pool:
+        db_ops.load(transformed_data.iloc[:1], db_path, table_name='transformed_data', session=session)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            counts = list(executor.map(lambda _: pool.query('SELECT COUNT(*) FROM transformed_data')[0][0], range(16)))
+        assert counts == [len(transformed_data)] * 16
+
+        with pytest.raises(db_ops.DatabaseError, match="readonly"):
+            pool.query('DELETE FROM transformed_data')
+
+    logging.info("test_reader_pool completed successfully.")
+
+
+def test_posting_lists(db_path, transformed_data):
+    """
+    Test the create_posting_lists, store_posting_lists, lookup and lookup_many functions from the db_ops module.
+
+    Tests include:
+    1. Posting lists hold each (location, user_id) pair once, sorted.
+    2. Lookups return sorted ids, and no ids for an unknown location, with or without a reader pool.
+    3. Handling of missing columns.
+    """
+    logging.info("Starting test_posting_lists...")
+
+    postings = db_ops.create_posting_lists(transformed_data)
+    assert postings.values.tolist() == [['Greece', 'b'], ['Poland', 'a'], ['Poland', 'c']]
+
+    db_ops.store_posting_lists(postings, db_path)
+    assert db_ops.lookup('Poland', db_path=db_path) == ['a', 'c']
+    assert db_ops.lookup_many(['Greece', 'Nowhere'], db_path=db_path) == {'Greece': ['b'], 'Nowhere': []}
+    with db_ops.ReaderPool(db_path) as pool:
+        assert db_ops.lookup('Greece', db_path=db_path, pool=pool) == ['b']
+
+    with pytest.raises(ValueError, match="Missing required columns"):
+        db_ops.create_posting_lists(transformed_data.drop(columns='location'))
+
+    logging.info("test_posting_lists completed successfully.")
+
+
+def test_update_posting_lists(db_path, transformed_data):
+    """
+    Test the update_posting_lists and update_inverted_index functions from the db_ops module.
+
+    Tests include:
+    1. Only the postings of changed, new and deleted users are rewritten, matching a full rebuild.
+    2. The changed locations are returned and only their inverted index rows are rebuilt.
+    """
+    logging.info("Starting test_update_posting_lists...")
+
+    db_ops.store_posting_lists(db_ops.create_posting_lists(transformed_data), db_path)
+    db_ops.store_inverted_index(db_ops.create_inverted_index(transformed_data), db_path)
+
+    delta = pd.concat([transformed_data[transformed_data['id'] == 'b'].assign(location='Poland'),
+                       transformed_data[transformed_data['id'] == 'c'].assign(id='d')])
+    changed_locations = db_ops.update_posting_lists(delta, db_path, deleted_ids=['a'])
+    assert changed_locations == {'Greece', 'Poland'}
+
+    current = pd.concat([transformed_data[transformed_data['id'] == 'c'], delta])
+    assert db_ops.lookup_many(['Poland', 'Greece'], db_path=db_path) == {'Poland': ['b', 'c', 'd'], 'Greece': []}
+    assert db_ops.update_posting_lists(current, db_path) == set()
+
+    db_ops.update_inverted_index(current, changed_locations, db_path)
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT location, id FROM inverted_index').fetchall() == [('Poland', 'c,b,d')]
+
+    logging.info("test_update_posting_lists completed successfully.")
+
+
+def test_search_index(db_path, transformed_data):
+    """
+    Test the store_search_index, update_search_index, drop_search_index and search functions from the db_ops module.
+
+    Tests include:
+    1. Prefix searches match the start of any word of a value, ignoring case.
+    2. Term searches match a whole value or its tail from a word on, such as an email domain.
+    3. Applying a delta of changed and deleted users matches a full rebuild.
+    4. Dropped or missing search tables and invalid queries raise errors.
+    """
+    logging.info("Starting test_search_index...")
+
+    data = transformed_data.assign(
+        email=['jo.doe@mail.com', 'jo.doe@mail.com', 'b@Mail.com', 'c@mail.org'],
+        widget_name=['Oryx gazella', 'Beisa oryx', 'Oryctolagus', None])
+    assert db_ops.store_search_index(data, db_path=db_path) == {'email_search': 10, 'widget_name_search': 5}
+
+    assert db_ops.search('ORYX', field='widget_name', db_path=db_path) == ['a']
+    assert db_ops.search('ory', field='widget_name', db_path=db_path) == ['a', 'b']
+    assert db_ops.search('doe@', db_path=db_path) == ['a']
+    assert db_ops.search('mail.com', match='term', db_path=db_path) == ['a', 'b']
+    assert db_ops.search('mail', match='term', db_path=db_path) == []
+    with db_ops.ReaderPool(db_path) as pool:
+        assert db_ops.search('m', db_path=db_path, pool=pool) == ['a', 'b', 'c']
+
+    delta = data[data['id'] == 'b'].assign(email='b@mail.org', widget_name='Oryx beisa')
+    db_ops.update_search_index(delta, db_path=db_path, deleted_ids=['a'])
+    assert db_ops.search('oryx', field='widget_name', db_path=db_path) == ['b']
+    assert db_ops.search('mail.org', match='term', db_path=db_path) == ['b', 'c']
+    assert db_ops.search('jo', db_path=db_path) == []
+
+    with pytest.raises(ValueError, match="empty"):
+        db_ops.search('', db_path=db_path)
+    with pytest.raises(ValueError, match="Unknown match"):
+        db_ops.search('mail', match='suffix', db_path=db_path)
+    db_ops.drop_search_index(db_path=db_path)
+    with pytest.raises(db_ops.DatabaseError):
+        db_ops.search('mail', db_path=db_path)
+
+    logging.info("test_search_index completed successfully.")
+
+
+def test_store_rankings(db_path):
+    """
+    Test the store_rankings and load_rankings functions from the db_ops module.
+
+    Tests include:
+    1. The first store writes every record, later stores only the changed ones.
+    2. Loaded rankings match the stored ones, and are empty if nothing was stored.
+    3. A table keyed on user ids alone, as stored by earlier versions, is loaded empty and replaced.
+    4. A DataFrame of every record, as a streaming run collects, replaces the table.
+    """
+    logging.info("Starting test_store_rankings...")
+
+    assert len(db_ops.load_rankings(db_path)) == 0
+
+    created_at = pd.Timestamp('2020-01-01T00:00:00Z')
+    users = pd.DataFrame({'id': ['a', 'b', 'c'], 'created_at': [created_at] * 3, 'age_group': [1, 1, 2],
+                          'user_score': [0.5, 0.9, 0.3]})
+    rankings = AgeGroupRankings.from_data(users)
+    rankings.pop_changes()
+    assert db_ops.store_rankings(rankings, db_path) == 3
+
+    rankings.upsert(pd.DataFrame({'id': ['a'], 'created_at': [created_at], 'age_group': [1], 'user_score': [0.95]}))
+    rankings.delete([('c', created_at)])
+    assert db_ops.store_rankings(rankings, db_path) == 2
+
+    loaded = db_ops.load_rankings(db_path)
+    assert len(loaded) == 2 and loaded.rank('a', created_at) == 1 and loaded.rank('b', created_at) == 2
+    assert db_ops.store_rankings(loaded, db_path) == 0
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('DROP TABLE age_group_rankings')
+        conn.execute('CREATE TABLE age_group_rankings (id TEXT PRIMARY KEY, age_group INTEGER, user_score REAL)')
+    assert len(db_ops.load_rankings(db_path)) == 0
+    assert db_ops.store_rankings(loaded, db_path) == 2 and len(db_ops.load_rankings(db_path)) == 2
+
+    assert db_ops.store_rankings(users.assign(email='x'), db_path) == 3
+    loaded = db_ops.load_rankings(db_path)
+    assert len(loaded) == 3 and loaded.rank('b', created_at) == 1 and loaded.rank('c', created_at) == 1
+
+    logging.info("test_store_rankings completed successfully.")
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,86 @@
+import os, sys
+import pytest
+import numpy as np
+import pandas as pd
+import logging
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
+
+import data_processing as dp
+from fingerprints import FingerprintStore, hash_keys
+
+logging.basicConfig(level=logging.INFO)
+
+
+@pytest.fixture
+def records():
+    """Fixture to provide records with (id, created_at) keys for testing."""
+    return pd.DataFrame({
+        'id': ['a', 'b', 'a', 'c'],
+        'created_at': pd.to_datetime(['2020-01-01T00:00:00Z', '2020-01-01T00:00:00Z',
+                                      '2020-02-01T00:00:00Z', '2020-03-01T00:00:00Z']),
+    })
+
+
+def test_hash_keys(records):
+    """
+    Test the hash_keys function from the fingerprints module.
+
+    Tests include:
+    1. Distinct keys hash differently and equal keys hash equally.
+    2. Timestamps given as text hash like the parsed timestamps.
+    """
+    logging.info("Starting test_hash_keys...")
+
+    hashes = hash_keys(records)
+    assert hashes.dtype == np.uint64 and len(set(hashes)) == 4
+    assert (hash_keys(records.assign(created_at=records['created_at'].astype(str))) == hashes).all()
+
+    logging.info("test_hash_keys completed successfully.")
+
+
+@pytest.mark.parametrize('bloom_bits_per_key', [None, 10])
+def test_fingerprint_store(tmp_path, bloom_bits_per_key):
+    """
+    Test the FingerprintStore class from the fingerprints module.
+
+    Tests include:
+    1. Added keys are found and others are not, across folds of pending keys into the store.
+    2. The store is persisted and reopened.
+    """
+    logging.info("Starting test_fingerprint_store...")
+
+    rng = np.random.default_rng(0)
+    added, absent = rng.integers(0, 2**63, 20000, dtype=np.uint64), rng.integers(0, 2**63, 1000, dtype=np.uint64)
+    store = FingerprintStore(capacity=20000, bloom_bits_per_key=bloom_bits_per_key, path=str(tmp_path / 'fingerprints.npz'))
+    for batch in np.array_split(added, 7):
+        store.add(batch)
+    assert len(store) == len(added)
+    assert store.contains(added).all() and not store.contains(absent).any()
+
+    store.save()
+    reopened = FingerprintStore.open(store.path)
+    assert len(reopened) == len(added) and reopened.contains(added).all() and not reopened.contains(absent).any()
+
+    logging.info("test_fingerprint_store completed successfully.")
+
+
+def test_deduplicate_with_fingerprint_store(records):
+    """
+    Test the deduplicate function from the dp module with a FingerprintStore.
+
+    Tests include:
+    1. Keys seen in earlier batches are dropped and the store's counters are updated.
+    """
+    logging.info("Starting test_deduplicate_with_fingerprint_store...")
+
+    store = FingerprintStore()
+    assert dp.deduplicate(records.iloc[:2], seen=store)['id'].tolist() == ['a', 'b']
+    assert dp.deduplicate(pd.concat([records, records.iloc[[3]]]), seen=store)['id'].tolist() == ['a', 'c']
+    assert store.stats['rows'] == 6 and store.stats['new_rows'] == 4 and len(store) == 4
+
+    logging.info("test_deduplicate_with_fingerprint_store completed successfully.")
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,48 @@
+import os, sys
+import pytest
+import logging
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../performance')))
+
+import data_processing as dp
+import validation
+from generate_data import generate_data, generate_records
+
+logging.basicConfig(level=logging.INFO)
+
+
+def test_generate_data(tmp_path):
+    """
+    Test the generate_data function from the generate_data benchmark module.
+
+    Tests include:
+    1. The generated data meets the default expectations of the raw data.
+    2. The duplicate rate, widget list lengths and location cardinality follow the parameters.
+    3. Duplicates repeat lines of earlier chunks too.
+    4. The same seed always gives the same lines.
+    """
+    logging.info("Starting test_generate_data...")
+
+    data_path = str(tmp_path / 'data.json')
+    generate_data(data_path, 5000, duplicate_rate=0.1, max_widgets=5, locations=7, chunk_rows=2000)
+    data = dp.extract(data_path=data_path)
+    assert len(data) == 5000
+    assert validation.validate(data)['success']
+
+    duplicated = data.duplicated(['id', 'created_at'])
+    assert 400 < duplicated.sum() < 600
+    first_chunk = data.iloc[:2000]
+    assert data.iloc[2000:][duplicated.iloc[2000:]]['id'].isin(first_chunk['id']).any()
+    assert data['widget_list'].map(len).max() == 5 and data['widget_list'].map(len).min() == 0
+    assert data['location'].nunique() == 7
+
+    lines = [line for chunk in generate_records(3000, seed=1, chunk_rows=1000) for line in chunk]
+    assert lines == [line for chunk in generate_records(3000, seed=1, chunk_rows=1000) for line in chunk]
+    assert lines != [line for chunk in generate_records(3000, seed=2, chunk_rows=1000) for line in chunk]
+
+    logging.info("test_generate_data completed successfully.")
+
+
+if __name__ == "__main__":
+    pytest.main()
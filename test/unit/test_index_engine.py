@@ -0,0 +1,149 @@
+import os, sys
+import pytest
+import pandas as pd
+import logging
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
+
+from index_engine import MultiFieldIndex, IndexQueryError, index_columns, delta_path
+
+logging.basicConfig(level=logging.INFO)
+
+
+@pytest.fixture(scope='module')
+def transformed_data():
+    """Fixture to provide flattened user data for testing."""
+    return pd.DataFrame({
+        'id': ['a', 'a', 'b', 'c', 'd'],
+        'email': ['a@msn.com', 'a@msn.com', 'b@gmail.com', 'c@MSN.com', 'd@yahoo.com'],
+        'age_group': [1, 1, 2, 2, 3],
+        'location': ['Poland', 'Poland', 'Greece', 'Poland', None],
+        'created_at': pd.to_datetime(['2020-01-01T00:00:00Z', '2020-01-01T00:00:00Z', '2020-02-01T00:00:00Z',
+                                      '2020-02-15T00:00:00Z', '2020-03-01T00:00:00Z']),
+        'widget_name': ['Lycaon pictus', 'widget2', 'widget2', None, 'widget2'],
+    })
+
+
+def test_index_columns(transformed_data):
+    """
+    Test the index_columns function from the index_engine module.
+
+    Tests include:
+    1. Derived fields are computed and repeated rows are dropped.
+    2. Handling of missing columns.
+    """
+    logging.info("Starting test_index_columns...")
+
+    columns = index_columns(transformed_data, fields=['email_domain', 'created_month'])
+    assert columns.values.tolist() == [['a', 'msn.com', '2020-01'], ['b', 'gmail.com', '2020-02'],
+                                       ['c', 'msn.com', '2020-02'], ['d', 'yahoo.com', '2020-03']]
+
+    with pytest.raises(ValueError, match="Missing required columns: email"):
+        index_columns(transformed_data.drop(columns='email'))
+
+    logging.info("test_index_columns completed successfully.")
+
+
+def test_multi_field_index_query(transformed_data):
+    """
+    Test the query method of the MultiFieldIndex class from the index_engine module.
+
+    Tests include:
+    1. Single terms, including numeric, quoted and unknown values.
+    2. AND, OR and NOT with their precedence and parentheses.
+    3. Handling of malformed queries and fields that are not indexed.
+    """
+    logging.info("Starting test_multi_field_index_query...")
+
+    index = MultiFieldIndex.build(transformed_data)
+    assert index.query('location=Poland').tolist() == ['a', 'c']
+    assert index.query('age_group=2').tolist() == ['b', 'c']
+    assert index.query('widget_name="Lycaon pictus"').tolist() == ['a']
+    assert index.query('location=Nowhere').tolist() == []
+
+    assert index.query('location=Poland AND widget_name=widget2 AND age_group=1').tolist() == ['a']
+    assert index.query('location=Greece OR location=Poland AND email_domain=msn.com').tolist() == ['a', 'b', 'c']
+    assert index.query('(location=Greece OR location=Poland) AND created_month=2020-02').tolist() == ['b', 'c']
+    assert index.query('NOT location=Poland').tolist() == ['b', 'd']
+    assert index.query('widget_name=widget2 AND NOT NOT email_domain=msn.com').tolist() == ['a']
+
+    for query in ['location=Poland AND', '(location=Poland', 'location=Poland)', 'Poland']:
+        with pytest.raises(IndexQueryError):
+            index.query(query)
+    with pytest.raises(IndexQueryError, match="not indexed"):
+        index.query('revenue=1')
+
+    logging.info("test_multi_field_index_query completed successfully.")
+
+
+def test_multi_field_index_save_load(tmp_path, transformed_data):
+    """
+    Test the save and load methods of the MultiFieldIndex class from the index_engine module.
+
+    Tests include:
+    1. A loaded index answers queries like the one it was saved from.
+    2. Handling of empty input data.
+    """
+    logging.info("Starting test_multi_field_index_save_load...")
+
+    path = str(tmp_path / 'index.npz')
+    MultiFieldIndex.build(transformed_data).save(path)
+    index = MultiFieldIndex.load(path)
+    assert index.query('location=Poland AND NOT age_group=2').tolist() == ['a']
+
+    with pytest.raises(ValueError, match="Input data is empty"):
+        MultiFieldIndex.build(transformed_data.iloc[:0])
+
+    logging.info("test_multi_field_index_save_load completed successfully.")
+
+
+def test_multi_field_index_apply_delta(tmp_path, transformed_data):
+    """
+    Test the apply_delta and compact methods of the MultiFieldIndex class from the index_engine module.
+
+    Tests include:
+    1. Changed, new and deleted users are reflected in queries, matching a rebuilt index.
+    2. The delta survives compaction through save and load.
+    3. A small delta is saved as delta segments without rewriting the saved arrays, and survives load.
+    """
+    logging.info("Starting test_multi_field_index_apply_delta...")
+
+    index = MultiFieldIndex.build(transformed_data)
+    changed = transformed_data[transformed_data['id'] == 'b'].assign(location='Poland')
+    new = transformed_data[transformed_data['id'] == 'c'].assign(id='e', location='Greece')
+    index.apply_delta(pd.concat([changed, new]), deleted_ids=['a'])
+
+    current = pd.concat([transformed_data[transformed_data['id'].isin(['c', 'd'])], changed, new])
+    rebuilt = MultiFieldIndex.build(current)
+    for query in ['location=Poland', 'location=Greece', 'NOT location=Poland', 'widget_name=widget2 AND age_group=2']:
+        assert sorted(index.query(query)) == rebuilt.query(query).tolist()
+
+    path = str(tmp_path / 'index.npz')
+    index.save(path)
+    loaded = MultiFieldIndex.load(path)
+    assert loaded.ids.tolist() == ['b', 'c', 'd', 'e']
+    assert loaded.query('location=Poland OR location=Greece').tolist() == ['b', 'c', 'e']
+    assert not os.path.exists(delta_path(path))
+
+    base = open(path, 'rb').read()
+    loaded.apply_delta(new.assign(id='f', location='Spain'))
+    loaded.save(path, compact_fraction=0.5)
+    assert open(path, 'rb').read() == base and os.path.exists(delta_path(path))
+    reloaded = MultiFieldIndex.load(path)
+    assert reloaded.query('location=Spain').tolist() == ['f']
+    assert reloaded.query('NOT location=Spain').tolist() == ['b', 'c', 'd', 'e']
+
+    reloaded.apply_delta(changed.assign(location='Spain'))
+    reloaded.save(path, compact_fraction=0.5)
+    assert reloaded.query('location=Spain').tolist() == ['b', 'f']
+    assert open(path, 'rb').read() == base and MultiFieldIndex.load(path).query('location=Spain').tolist() == ['b', 'f']
+
+    MultiFieldIndex.load(path).save(path, compact_fraction=0)
+    assert not os.path.exists(delta_path(path))
+    assert MultiFieldIndex.load(path).query('location=Spain').tolist() == ['b', 'f']
+
+    logging.info("test_multi_field_index_apply_delta completed successfully.")
+
+
+if __name__ == "__main__":
+    pytest.main()
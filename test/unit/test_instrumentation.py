@@ -0,0 +1,121 @@
+import os, sys
+import json
+import tracemalloc
+import pytest
+import logging
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
+
+from instrumentation import Instrumentation
+
+logging.basicConfig(level=logging.INFO)
+
+
+def write_rows(data, path):
+    """Write the rows of a DataFrame to a CSV file, returning the first half of them."""
+    data.to_csv(path)
+    return data.head(len(data) // 2)
+
+
+@pytest.fixture
+def metrics(tmp_path):
+    """Fixture to provide the measurements of one stage writing a file, and one skipped as cached."""
+    metrics = Instrumentation()
+    data = pd.DataFrame({'value': range(1000)})
+    metrics.measure('write', write_rows, [data], {'path': str(tmp_path / 'rows.csv')})
+    metrics.skip('cached')
+    return metrics
+
+
+def test_measure(metrics):
+    """
+    Test the measure and skip methods of the Instrumentation class from the instrumentation module.
+
+    Tests include:
+    1. The wall and CPU time, rows in and out, bytes written and resident memory of a stage are recorded.
+    2. Memory peaks are only recorded when tracing.
+    3. Skipped stages are recorded as cached, without measurements.
+    4. A stage that raises is recorded as failed, measured up to the error, and the error is raised.
+    """
+    logging.info("Starting test_measure...")
+
+    record, skipped = metrics.records
+    assert record['stage'] == 'write' and not record['cached']
+    assert record['seconds'] > 0 and record['cpu_seconds'] >= 0
+    assert (record['rows_in'], record['rows_out']) == (1000, 500)
+    assert record['bytes_written'] is None or record['bytes_written'] >= 1000
+    assert record['max_rss_bytes'] > 0
+    assert 'peak_bytes' not in record and metrics.peak_memory() == {}
+    assert skipped == {'stage': 'cached', 'cached': True}
+    assert not record['failed']
+
+    with pytest.raises(ZeroDivisionError):
+        metrics.measure('fail', lambda data: 1 / 0, [pd.DataFrame({'value': range(10)})])
+    failed = metrics.records[-1]
+    assert failed['stage'] == 'fail' and failed['failed'] and not failed['cached']
+    assert failed['rows_in'] == 10 and failed['rows_out'] is None and failed['seconds'] >= 0
+
+    logging.info("test_measure completed successfully.")
+
+
+def test_trace_memory():
+    """
+    Test the memory tracing of the Instrumentation class from the instrumentation module.
+
+    Tests include:
+    1. The peak memory allocated by a stage is recorded.
+    2. The source lines holding the most memory at the end of the stage are recorded, up to the number asked for.
+    """
+    logging.info("Starting test_trace_memory...")
+
+    metrics = Instrumentation(trace_memory=True, hotspots=3)
+    tracemalloc.start()
+    try:
+        held = metrics.measure('allocate', lambda: [bytearray(2 ** 20) for _ in range(5)])
+    finally:
+        tracemalloc.stop()
+
+    assert metrics.peak_memory()['allocate'] >= 5 * 2 ** 20
+    hotspots = metrics.records[0]['hotspots']
+    assert 0 < len(hotspots) <= 3
+    assert 'test_instrumentation.py' in hotspots[0]['line'] and hotspots[0]['bytes'] >= 5 * 2 ** 20
+    del held
+
+    logging.info("test_trace_memory completed successfully.")
+
+
+def test_write_metrics(metrics, tmp_path):
+    """
+    Test the write_jsonl and write_prometheus methods of the Instrumentation class from the instrumentation module.
+
+    Tests include:
+    1. Each run appends one JSON line per stage, tagged with its run id.
+    2. The Prometheus file holds one gauge sample per stage and measurement, and is replaced on each write.
+    """
+    logging.info("Starting test_write_metrics...")
+
+    jsonl_path = str(tmp_path / 'metrics' / 'stages.jsonl')
+    metrics.write_jsonl(jsonl_path)
+    metrics.write_jsonl(jsonl_path)
+    with open(jsonl_path) as file:
+        lines = [json.loads(line) for line in file]
+    assert [line['stage'] for line in lines] == ['write', 'cached'] * 2
+    assert {line['run_id'] for line in lines} == {metrics.run_id}
+    assert lines[0]['rows_out'] == 500
+
+    prometheus_path = str(tmp_path / 'metrics' / 'stages.prom')
+    metrics.write_prometheus(prometheus_path)
+    metrics.write_prometheus(prometheus_path)
+    with open(prometheus_path) as file:
+        text = file.read()
+    assert '# TYPE etl_stage_seconds gauge' in text
+    assert 'etl_stage_rows_out{stage="write"} 500\n' in text
+    assert 'etl_stage_cached{stage="cached"} 1\n' in text
+    assert 'etl_stage_failed{stage="write"} 0\n' in text
+    assert 'etl_stage_seconds{stage="cached"}' not in text
+    assert 'etl_stage_peak_bytes' not in text
+    assert text.count('# TYPE etl_stage_rows_in gauge') == 1
+    assert sorted(os.listdir(tmp_path / 'metrics')) == ['stages.jsonl', 'stages.prom']
+
+    logging.info("test_write_metrics completed successfully.")
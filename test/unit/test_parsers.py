@@ -0,0 +1,109 @@
+import os, sys
+import pytest
+import numpy as np
+import pandas as pd
+import logging
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
+
+import data_processing as dp
+import parsers
+from constants import DATA_PATH
+
+logging.basicConfig(level=logging.INFO)
+
+
+def test_parse_lines():
+    """
+    Test the parse_lines function from the parsers module.
+
+    Tests include:
+    1. Columns get their declared compact types, and hold the same values as the pandas backend.
+    2. Missing fields, values not fitting their type and non-UTC timestamps fall back to inferred types.
+    3. Blank lines are skipped and no lines give an empty DataFrame.
+    4. widgets=False skips the WidgetColumn arrays and keeps the widget lists in the DataFrame,
+       also when every record has the same number of widgets.
+    """
+    logging.info("Starting test_parse_lines...")
+
+    with open(DATA_PATH, 'rb') as file:
+        data, widgets = parsers.parse_lines(file.read().splitlines())
+    assert data['age_group'].dtype == np.int8
+    assert isinstance(data['location'].dtype, pd.CategoricalDtype)
+    assert str(data['created_at'].dtype) == 'datetime64[ns, UTC]'
+    expected = dp.extract(data_path=DATA_PATH)
+    pd.testing.assert_frame_equal(data.astype({'age_group': 'int64', 'location': object}), expected)
+    assert set(widgets) == {'widget_list'}
+
+    data, widgets = parsers.parse_lines([
+        '{"id": "a", "age_group": 1, "created_at": "2020-01-01T02:00:00+02:00", "widget_list": []}',
+        '',
+        '{"id": "b", "age_group": 1000, "created_at": "2020-01-01T00:00:00Z"}',
+        '{"id": "c", "age_group": null, "created_at": "2020-01-01T00:00:00Z", "user_score": null}',
+    ])
+    assert data['age_group'].dtype == np.float64 and data['age_group'].isna().tolist() == [False, False, True]
+    assert data['created_at'].nunique() == 1 and data['user_score'].isna().all()
+    assert widgets['widget_list'].lengths().tolist() == [0, 0, 0]
+
+    data, widgets = parsers.parse_lines([])
+    assert data.empty and widgets == {}
+
+    lines = ['{"id": "a", "widget_list": [{"name": "x", "amount": 1}]}']
+    data, widgets = parsers.parse_lines(lines, widgets=False)
+    assert widgets == {} and data['widget_list'].tolist() == [[{'name': 'x', 'amount': 1}]]
+
+    logging.info("test_parse_lines completed successfully.")
+
+
+def test_widget_column():
+    """
+    Test the WidgetColumn class from the parsers module.
+
+    Tests include:
+    1. Widgets are flattened into offsets, names and amounts in record order.
+    2. take selects the widgets of the given records in their new order.
+    """
+    logging.info("Starting test_widget_column...")
+
+    widgets = parsers.WidgetColumn.from_lists([
+        [{'name': 'a', 'amount': 1}, {'name': 'b', 'amount': 2}],
+        None,
+        [{'name': 'c', 'amount': 3}],
+    ])
+    assert len(widgets) == 3
+    assert widgets.offsets.tolist() == [0, 2, 2, 3]
+    assert widgets.names.tolist() == ['a', 'b', 'c'] and widgets.amounts.tolist() == [1, 2, 3]
+
+    taken = widgets.take([2, 1, 0])
+    assert taken.offsets.tolist() == [0, 1, 1, 3]
+    assert taken.names.tolist() == ['c', 'a', 'b'] and taken.amounts.tolist() == [3, 1, 2]
+
+    logging.info("test_widget_column completed successfully.")
+
+
+def test_extract_backends():
+    """
+    Test the backend parameter of the extract function from the dp module.
+
+    Tests include:
+    1. Streaming and partitioned extracts with the typed backend match its whole-file extract,
+       keeping categorical columns categorical.
+    2. Handling of an unknown backend.
+    """
+    logging.info("Starting test_extract_backends...")
+
+    data = dp.extract(data_path=DATA_PATH, backend='typed')
+    batches = list(dp.extract(data_path=DATA_PATH, chunksize=400, backend='typed'))
+    pd.testing.assert_frame_equal(pd.concat(batches).astype({'location': object}), data.astype({'location': object}))
+    partitioned = dp.extract(data_path=DATA_PATH, max_workers=2, backend='typed')
+    assert isinstance(partitioned['location'].dtype, pd.CategoricalDtype)
+    pd.testing.assert_frame_equal(partitioned.astype({'location': object}), data.astype({'location': object}))
+
+    with pytest.raises(ValueError, match="Unknown parser backend 'yaml'"):
+        dp.extract(data_path=DATA_PATH, backend='yaml')
+
+    logging.info("test_extract_backends completed successfully.")
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,243 @@
+import os, sys
+import threading
+import time
+import tracemalloc
+import pytest
+import logging
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
+
+from pipeline import Pipeline, PipelineError
+
+logging.basicConfig(level=logging.INFO)
+
+
+@pytest.fixture
+def cache_folder(tmp_path):
+    """Fixture to provide an empty cache folder for testing."""
+    return str(tmp_path / 'cache')
+
+
+def build_pipeline(cache_folder, calls, source_path, offset=1, valid=None):
+    """Build a pipeline of three stages, recording every stage run in calls."""
+    def read(path):
+        calls.append('read')
+        with open(path) as file:
+            return int(file.read())
+
+    def add(value, offset):
+        calls.append('add')
+        return value + offset
+
+    def double(value):
+        calls.append('double')
+        return value * 2
+
+    pipeline = Pipeline(cache_folder=cache_folder)
+    pipeline.add_stage('read', read, params={'path': source_path}, files=[source_path])
+    pipeline.add_stage('add', add, inputs=['read'], params={'offset': offset})
+    pipeline.add_stage('double', double, inputs=['add'], valid=valid)
+    return pipeline
+
+
+def test_pipeline_cache(cache_folder, tmp_path, monkeypatch):
+    """
+    Test the caching of stage outputs by the Pipeline class from the pipeline module.
+
+    Tests include:
+    1. A rerun skips every stage, without loading any output, as only their metadata is read.
+    2. A changed parameter or input file reruns the stage and the stages downstream of it only.
+    3. A stage whose validity check fails is rerun, and force reruns every stage.
+    """
+    logging.info("Starting test_pipeline_cache...")
+
+    source_path = str(tmp_path / 'source.txt')
+    with open(source_path, 'w') as file:
+        file.write('1')
+
+    calls = []
+    assert build_pipeline(cache_folder, calls, source_path).run() == {'read': 1, 'add': 2, 'double': 4}
+    assert calls == ['read', 'add', 'double']
+
+    calls.clear()
+    loads = []
+    monkeypatch.setattr(pd, 'read_pickle', lambda path: loads.append(path))
+    assert build_pipeline(cache_folder, calls, source_path).run() == {}
+    assert calls == [] and loads == []
+    monkeypatch.undo()
+
+    assert build_pipeline(cache_folder, calls, source_path, offset=2).run() == {'read': 1, 'add': 3, 'double': 6}
+    assert calls == ['add', 'double']
+
+    calls.clear()
+    with open(source_path, 'w') as file:
+        file.write('5')
+    assert build_pipeline(cache_folder, calls, source_path).run()['double'] == 12
+    assert calls == ['read', 'add', 'double']
+
+    calls.clear()
+    build_pipeline(cache_folder, calls, source_path, valid=lambda output: output != 12).run()
+    assert calls == ['double']
+
+    calls.clear()
+    build_pipeline(cache_folder, calls, source_path).run(force=True)
+    assert calls == ['read', 'add', 'double']
+
+    logging.info("test_pipeline_cache completed successfully.")
+
+
+def test_pipeline_state(cache_folder):
+    """
+    Test the caching of stages with external state by the Pipeline class from the pipeline module.
+
+    Tests include:
+    1. Their outputs are only cached by commit, and not at all if the run fails before it.
+    2. A cache hit needs the fingerprint of their state to match the one stored at commit.
+    3. The source of the modules given is part of every cache key.
+    """
+    logging.info("Starting test_pipeline_state...")
+
+    table = {'rows': 0}
+    calls = []
+
+    def write(rows):
+        calls.append('write')
+        table['rows'] = rows
+        return rows
+
+    def build(fail=False):
+        pipeline = Pipeline(cache_folder=cache_folder, modules=[logging] if fail else [])
+        pipeline.add_stage('write', write, params={'rows': 3}, state=lambda: table['rows'])
+        if fail:
+            pipeline.add_stage('fail', lambda rows: 1 / 0, inputs=['write'])
+        return pipeline
+
+    pipeline = build()
+    assert pipeline.run(commit=False) == {'write': 3}
+    assert os.listdir(cache_folder) == []
+    pipeline.commit()
+    assert build().run() == {} and calls == ['write']
+
+    table['rows'] = 5
+    assert build().run() == {'write': 3} and calls == ['write', 'write']
+    assert build().run() == {}
+
+    # Another module list changes the key, and a failed run caches nothing for it
+    with pytest.raises(ZeroDivisionError):
+        build(fail=True).run()
+    with pytest.raises(ZeroDivisionError):
+        build(fail=True).run()
+    assert calls == ['write'] * 4
+
+    logging.info("test_pipeline_state completed successfully.")
+
+
+def test_pipeline_scheduling(cache_folder):
+    """
+    Test the scheduling of stages by the Pipeline class from the pipeline module.
+
+    Tests include:
+    1. Independent stages run concurrently, and a stage runs only after every stage it depends on.
+    2. An error in a stage is raised by run, nothing downstream of it runs, and the stage is recorded as failed.
+    3. Handling of duplicate stage names and unknown upstream stages.
+    """
+    logging.info("Starting test_pipeline_scheduling...")
+
+    # Both branches must be running at once to pass the barrier
+    barrier = threading.Barrier(2, timeout=5)
+    finished = []
+
+    def branch(name):
+        barrier.wait()
+        finished.append(name)
+        return name
+
+    def join(left, right, after_name):
+        assert finished == [left, right] or finished == [right, left]
+        finished.append(after_name)
+        return f'{left}+{right}'
+
+    pipeline = Pipeline(cache_folder=cache_folder)
+    pipeline.add_stage('left', branch, params={'name': 'left'})
+    pipeline.add_stage('right', branch, params={'name': 'right'})
+    pipeline.add_stage('join', join, inputs=['left', 'right'], params={'after_name': 'join'})
+    assert pipeline.run()['join'] == 'left+right'
+
+    def fail():
+        raise RuntimeError("Stage failed")
+
+    failing = Pipeline(cache_folder=cache_folder)
+    failing.add_stage('fail', fail)
+    failing.add_stage('downstream', lambda value: finished.append('downstream'), inputs=['fail'])
+    with pytest.raises(RuntimeError, match="Stage failed"):
+        failing.run()
+    assert 'downstream' not in finished
+    assert [(record['stage'], record['failed']) for record in failing.metrics.records] == [('fail', True)]
+
+    with pytest.raises(PipelineError, match="already exists"):
+        failing.add_stage('fail', fail)
+    with pytest.raises(PipelineError, match="unknown stages: missing"):
+        failing.add_stage('orphan', fail, after=['missing'])
+
+    logging.info("test_pipeline_scheduling completed successfully.")
+
+
+def test_profile_memory(cache_folder):
+    """
+    Test the memory profiling of the Pipeline class from the pipeline module.
+
+    Tests include:
+    1. The peak memory allocated by each stage that runs is recorded, and stages that do not run are left out.
+    2. Tracing is stopped after the run.
+    3. The stages that do not run are recorded in the metrics as cached.
+    """
+    logging.info("Starting test_profile_memory...")
+
+    pipeline = Pipeline(cache_folder=cache_folder)
+    pipeline.add_stage('allocate', lambda: len(bytearray(10 * 2 ** 20)))
+    pipeline.add_stage('count', lambda size: size // 2 ** 20, inputs=['allocate'])
+    assert pipeline.run(profile_memory=True) == {'allocate': 10 * 2 ** 20, 'count': 10}
+    assert set(pipeline.peak_memory) == {'allocate', 'count'}
+    assert pipeline.peak_memory['allocate'] >= 10 * 2 ** 20 > pipeline.peak_memory['count']
+    assert not tracemalloc.is_tracing()
+
+    pipeline.run(profile_memory=True)
+    assert pipeline.peak_memory == {}
+    assert pipeline.metrics.records == [{'stage': 'allocate', 'cached': True}, {'stage': 'count', 'cached': True}]
+
+    logging.info("test_profile_memory completed successfully.")
+
+
+def test_evict(cache_folder):
+    """
+    Test the evict method of the Pipeline class from the pipeline module.
+
+    Tests include:
+    1. The least recently used outputs are deleted, with their metadata, until the cache folder fits its size limit.
+    2. Outputs of the current run are kept even over the limit.
+    """
+    logging.info("Starting test_evict...")
+
+    os.makedirs(cache_folder)
+    for age, name in enumerate(['new', 'middle', 'old']):
+        path = os.path.join(cache_folder, f'{name}.pkl')
+        with open(path, 'wb') as file:
+            file.write(b'x' * 100)
+        os.utime(path, (time.time() - age * 60,) * 2)
+    with open(os.path.join(cache_folder, 'old.meta.json'), 'w') as file:
+        file.write('{"state": null}')
+
+    pipeline = Pipeline(cache_folder=cache_folder, max_cache_bytes=200)
+    pipeline.evict()
+    assert sorted(os.listdir(cache_folder)) == ['middle.pkl', 'new.pkl']
+
+    pipeline.max_cache_bytes = 0
+    pipeline.evict(keep=[os.path.join(cache_folder, 'middle.pkl')])
+    assert os.listdir(cache_folder) == ['middle.pkl']
+
+    logging.info("test_evict completed successfully.")
+
+
+if __name__ == "__main__":
+    pytest.main()
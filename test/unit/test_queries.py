@@ -0,0 +1,136 @@
+import os, sys
+import pytest
+import logging
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
+
+import db_operations as db_ops
+from rankings import AgeGroupRankings
+from queries import LRUCache, QueryService, TopUser
+
+logging.basicConfig(level=logging.INFO)
+
+
+@pytest.fixture
+def transformed_data():
+    """Fixture to provide ranked, flattened user data for testing."""
+    return pd.DataFrame({
+        'id': ['a', 'a', 'b', 'c', 'd'],
+        'email': ['a@x.com', 'a@x.com', 'b@x.com', 'c@x.com', 'd@x.com'],
+        'age_group': [1, 1, 1, 2, 2],
+        'user_score': [0.9, 0.9, 0.5, 0.7, 0.7],
+        'location': ['Poland', 'Poland', 'Greece', 'Poland', 'Greece'],
+        'created_at': ['2020-01-01T00:00:00Z'] * 5,
+        'age_group_rank': [1, 1, 2, 1, 1],
+        'widget_name': ['widget1', 'widget2', 'widget3', None, 'widget4'],
+        'widget_amount': [10.0, 20.0, 30.0, None, 40.0],
+    })
+
+
+@pytest.fixture
+def db_path(tmp_path, transformed_data):
+    """Fixture to provide the path of an export database loaded from transformed_data by one committed run."""
+    db_path = str(tmp_path / 'test.db')
+    with db_ops.Session(db_path) as session:
+        db_ops.bulk_load(transformed_data, db_path, table_name='transformed_data', session=session)
+        db_ops.store_posting_lists(db_ops.create_posting_lists(transformed_data), db_path, session=session)
+        db_ops.store_rankings(AgeGroupRankings.from_data(transformed_data), db_path, session=session)
+        db_ops.bump_generation(db_path, session=session)
+    return db_path
+
+
+def test_queries(db_path):
+    """
+    Test the queries of the QueryService class from the queries module.
+
+    Tests include:
+    1. The top users of each age group are returned once each, ties included, ranked by the stored rankings
+       even where the age_group_rank column of transformed_data is stale.
+    2. The ids of the users at a location are returned sorted, and none for an unknown location.
+    3. The widgets of a user are returned with the rank of their record, from the stored rankings too.
+    """
+    logging.info("Starting test_queries...")
+
+    with QueryService(db_path, pool_size=2) as service:
+        assert service.top_users() == (TopUser(1, 1, 'a', 'a@x.com', 0.9), TopUser(2, 1, 'c', 'c@x.com', 0.7),
+                                       TopUser(2, 1, 'd', 'd@x.com', 0.7))
+        assert [user.id for user in service.top_users(k=2)] == ['a', 'b', 'c', 'd']
+        assert service.top_users(k=5) == service.top_users(k=2)
+        assert service.ids_by_location('Poland') == ('a', 'c')
+        assert service.ids_by_location('Nowhere') == ()
+        widgets = service.user_widgets('a')
+        assert [(widget.widget_name, widget.widget_amount, widget.age_group_rank) for widget in widgets] == \
+            [('widget1', 10.0, 1), ('widget2', 20.0, 1)]
+        assert service.user_widgets('c')[0].widget_name is None
+        assert service.user_widgets('z') == ()
+
+        # An incremental run re-ranks the stored users without rewriting the ranks of their other records
+        rankings = db_ops.load_rankings(db_path)
+        rankings.upsert(pd.DataFrame({'id': ['b'], 'created_at': ['2020-01-01T00:00:00Z'], 'age_group': [1],
+                                      'user_score': [0.95]}))
+        with db_ops.Session(db_path) as session:
+            db_ops.store_rankings(rankings, db_path, session=session)
+            db_ops.bump_generation(db_path, session=session)
+        assert service.top_users()[0] == TopUser(1, 1, 'b', 'b@x.com', 0.95)
+        assert [user.age_group_rank for user in service.top_users()] == [1, 1, 1]
+        assert [widget.age_group_rank for widget in service.user_widgets('a')] == [2, 2]
+
+    logging.info("test_queries completed successfully.")
+
+
+def test_query_cache(db_path, transformed_data):
+    """
+    Test the result cache of the QueryService class from the queries module.
+
+    Tests include:
+    1. Repeated queries are answered from the cache with the same result.
+    2. A run that commits new data and bumps the run generation invalidates the cache.
+    3. Uncommitted writes do not invalidate it.
+    """
+    logging.info("Starting test_query_cache...")
+
+    with QueryService(db_path) as service:
+        first = service.ids_by_location('Poland')
+        assert service.ids_by_location('Poland') is first
+        assert (service.cache.hits, service.cache.misses) == (1, 1)
+        generation = service.generation
+
+        moved = transformed_data.assign(location='Poland')
+        with db_ops.Session(db_path) as session:
+            db_ops.store_posting_lists(db_ops.create_posting_lists(moved), db_path, session=session)
+            assert service.ids_by_location('Poland') == ('a', 'c')
+            db_ops.bump_generation(db_path, session=session)
+            assert service.ids_by_location('Poland') == ('a', 'c')
+        assert service.ids_by_location('Poland') == ('a', 'b', 'c', 'd')
+        assert service.generation == generation + 1
+
+    logging.info("test_query_cache completed successfully.")
+
+
+def test_lru_cache():
+    """
+    Test the LRUCache class from the queries module.
+
+    Tests include:
+    1. The least recently used entries are evicted beyond the entry limit.
+    2. Entries are evicted beyond the byte limit, and values larger than it are not stored.
+    """
+    logging.info("Starting test_lru_cache...")
+
+    cache = LRUCache(max_entries=2, max_bytes=10000)
+    cache.put('a', ('1',))
+    cache.put('b', ('2',))
+    assert cache.get('a') == ('1',)
+    cache.put('c', ('3',))
+    assert cache.get('b') is None and cache.get('a') == ('1',) and len(cache) == 2
+
+    cache = LRUCache(max_entries=10, max_bytes=2000)
+    cache.put('a', ('x' * 1500,))
+    cache.put('b', ('y' * 1500,))
+    assert cache.get('a') is None and cache.get('b') is not None
+    assert cache.nbytes <= 2000
+    cache.put('c', ('z' * 5000,))
+    assert cache.get('c') is None and cache.get('b') is not None
+
+    logging.info("test_lru_cache completed successfully.")
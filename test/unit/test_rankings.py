@@ -0,0 +1,92 @@
+import os, sys
+import pytest
+import pandas as pd
+import logging
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
+
+import data_processing as dp
+from rankings import AgeGroupRankings
+
+logging.basicConfig(level=logging.INFO)
+
+
+@pytest.fixture
+def users():
+    """Fixture to provide records with age groups and scores for testing, two of them of user 'a'."""
+    return pd.DataFrame({
+        'id': ['a', 'b', 'c', 'd', 'e', 'f', 'a'],
+        'created_at': pd.to_datetime(['2020-01-01T00:00:00Z'] * 6 + ['2020-02-01T00:00:00Z']),
+        'age_group': [1, 1, 2, 1, 2, 1, 1],
+        'user_score': [0.5, 0.9, 0.3, 0.5, 0.8, 0.1, 0.2]
+    })
+
+
+def ranks(rankings, data):
+    """Return the rank of each record of the data."""
+    return [rankings.rank(user_id, created_at) for user_id, created_at in zip(data['id'], data['created_at'])]
+
+
+def test_rankings_match_rank_users(users):
+    """
+    Test the rank and top_k methods of the AgeGroupRankings class from the rankings module.
+
+    Tests include:
+    1. Ranks match rank_users, including tied scores and every record of a user.
+    2. Top k records per age group, with ties in arrival order, and an unknown age group.
+    3. Records are found by created_at given as text too.
+    4. Handling of an unknown record and missing columns.
+    """
+    logging.info("Starting test_rankings_match_rank_users...")
+
+    rankings = AgeGroupRankings.from_data(users)
+    ranked = dp.rank_users(users)
+    assert ranks(rankings, ranked) == ranked['age_group_rank'].tolist()
+    assert rankings.top_k(1, 3)['id'].tolist() == ['b', 'a', 'd']
+    assert rankings.top_k(1, 5)['created_at'].iloc[3] == pd.Timestamp('2020-02-01T00:00:00Z')
+    assert rankings.top_k(2, 5)['id'].tolist() == ['e', 'c']
+    assert rankings.top_k(3, 1).empty
+    assert rankings.rank('a', '2020-02-01 00:00:00+00:00') == 4 and ('a', '2020-01-01 00:00:00+00:00') in rankings
+
+    with pytest.raises(KeyError):
+        rankings.rank('z', '2020-01-01T00:00:00Z')
+    with pytest.raises(ValueError, match="Missing required columns"):
+        rankings.upsert(users.drop(columns='user_score'))
+
+    logging.info("test_rankings_match_rank_users completed successfully.")
+
+
+def test_rankings_changes(users):
+    """
+    Test the upsert, delete and pop_changes methods of the AgeGroupRankings class from the rankings module.
+
+    Tests include:
+    1. Inserts, score updates, age group moves and deletes keep ranks equal to a full re-rank.
+    2. A new record of a user is ranked alongside its earlier records rather than replacing them.
+    3. Only the changed records are reported, once.
+    """
+    logging.info("Starting test_rankings_changes...")
+
+    rankings = AgeGroupRankings.from_data(users)
+    rankings.pop_changes()
+
+    changes = pd.DataFrame({'id': ['a', 'c', 'g', 'd'], 'age_group': [1, 1, 2, 1], 'user_score': [0.95, 0.2, 0.85, 0.7],
+                            'created_at': pd.to_datetime(['2020-01-01T00:00:00Z'] * 3 + ['2020-03-01T00:00:00Z'])})
+    rankings.upsert(changes)
+    rankings.delete([('b', '2020-01-01T00:00:00Z'), ('z', '2020-01-01T00:00:00Z')])
+
+    current = pd.concat([users.iloc[[3, 4, 5, 6]], changes])
+    ranked = dp.rank_users(current)
+    assert len(rankings) == len(current) == 8
+    assert ranks(rankings, ranked) == ranked['age_group_rank'].tolist()
+    assert dp.rank_users(current, score_index=rankings.score_index())['age_group_rank'].tolist() == ranked['age_group_rank'].tolist()
+
+    upserted, deleted = rankings.pop_changes()
+    assert sorted(upserted['id']) == ['a', 'c', 'd', 'g'] and deleted == [('b', pd.Timestamp('2020-01-01T00:00:00Z'))]
+    assert rankings.pop_changes()[0].empty
+
+    logging.info("test_rankings_changes completed successfully.")
+
+
+if __name__ == "__main__":
+    pytest.main()
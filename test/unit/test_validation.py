@@ -0,0 +1,103 @@
+import os, sys
+import json
+import pytest
+import pandas as pd
+import logging
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
+
+import data_processing as dp
+import validation
+
+logging.basicConfig(level=logging.INFO)
+
+
+@pytest.fixture(scope='module')
+def raw_data():
+    """Fixture to provide the extracted raw data for testing."""
+    return dp.extract()
+
+
+def test_validate(raw_data):
+    """
+    Test the validate function from the validation module with the default expectations.
+
+    Tests include:
+    1. The raw data meets the default expectations.
+    2. Nulls, wrong types and values not matching their pattern are counted and listed.
+    3. Checking in parallel chunks gives the same results as checking in one chunk.
+    """
+    logging.info("Starting test_validate...")
+
+    results = validation.validate(raw_data)
+    assert results['success'] and results['statistics']['unsuccessful_expectations'] == 0
+
+    data = raw_data.copy()
+    data.loc[0, 'email'] = 'not-an-email'
+    data.loc[1, 'location'] = None
+    data.loc[2, 'id'] = 5
+    results = validation.validate(data, chunksize=300, max_workers=2)
+    assert not results['success'] and results['meta']['chunks'] == 4
+    failed = {(result['expectation_config']['expectation_type'], result['expectation_config']['kwargs']['column']):
+              result['result'] for result in results['results'] if not result['success']}
+    assert set(failed) == {('expect_column_values_to_match_regex', 'email'),
+                           ('expect_column_values_to_not_be_null', 'location'),
+                           ('expect_column_values_to_be_in_type_list', 'id'),
+                           ('expect_column_values_to_match_regex', 'id')}
+    assert failed[('expect_column_values_to_match_regex', 'email')]['partial_unexpected_list'] == ['not-an-email']
+    assert failed[('expect_column_values_to_be_in_type_list', 'id')]['unexpected_count'] == 1
+    assert len(validation.failures(results)) == 4
+
+    single_chunk = validation.validate(data, max_workers=1)
+    assert [result['result'] for result in single_chunk['results']] == [result['result'] for result in results['results']]
+
+    logging.info("test_validate completed successfully.")
+
+
+def test_validate_suite(raw_data, tmp_path):
+    """
+    Test the validate and load_expectations functions from the validation module with a saved expectation suite.
+
+    Tests include:
+    1. Table, column statistic, quantile and distinct value expectations report Great Expectations' observed values.
+    2. Unsupported expectations fail with an exception, without stopping the validation.
+    3. Excluded expectation types are left out of the loaded suite.
+    4. Handling of an unreadable suite.
+    """
+    logging.info("Starting test_validate_suite...")
+
+    suite = {'expectation_suite_name': 'raw', 'expectations': [
+        {'expectation_type': 'expect_table_row_count_to_be_between', 'kwargs': {'min_value': 1000, 'max_value': 1000}},
+        {'expectation_type': 'expect_column_min_to_be_between', 'kwargs': {'column': 'age_group', 'min_value': 1, 'max_value': 1}},
+        {'expectation_type': 'expect_column_quantile_values_to_be_between',
+         'kwargs': {'column': 'age_group', 'allow_relative_error': 'lower',
+                    'quantile_ranges': {'quantiles': [0.05, 0.95], 'value_ranges': [[1, 1], [4, 4]]}}},
+        {'expectation_type': 'expect_column_proportion_of_unique_values_to_be_between',
+         'kwargs': {'column': 'widget_list', 'min_value': 0.758, 'max_value': 0.758}},
+        {'expectation_type': 'expect_column_values_to_be_in_type_list',
+         'kwargs': {'column': 'created_at', 'type_list': ['Timestamp']}},
+        {'expectation_type': 'expect_column_values_to_be_between',
+         'kwargs': {'column': 'created_at', 'min_value': '2019-08-12 01:21:27+00:00', 'max_value': '2020-08-11 00:05:12+00:00'}},
+        {'expectation_type': 'expect_column_kl_divergence_to_be_less_than', 'kwargs': {'column': 'revenue'}},
+    ]}
+    suite_path = str(tmp_path / 'suite.json')
+    with open(suite_path, 'w') as file:
+        json.dump(suite, file)
+
+    results = validation.validate(raw_data, validation.load_expectations(suite_path), chunksize=400, max_workers=2)
+    assert [result['success'] for result in results['results']] == [True] * 6 + [False]
+    assert results['results'][3]['result']['observed_value'] == 0.758
+    assert results['results'][6]['exception_info']['raised_exception']
+    excluded = ['expect_table_row_count_to_be_between', 'expect_column_min_to_be_between']
+    assert len(validation.load_expectations(suite_path, excluded=excluded)) == 5
+
+    with pytest.raises(validation.ValidationError, match="Unable to read expectation suite"):
+        validation.load_expectations(str(tmp_path / 'missing.json'))
+    with pytest.raises(validation.ValidationError, match="Expected an expectation suite"):
+        validation.validate(raw_data, {'expectations': 'none'})
+
+    logging.info("test_validate_suite completed successfully.")
+
+
+if __name__ == "__main__":
+    pytest.main()